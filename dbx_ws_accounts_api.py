@@ -3,18 +3,76 @@
 
 import time
 
-from databricks_cli.sdk import ApiClient
-from databricks_cli.accounts.api import AccountsApi
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from dbx_ws_accounts_transport import DatabricksWSAccountsTransport, DatabricksWSRateLimiter
+from dbx_ws_tracer import DatabricksWSTracer, traced
+from dbx_ws_workspace_watcher import DatabricksWSWorkspaceWatcher
+
+# Keys of the workspace request that differ from the id keys of the workspace input data
+WORKSPACE_REQUEST_KEYS = {
+    "storage_config_id": "storage_configuration_id"
+}
+# For each workspace object, the calls to list and delete it, and the key path of the name it's found by
+# A customer managed key has no name, so it's found by the key ARN from its stack's output, and swept by its alias
+WORKSPACE_OBJECT_CALLS = {
+    "credentials_id": {
+        "list_call": 'list_credentials',
+        "delete_call": 'delete_credentials',
+        "name_key_path": ("credentials_name",)
+    },
+    "storage_config_id": {
+        "list_call": 'list_storage_config',
+        "delete_call": 'delete_storage_config',
+        "name_key_path": ("storage_configuration_name",)
+    },
+    "network_id": {
+        "list_call": 'list_network',
+        "delete_call": 'delete_network',
+        "name_key_path": ("network_name",)
+    },
+    "customer_managed_key_id": {
+        "list_call": 'list_customer_managed_keys',
+        "delete_call": 'delete_customer_managed_key',
+        "name_key_path": ("aws_key_info", "key_arn"),
+        "input_data_key": "kms_key_arn",
+        "sweep_key_path": ("aws_key_info", "key_alias")
+    }
+}
+
+# Get the value at a key path of a nested dict, or None if any key along the path is missing
+def get_key_path_value(nested_dict, key_path):
+    for key in key_path:
+        nested_dict = nested_dict.get(key) if isinstance(nested_dict, dict) else None
+    return nested_dict
 
 class DatabricksWSAccountsAPI(object):
 
-    def __init__(self, common_params):
-        dbcli_apiclient = ApiClient(common_params["api_user"], password=common_params["api_password"],
-                                host='https://accounts.cloud.databricks.com', 
-                                verify=True, command_name='Python Dev')
-        self.accounts_api_client = AccountsApi(dbcli_apiclient)
+    # A shared accounts API client and workspace watcher can be passed in, e.g. from DatabricksWSClientPool
+    # when provisioning many workspaces. Calls made through the accounts API client are counted on the tracer
+    # of the run.
+    def __init__(self, common_params, accounts_api_client=None, workspace_watcher=None, tracer=None):
+        if tracer is None:
+            tracer = DatabricksWSTracer(common_params.get("workspace_name"))
+        self.tracer = tracer
+        if accounts_api_client is None:
+            # databricks_cli takes a while to import, so it's only imported when a client has to be created
+            from databricks_cli.sdk import ApiClient
+            from databricks_cli.accounts.api import AccountsApi
+            dbcli_apiclient = ApiClient(common_params["api_user"], password=common_params["api_password"],
+                                    host='https://accounts.cloud.databricks.com', 
+                                    verify=True, command_name='Python Dev')
+            # Calls are rate limited, and retried on throttling and server errors
+            rate_limiter = DatabricksWSRateLimiter(common_params.get("accounts_api_rate_per_second", 5),
+                                common_params.get("accounts_api_burst", 10), common_params.get("rate_limit_dir"))
+            accounts_api_client = DatabricksWSAccountsTransport(AccountsApi(dbcli_apiclient), rate_limiter)
+        self.accounts_api_client = tracer._instrument_client(accounts_api_client, 'accounts')
+        if workspace_watcher is None:
+            workspace_watcher = DatabricksWSWorkspaceWatcher(self.accounts_api_client)
+        self.workspace_watcher = workspace_watcher
 
     # Create credentials object for a E2 workspace
+    @traced('create_credentials')
     def _create_credentials(self, common_params, other_input_data):
         print("Creating the Databricks workspace credentials")
         credentials_id = None
@@ -37,6 +95,7 @@ class DatabricksWSAccountsAPI(object):
         return credentials_id
 
     # Create storage config object for a E2 workspace
+    @traced('create_storage_config')
     def _create_storage_config(self, common_params, other_input_data):
         print("Creating the Databricks workspace storage config")
         storage_config_id = None
@@ -57,6 +116,7 @@ class DatabricksWSAccountsAPI(object):
         return storage_config_id
 
     # Create network object for a E2 workspace
+    @traced('create_network')
     def _create_network(self, common_params, other_input_data):
         print("Creating the Databricks workspace network")
         network_id = None
@@ -77,6 +137,7 @@ class DatabricksWSAccountsAPI(object):
         return network_id
 
     # Create customer managed key object for a E2 workspace
+    @traced('create_customer_managed_key')
     def _create_customer_managed_key(self, common_params, other_input_data):
         print("Creating the Databricks workspace customer managed key")
         customer_managed_key_id = None
@@ -97,7 +158,47 @@ class DatabricksWSAccountsAPI(object):
             exit(1)
         return customer_managed_key_id
 
+    # Submit the creation of a workspace object to an executor, as soon as its input data is available
+    # With a run journal, an object created by a previous run is reused and a newly created one is recorded
+    def _submit_workspace_object(self, executor, create_method, common_params, other_input_data,
+                                 id_key=None, run_journal=None):
+        if run_journal is not None:
+            workspace_object_id = run_journal._get("workspace_object", id_key)
+            if workspace_object_id is not None:
+                print("Reusing the workspace object {} created by a previous run for {}".format(workspace_object_id, id_key))
+                workspace_object_future = Future()
+                workspace_object_future.set_result(workspace_object_id)
+                return workspace_object_future
+
+        workspace_object_future = executor.submit(getattr(self, create_method), common_params, other_input_data)
+        if run_journal is not None:
+            def _record_workspace_object(done_future):
+                if done_future.exception() is None:
+                    run_journal._record("workspace_object", id_key, done_future.result())
+            workspace_object_future.add_done_callback(_record_workspace_object)
+        return workspace_object_future
+
+    # Wait for all submitted workspace objects and collect their ids as input data for the workspace
+    # Fails together if any of the objects was not created successfully
+    def _collect_workspace_objects(self, workspace_object_futures):
+        wait(workspace_object_futures.values())
+        workspace_input_data = {}
+        failed_id_keys = []
+        for id_key, workspace_object_future in workspace_object_futures.items():
+            workspace_object_ex = workspace_object_future.exception()
+            if workspace_object_ex is not None:
+                print("Creation of the workspace object for {} failed with {!r}".format(id_key, workspace_object_ex))
+                failed_id_keys.append(id_key)
+            else:
+                workspace_input_data[id_key] = workspace_object_future.result()
+
+        if failed_id_keys:
+            print("Exiting the script as workspace objects for {} were not created successfully".format(failed_id_keys))
+            exit(1)
+        return workspace_input_data
+
     # Create the E2 workspace using previously created object references
+    @traced('create_workspace')
     def _create_workspace(self, common_params, other_input_data):
         print("Creating the Databricks workspace")
         workspace_id = None
@@ -120,13 +221,169 @@ class DatabricksWSAccountsAPI(object):
             exit(1)
         return workspace_id
 
+    # Create a replacement for a workspace object whose stack outputs have changed
+    # Objects can't be changed in place, so a new one is created with a name suffixed by a timestamp
+    def _create_replacement_workspace_object(self, common_params, workspace_object, other_input_data):
+        replacement_params = dict(common_params)
+        replacement_params[workspace_object["name_param"]] = "{}-{}".format(
+            common_params[workspace_object["name_param"]], time.strftime('%Y%m%d%H%M%S'))
+        return getattr(self, workspace_object["create_method"])(replacement_params, other_input_data)
+
+    # Check if a call failed because the object it refers to doesn't exist
+    def _is_missing_object(self, ex):
+        return getattr(getattr(ex, 'response', None), 'status_code', None) == 404
+
+    # Find the workspace in the common params by its id if it's given, or else by its name. Returns None if it doesn't
+    # exist, and exits if it can't be looked up.
+    def _find_workspace(self, common_params):
+        account_id = common_params["databricks_workspace_account_id"]
+        if common_params.get("workspace_id") is not None:
+            try:
+                return self.accounts_api_client.get_workspace(account_id, common_params["workspace_id"])
+            except Exception as ex:
+                if self._is_missing_object(ex):
+                    return None
+                raise
+        # Without a listing, a workspace that wasn't found can't be told apart from one that doesn't exist
+        if not hasattr(self.accounts_api_client, 'list_workspaces'):
+            print("Exiting the script as workspace {} can't be looked up by name - set its workspace_id".format(
+                common_params["workspace_name"]))
+            exit(1)
+        for workspace in self.accounts_api_client.list_workspaces(account_id):
+            if workspace['workspace_name'] == common_params["workspace_name"]:
+                return workspace
+        return None
+
+    # Get the id of the workspace in the common params, looking it up by name if it's not given
+    def _get_workspace_id(self, common_params):
+        workspace_id = common_params.get("workspace_id")
+        if workspace_id is None:
+            workspace = self._find_workspace(common_params)
+            workspace_id = workspace['workspace_id'] if workspace is not None else None
+
+        if workspace_id is None:
+            print("Exiting the script as the id of workspace {} could not be found".format(common_params["workspace_name"]))
+            exit(1)
+        return workspace_id
+
+    # Point an existing E2 workspace at replacement workspace objects
+    # Returns the workspace id, or None if the client can't update workspaces and it has to be done manually
+    @traced('update_workspace')
+    def _update_workspace(self, common_params, workspace_id, other_input_data):
+        print("Updating the Databricks workspace {} with {}".format(workspace_id, other_input_data))
+        workspace_request = {}
+        for id_key, workspace_object_id in other_input_data.items():
+            workspace_request[WORKSPACE_REQUEST_KEYS.get(id_key, id_key)] = workspace_object_id
+        if not hasattr(self.accounts_api_client, 'update_workspace'):
+            print("The Accounts API client can't update workspaces - attach {} to workspace {} manually".format(
+                workspace_request, workspace_id))
+            return None
+        self.accounts_api_client.update_workspace(common_params["databricks_workspace_account_id"],
+                                                  workspace_id, workspace_request)
+        return workspace_id
+
+    # Get the ids of the workspace objects a workspace uses, keyed by the id keys of the workspace input data
+    def _get_workspace_object_ids(self, workspace):
+        workspace_object_ids = {}
+        for id_key in WORKSPACE_OBJECT_CALLS:
+            workspace_object_id = workspace.get(WORKSPACE_REQUEST_KEYS.get(id_key, id_key))
+            if workspace_object_id is not None:
+                workspace_object_ids[id_key] = workspace_object_id
+        return workspace_object_ids
+
+    # List the workspace objects of a kind in the account, or an empty list if the client can't list them
+    def _list_workspace_objects(self, common_params, id_key):
+        list_call = WORKSPACE_OBJECT_CALLS[id_key]["list_call"]
+        if not hasattr(self.accounts_api_client, list_call):
+            return []
+        return getattr(self.accounts_api_client, list_call)(common_params["databricks_workspace_account_id"]) or []
+
+    # Find the id of a workspace object by its name in the common params, or by a value of the stack output data it
+    # was created from. Returns None if it doesn't exist.
+    def _find_workspace_object_id(self, common_params, workspace_object, other_input_data=None):
+        object_calls = WORKSPACE_OBJECT_CALLS[workspace_object["id_key"]]
+        if "input_data_key" in object_calls:
+            object_name = (other_input_data or {}).get(object_calls["input_data_key"])
+        else:
+            object_name = common_params.get(workspace_object["name_param"])
+        if object_name is None:
+            return None
+        object_id_key = WORKSPACE_REQUEST_KEYS.get(workspace_object["id_key"], workspace_object["id_key"])
+        for account_object in self._list_workspace_objects(common_params, workspace_object["id_key"]):
+            if get_key_path_value(account_object, object_calls["name_key_path"]) == object_name:
+                return account_object[object_id_key]
+        return None
+
+    # Delete a workspace object, unless it's already gone
+    @traced('delete_workspace_object')
+    def _delete_workspace_object(self, common_params, id_key, workspace_object_id):
+        delete_call = WORKSPACE_OBJECT_CALLS[id_key]["delete_call"]
+        if not hasattr(self.accounts_api_client, delete_call):
+            print("The Accounts API client can't delete workspace objects - delete {} {} manually".format(id_key, workspace_object_id))
+            exit(1)
+        print("Deleting the Databricks workspace object {} for {}".format(workspace_object_id, id_key))
+        try:
+            getattr(self.accounts_api_client, delete_call)(common_params["databricks_workspace_account_id"], workspace_object_id)
+        except Exception as ex:
+            if not self._is_missing_object(ex):
+                raise
+            print("Skipping the workspace object {} for {} as it was already deleted".format(workspace_object_id, id_key))
+        return workspace_object_id
+
+    # Delete workspace objects concurrently, given their ids keyed by id key
+    # Fails together if any of the objects was not deleted successfully
+    def _delete_workspace_objects(self, common_params, workspace_object_ids):
+        if not workspace_object_ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(workspace_object_ids)) as executor:
+            workspace_object_futures = dict((id_key, executor.submit(self._delete_workspace_object, common_params,
+                                                                     id_key, workspace_object_id))
+                                            for id_key, workspace_object_id in workspace_object_ids.items())
+        failed_id_keys = []
+        for id_key, workspace_object_future in workspace_object_futures.items():
+            if workspace_object_future.exception() is not None:
+                print("Deletion of the workspace object for {} failed with {!r}".format(id_key, workspace_object_future.exception()))
+                failed_id_keys.append(id_key)
+
+        if failed_id_keys:
+            print("Exiting the script as workspace objects for {} were not deleted successfully".format(failed_id_keys))
+            exit(1)
+        return workspace_object_ids
+
+    # Delete a E2 workspace, and wait until it's gone - the workspace objects can't be deleted while it uses them
+    # Waits through the workspace watcher, until the deadline in the common params has passed
+    @traced('delete_workspace')
+    def _delete_workspace(self, common_params, workspace_id):
+        if not hasattr(self.accounts_api_client, 'delete_workspace'):
+            print("The Accounts API client can't delete workspaces - delete workspace {} manually".format(workspace_id))
+            exit(1)
+        print("Deleting the Databricks workspace {}".format(workspace_id))
+        account_id = common_params["databricks_workspace_account_id"]
+        try:
+            self.accounts_api_client.delete_workspace(account_id, workspace_id)
+        except Exception as ex:
+            if not self._is_missing_object(ex):
+                raise
+        workspace_delete_future = self.workspace_watcher._watch_workspace(account_id, workspace_id,
+                                      common_params.get("workspace_deadline_seconds", 1800), until_deleted=True)
+        workspace_prov_status = workspace_delete_future.result()["workspace_status"]
+        if workspace_prov_status is not None:
+            print("Exiting the script as workspace {} was not deleted in time, it's {}".format(workspace_id, workspace_prov_status))
+            exit(1)
+        print("Deleted the Databricks workspace {}".format(workspace_id))
+        return workspace_id
+
     # Check if the workspace has been provisioned successfully
+    # Waits until it's no longer provisioning, or until the deadline in the common params has passed, and records the
+    # time the workspace took to get to RUNNING in the trace
+    @traced('wait_workspace')
     def _check_workspace_provisioning(self, common_params, other_input_data):
-        workspace_prov_status = 'PROVISIONING'
-        while workspace_prov_status == 'PROVISIONING':
-            time.sleep(5)
-            workspace_prov_resp = self.accounts_api_client.get_workspace(
-                                        common_params["databricks_workspace_account_id"], other_input_data["workspace_id"])
-            workspace_prov_status = workspace_prov_resp['workspace_status']
-        return workspace_prov_status
+        workspace_prov_future = self.workspace_watcher._watch_workspace(
+                                    common_params["databricks_workspace_account_id"], other_input_data["workspace_id"],
+                                    common_params.get("workspace_deadline_seconds", 1800))
+        workspace_watch = workspace_prov_future.result()
+        if workspace_watch["workspace_status"] == 'RUNNING':
+            self.tracer._record_milestone('workspace_running', workspace_watch["elapsed_seconds"])
+        return workspace_watch["workspace_status"]
+
         
\ No newline at end of file
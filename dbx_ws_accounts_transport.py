@@ -0,0 +1,204 @@
+# Interface for a rate limited transport under the Databricks E2 Accounts API client
+# Every call takes a token from a bucket shared by all calls to the same account, optionally across processes through
+# a locked state file. Calls are retried on throttling (429), server errors (5xx) and connection errors, with backoff.
+# Gets, lists, updates and deletes can simply be repeated. After a server or connection error a create may have
+# gone through anyway, so the object is looked up by name first and reused if it exists.
+
+import os
+import random
+import threading
+import time
+
+from json import dumps as json_dumps, loads as json_loads
+
+from dbx_ws_tracer import count_retry
+
+# Status codes of failed calls that are worth retrying
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# For each create call, the list call and the request key path used to find an object created by an earlier try
+CREATE_LOOKUPS = {
+    "create_credentials": ("list_credentials", ("credentials_name",)),
+    "create_storage_config": ("list_storage_config", ("storage_configuration_name",)),
+    "create_network": ("list_network", ("network_name",)),
+    "create_customer_managed_key": ("list_customer_managed_keys", ("aws_key_info", "key_arn")),
+    "create_workspace": ("list_workspaces", ("workspace_name",))
+}
+
+class DatabricksWSRateLimiter(object):
+
+    # With a state_dir, the bucket of each account is kept in a file there, so that all processes using the same
+    # directory share the budget of an account. Otherwise the buckets are only shared within this process.
+    def __init__(self, rate_per_second=5, burst=10, state_dir=None):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.state_dir = state_dir
+        self.token_buckets = {}
+        self.limiter_lock = threading.Lock()
+        if state_dir is not None:
+            os.makedirs(state_dir, exist_ok=True)
+
+    # Refill a bucket for the time passed, and take a token from it if there is one.
+    # Returns the seconds to wait for the next token, or 0 if a token was taken.
+    def _take_token(self, token_bucket):
+        now = time.time()
+        tokens = min(self.burst, token_bucket["tokens"] + (now - token_bucket["updated_at"]) * self.rate_per_second)
+        token_bucket["updated_at"] = now
+        if tokens >= 1:
+            token_bucket["tokens"] = tokens - 1
+            return 0
+        token_bucket["tokens"] = tokens
+        return (1 - tokens) / self.rate_per_second
+
+    # Take a token from the bucket of an account kept in a state file, under an exclusive lock on the file
+    def _take_shared_token(self, account_id):
+        import fcntl
+        bucket_path = os.path.join(self.state_dir, '{}.json'.format(account_id))
+        with open(bucket_path, 'a+') as bucket_fileobj:
+            fcntl.flock(bucket_fileobj, fcntl.LOCK_EX)
+            try:
+                bucket_fileobj.seek(0)
+                try:
+                    token_bucket = json_loads(bucket_fileobj.read())
+                except ValueError:
+                    token_bucket = {"tokens": self.burst, "updated_at": time.time()}
+                wait_seconds = self._take_token(token_bucket)
+                bucket_fileobj.seek(0)
+                bucket_fileobj.truncate()
+                bucket_fileobj.write(json_dumps(token_bucket))
+                bucket_fileobj.flush()
+            finally:
+                fcntl.flock(bucket_fileobj, fcntl.LOCK_UN)
+        return wait_seconds
+
+    # Wait until a token of the account's bucket is available and take it. Returns the seconds waited.
+    def _acquire(self, account_id):
+        waited_seconds = 0
+        while True:
+            with self.limiter_lock:
+                if self.state_dir is not None:
+                    wait_seconds = self._take_shared_token(account_id)
+                else:
+                    token_bucket = self.token_buckets.setdefault(account_id, {"tokens": self.burst, "updated_at": time.time()})
+                    wait_seconds = self._take_token(token_bucket)
+            if wait_seconds <= 0:
+                return waited_seconds
+            time.sleep(wait_seconds)
+            waited_seconds += wait_seconds
+
+class DatabricksWSAccountsTransport(object):
+
+    # accounts_api_client is the AccountsApi client to make the calls with. Calls that fail with other errors
+    # than the retryable ones, or still fail after max_retries retries, raise the last error.
+    def __init__(self, accounts_api_client, rate_limiter=None, max_retries=5, min_backoff=1, max_backoff=30,
+                 pool_maxsize=20):
+        self.accounts_api_client = accounts_api_client
+        if rate_limiter is None:
+            rate_limiter = DatabricksWSRateLimiter()
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.transport_counters = {"calls": 0, "throttles": 0, "server_errors": 0, "retries": 0,
+                                   "deduplicated_creates": 0, "rate_limited_seconds": 0.0}
+        self.transport_lock = threading.Lock()
+        self._mount_connection_pool(pool_maxsize)
+
+    # Size the keep-alive connection pool of the underlying requests session for the concurrent calls, and leave
+    # the retries to the transport so that they are rate limited and counted
+    def _mount_connection_pool(self, pool_maxsize):
+        api_session = getattr(getattr(self.accounts_api_client, 'client', None), 'session', None)
+        if api_session is None:
+            return
+        from requests.adapters import HTTPAdapter
+        api_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0))
+
+    def _count(self, counter_name, count=1):
+        with self.transport_lock:
+            self.transport_counters[counter_name] += count
+
+    # Get the counters of calls, throttles, server errors, retries, deduplicated creates and time spent rate limited
+    def _get_counters(self):
+        with self.transport_lock:
+            return dict(self.transport_counters)
+
+    # Get the status code of a failed call, or None if it failed before getting a response
+    def _get_status_code(self, ex):
+        return getattr(getattr(ex, 'response', None), 'status_code', None)
+
+    # Check if a failed call can be retried - requests errors without a response are connection errors or timeouts
+    def _is_retryable(self, ex):
+        status_code = self._get_status_code(ex)
+        if status_code is None:
+            return isinstance(ex, OSError)
+        return status_code in RETRYABLE_STATUS_CODES
+
+    # Get the delay before a retry - the server's Retry-After if it sent one, else a jittered exponential backoff
+    def _get_backoff(self, ex, retry_count):
+        retry_after = getattr(getattr(ex, 'response', None), 'headers', None) or {}
+        try:
+            return min(float(retry_after.get('Retry-After')), self.max_backoff)
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_backoff, self.min_backoff * 2 ** retry_count))
+
+    # Find an object that an earlier try of a create call made, by the name in its request, or None
+    def _find_created_object(self, call_name, account_id, object_request):
+        list_call_name, name_key_path = CREATE_LOOKUPS[call_name]
+        if not hasattr(self.accounts_api_client, list_call_name):
+            return None
+        object_name = object_request
+        for name_key in name_key_path:
+            object_name = object_name.get(name_key) if isinstance(object_name, dict) else None
+        if object_name is None:
+            return None
+        self._count("calls")
+        self.rate_limiter._acquire(account_id)
+        for account_object in getattr(self.accounts_api_client, list_call_name)(account_id) or []:
+            existing_name = account_object
+            for name_key in name_key_path:
+                existing_name = existing_name.get(name_key) if isinstance(existing_name, dict) else None
+            if existing_name == object_name:
+                return account_object
+        return None
+
+    # Make a call with rate limiting and retries. The first argument of every Accounts API call is the account id.
+    def _call(self, call_name, *args, **kwargs):
+        account_id = args[0] if args else kwargs.get('account_id')
+        retry_count = 0
+        while True:
+            self._count("rate_limited_seconds", self.rate_limiter._acquire(account_id))
+            self._count("calls")
+            try:
+                return getattr(self.accounts_api_client, call_name)(*args, **kwargs)
+            except Exception as ex:
+                status_code = self._get_status_code(ex)
+                if status_code == 429:
+                    self._count("throttles")
+                elif status_code is not None and status_code >= 500:
+                    self._count("server_errors")
+                if not self._is_retryable(ex) or retry_count >= self.max_retries:
+                    raise
+                retry_ex = ex
+
+            # A throttled create was rejected, but after a server or connection error it may have been made
+            if call_name in CREATE_LOOKUPS and self._get_status_code(retry_ex) != 429 and len(args) > 1:
+                try:
+                    account_object = self._find_created_object(call_name, account_id, args[1])
+                except Exception:
+                    account_object = None
+                if account_object is not None:
+                    print("Reusing the object from an earlier try of {} after {!r}".format(call_name, retry_ex))
+                    self._count("deduplicated_creates")
+                    return account_object
+
+            retry_count += 1
+            self._count("retries")
+            # The tracer of the run only sees the outcome of the call, so the retries within it are reported separately
+            count_retry(self._get_status_code(retry_ex) == 429)
+            time.sleep(self._get_backoff(retry_ex, retry_count))
+
+    # Make every call of the Accounts API client through the transport
+    def __getattr__(self, attribute_name):
+        attribute = getattr(self.accounts_api_client, attribute_name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self._call(attribute_name, *args, **kwargs)
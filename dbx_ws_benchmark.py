@@ -0,0 +1,235 @@
+# Benchmark of end-to-end provisioning throughput, run offline against the stand-ins from dbx_ws_fakes.py
+# Provisions fleets of workspaces with time-scaled latencies, and reports the wall time, the critical path time,
+# the API call counts and the peak memory of each run. All times are reported in unscaled (modeled) seconds.
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from json import dumps as json_dumps, loads as json_loads
+
+from dbx_ws_accounts_transport import DatabricksWSAccountsTransport, DatabricksWSRateLimiter
+from dbx_ws_fakes import DatabricksWSFakeCloudFormationClient, DatabricksWSFakeAccountsApi, DatabricksWSFakeS3Client
+from dbx_ws_fakes import lognormal_latency
+from dbx_ws_fleet_provisioner import DatabricksWSFleetProvisioner
+from dbx_ws_resource_pool import DatabricksWSResourcePool
+from dbx_ws_stack_index import DatabricksWSStackIndex
+from dbx_ws_stack_poller import DatabricksWSStackPoller
+from dbx_ws_stack_scheduler import DatabricksWSStackScheduler
+from dbx_ws_template_cache import DatabricksWSTemplateCache
+from dbx_ws_template_stager import DatabricksWSTemplateStager
+from dbx_ws_workspace_watcher import DatabricksWSWorkspaceWatcher
+
+# Client pool handing out the fakes, with poll delays, backoffs and rate limits scaled like the fake latencies
+class DatabricksWSBenchmarkClientPool(object):
+
+    def __init__(self, cf_client, accounts_api_client, template_cache, time_scale, accounts_api_rate_per_second=5,
+                 accounts_api_burst=10, template_stager=None):
+        self.cf_client = cf_client
+        self.template_stager = template_stager
+        self.accounts_api_client = DatabricksWSAccountsTransport(accounts_api_client,
+                                       DatabricksWSRateLimiter(accounts_api_rate_per_second / time_scale, accounts_api_burst),
+                                       min_backoff=1 * time_scale, max_backoff=30 * time_scale)
+        self.template_cache = template_cache
+        self.stack_index = DatabricksWSStackIndex(cf_client, ttl_seconds=60 * time_scale)
+        self.stack_poller = DatabricksWSStackPoller(cf_client, self.stack_index, min_delay=2 * time_scale,
+                                max_delay=30 * time_scale, stream_events=False)
+        self.workspace_watcher = DatabricksWSWorkspaceWatcher(self.accounts_api_client, min_delay=5 * time_scale,
+                                    max_delay=60 * time_scale, expected_seconds=300 * time_scale)
+
+    def _get_cf_client(self, region_name):
+        return self.cf_client
+
+    def _get_stack_index(self, region_name):
+        return self.stack_index
+
+    def _get_stack_poller(self, region_name):
+        return self.stack_poller
+
+    def _get_template_stager(self, common_params):
+        return self.template_stager
+
+    def _get_accounts_api_client(self, common_params):
+        return self.accounts_api_client
+
+    def _get_workspace_watcher(self, common_params):
+        return self.workspace_watcher
+
+class DatabricksWSBenchmark(object):
+
+    # With stage_templates, templates are staged in a fake S3 bucket and stacks are created from their URL.
+    # With a resource_pool_size, a resource pool of that size is filled before the fleet is provisioned from it.
+    def __init__(self, defaults, step_graph='./stack_graph.json', time_scale=0.01, max_workspaces=100,
+                 stack_failure_rate=0, call_failure_rate=0, stage_templates=False, resource_pool_size=0):
+        self.defaults = defaults
+        self.step_graph = step_graph
+        self.time_scale = time_scale
+        self.max_workspaces = max_workspaces
+        self.stack_failure_rate = stack_failure_rate
+        self.call_failure_rate = call_failure_rate
+        self.stage_templates = stage_templates
+        self.resource_pool_size = resource_pool_size
+
+    # Build the fakes, with stack durations taken from the expected durations in the step graph
+    def _build_fakes(self, steps):
+        call_latency = lambda: lognormal_latency(0.2)() * self.time_scale
+        stack_latencies = {self.defaults[step["stack_name_param"]]: lognormal_latency(step.get("expected_seconds", 60))
+                           for step in steps}
+        call_failure_rates = {call_name: self.call_failure_rate for call_name in
+                              ('create_credentials', 'create_storage_config', 'create_network',
+                               'create_customer_managed_key', 'create_workspace', 'get_workspace')}
+        s3_client = DatabricksWSFakeS3Client(default_call_latency=call_latency)
+        cf_client = DatabricksWSFakeCloudFormationClient(stack_latencies=stack_latencies,
+                        stack_failure_rate=self.stack_failure_rate, time_scale=self.time_scale, s3_client=s3_client,
+                        default_call_latency=call_latency)
+        accounts_api_client = DatabricksWSFakeAccountsApi(time_scale=self.time_scale, default_call_latency=call_latency,
+                                call_failure_rates=call_failure_rates)
+        return cf_client, accounts_api_client, s3_client
+
+    # Write a copy of the step graph with time-scaled expected durations, for the stack poller
+    def _write_scaled_step_graph(self, steps, work_dir):
+        scaled_steps = [dict(step, expected_seconds=step.get("expected_seconds", 60) * self.time_scale) for step in steps]
+        scaled_step_graph = os.path.join(work_dir, 'stack_graph.json')
+        with open(scaled_step_graph, 'w') as step_graph_fileobj:
+            step_graph_fileobj.write(json_dumps(scaled_steps))
+        return scaled_step_graph
+
+    # Get the manifest rows for a fleet of workspaces with unique names
+    def _get_manifest_rows(self, workspace_count):
+        manifest_rows = []
+        for workspace_index in range(workspace_count):
+            workspace_key = 'bench{:05d}'.format(workspace_index)
+            manifest_row = {"workspace_key": workspace_key}
+            for param_key in ("vpc_stack_name", "iam_stack_name", "s3_stack_name", "kms_stack_name", "credentials_name",
+                              "storage_config_name", "network_name", "customer_managed_key_name", "workspace_name",
+                              "deployment_cname"):
+                manifest_row[param_key] = '{}-{}'.format(self.defaults[param_key], workspace_key)
+            manifest_rows.append(manifest_row)
+        return manifest_rows
+
+    # Get the modeled critical path of one workspace - the longest chain of stacks in the step graph,
+    # followed by the workspace provisioning. Accounts API call latencies are left out.
+    def _get_critical_path_seconds(self, steps, manifest_row, cf_client, accounts_api_client):
+        ws_stack_scheduler = DatabricksWSStackScheduler(None)
+        steps_by_name = dict((step["step_name"], step) for step in steps)
+        stack_finish_seconds = {}
+
+        def _get_stack_finish_seconds(step_name):
+            if step_name not in stack_finish_seconds:
+                step = steps_by_name[step_name]
+                stack_durations = cf_client.stack_durations.get(manifest_row[step["stack_name_param"]], {})
+                dependency_seconds = [_get_stack_finish_seconds(dependency)
+                                      for dependency in ws_stack_scheduler._get_dependencies(step)]
+                stack_finish_seconds[step_name] = max(dependency_seconds + [0]) + stack_durations.get('CREATE', 0)
+            return stack_finish_seconds[step_name]
+
+        stacks_seconds = max(_get_stack_finish_seconds(step_name) for step_name in steps_by_name)
+        return stacks_seconds + accounts_api_client.workspace_durations.get(manifest_row["workspace_name"], 0)
+
+    # Provision a fleet of the given size against fresh fakes, and measure it
+    def _run(self, workspace_count):
+        steps = DatabricksWSStackScheduler(None)._parse_step_graph(self.step_graph)
+        cf_client, accounts_api_client, s3_client = self._build_fakes(steps)
+        template_stager = None
+        if self.stage_templates:
+            template_stager = DatabricksWSTemplateStager(s3_client, 'dbx-ws-benchmark-templates',
+                                                         region_name=self.defaults["region_name"])
+        work_dir = tempfile.mkdtemp(prefix='dbx_ws_benchmark_')
+        try:
+            defaults = dict(self.defaults, run_journal_dir=os.path.join(work_dir, 'run_journal'),
+                            trace_dir=os.path.join(work_dir, 'traces'))
+            client_pool = DatabricksWSBenchmarkClientPool(cf_client, accounts_api_client,
+                              DatabricksWSTemplateCache(os.path.join(work_dir, 'template_cache')), self.time_scale,
+                              self.defaults.get("accounts_api_rate_per_second", 5), self.defaults.get("accounts_api_burst", 10),
+                              template_stager)
+            scaled_step_graph = self._write_scaled_step_graph(steps, work_dir)
+            manifest_rows = self._get_manifest_rows(workspace_count)
+
+            # The pipelines print a lot, which would swamp the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                resource_pool = None
+                pool_fill_seconds = None
+                if self.resource_pool_size > 0:
+                    resource_pool = DatabricksWSResourcePool(defaults, client_pool, self.resource_pool_size,
+                                        max_parallel_refills=self.resource_pool_size, step_graph=scaled_step_graph,
+                                        state_path=os.path.join(work_dir, 'resource_pool.json'),
+                                        min_retry_delay=30 * self.time_scale, max_retry_delay=600 * self.time_scale)
+                    fill_start_time = time.time()
+                    resource_pool._start()
+                    resource_pool._wait_until_ready(self.resource_pool_size, 3600 * self.time_scale)
+                    pool_fill_seconds = (time.time() - fill_start_time) / self.time_scale
+                ws_fleet_provisioner = DatabricksWSFleetProvisioner(defaults, client_pool, self.max_workspaces,
+                                           self.max_workspaces, scaled_step_graph, resource_pool=resource_pool)
+
+                tracemalloc.start()
+                start_time = time.time()
+                fleet_results = ws_fleet_provisioner._provision_fleet(manifest_rows)
+                wall_seconds = (time.time() - start_time) / self.time_scale
+                peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                if resource_pool is not None:
+                    resource_pool._stop(wait=True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        critical_path_seconds = [self._get_critical_path_seconds(steps, manifest_row, cf_client, accounts_api_client)
+                                 for manifest_row in manifest_rows]
+        # With the concurrency cap, the fleet can't finish before its total critical path is spread over the cap
+        lower_bound_seconds = max(max(critical_path_seconds), sum(critical_path_seconds) / self.max_workspaces)
+        return {
+            "workspaces": workspace_count,
+            "succeeded": len([fleet_result for fleet_result in fleet_results if fleet_result["workspace_status"] == 'RUNNING']),
+            "wall_seconds": round(wall_seconds, 1),
+            "critical_path_seconds": round(max(critical_path_seconds), 1),
+            "lower_bound_seconds": round(lower_bound_seconds, 1),
+            "overhead_ratio": round(wall_seconds / lower_bound_seconds, 3),
+            "cloudformation_calls": dict(cf_client.call_counts),
+            "cloudformation_template_bytes": cf_client.template_request_bytes,
+            "s3_calls": dict(s3_client.call_counts),
+            "accounts_api_calls": dict(accounts_api_client.call_counts),
+            "accounts_api_transport": self._get_modeled_summary(client_pool.accounts_api_client._get_counters()),
+            "total_calls": cf_client._get_total_calls() + accounts_api_client._get_total_calls() + s3_client._get_total_calls(),
+            "peak_memory_mb": round(peak_memory_bytes / (1024 * 1024), 1),
+            "fleet_summary": self._get_modeled_summary(ws_fleet_provisioner._summarize_fleet(fleet_results)),
+            "pool_fill_seconds": round(pool_fill_seconds, 1) if pool_fill_seconds is not None else None,
+            "resource_pool": self._get_modeled_summary(resource_pool._get_metrics()) if resource_pool is not None else None
+        }
+
+    # Convert the times in a summary to modeled seconds
+    def _get_modeled_summary(self, summary):
+        return dict((summary_key, round(summary_value / self.time_scale, 1) if summary_key.endswith('_seconds') else summary_value)
+                    for summary_key, summary_value in summary.items())
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark workspace provisioning against in-process fakes')
+    arg_parser.add_argument('--workspaces', default='1,10,100,1000', help='Comma separated fleet sizes to run')
+    arg_parser.add_argument('--defaults', default='./common_params.json', help='Shared default master parameters')
+    arg_parser.add_argument('--step-graph', default='./stack_graph.json', help='Step graph of the stacks to deploy')
+    arg_parser.add_argument('--time-scale', type=float, default=0.01, help='Real seconds per modeled second')
+    arg_parser.add_argument('--max-workspaces', type=int, default=100, help='Max workspaces provisioned at once')
+    arg_parser.add_argument('--stack-failure-rate', type=float, default=0, help='Probability of a stack failing')
+    arg_parser.add_argument('--call-failure-rate', type=float, default=0, help='Probability of an Accounts API call failing')
+    arg_parser.add_argument('--stage-templates', action='store_true',
+                            help='Stage the templates in a fake S3 bucket and create the stacks from their URL')
+    arg_parser.add_argument('--resource-pool-size', type=int, default=0,
+                            help='Fill a resource pool of this size first, and provision the fleet from it')
+    arg_parser.add_argument('--results', default='./bench_output.txt', help='File to write the JSON lines report to')
+    args = arg_parser.parse_args()
+
+    with open(args.defaults) as parameter_fileobj:
+        parameter_str = parameter_fileobj.read()
+    defaults = json_loads(parameter_str)
+
+    ws_benchmark = DatabricksWSBenchmark(defaults, args.step_graph, args.time_scale, args.max_workspaces,
+                                         args.stack_failure_rate, args.call_failure_rate, args.stage_templates,
+                                         args.resource_pool_size)
+    with open(args.results, 'w') as results_fileobj:
+        for workspace_count in [int(workspace_count) for workspace_count in args.workspaces.split(',')]:
+            benchmark_result = ws_benchmark._run(workspace_count)
+            print(json_dumps(benchmark_result))
+            results_fileobj.write(json_dumps(benchmark_result) + '\n')
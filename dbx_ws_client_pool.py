@@ -0,0 +1,110 @@
+# Interface for sharing AWS and Databricks Accounts API clients across many workspace provisioning pipelines
+# One boto3 session with a cloudformation client, stack index and stack poller per region, and one Accounts API client
+# and workspace watcher per API user
+
+import threading
+
+from dbx_ws_accounts_transport import DatabricksWSAccountsTransport, DatabricksWSRateLimiter
+from dbx_ws_stack_index import DatabricksWSStackIndex
+from dbx_ws_stack_poller import DatabricksWSStackPoller
+from dbx_ws_template_cache import DatabricksWSTemplateCache
+from dbx_ws_template_stager import DatabricksWSTemplateStager
+from dbx_ws_workspace_watcher import DatabricksWSWorkspaceWatcher
+
+class DatabricksWSClientPool(object):
+
+    # max_pool_connections should be at least the number of pipelines that can run at once in a region
+    # Accounts API calls of all API users are rate limited per account, across processes with a rate_limit_dir
+    def __init__(self, profile_name='databricks-field-eng-admin', max_pool_connections=10,
+                 accounts_api_rate_per_second=5, accounts_api_burst=10, rate_limit_dir=None):
+        # boto3 takes a while to import, so it's only imported once a pool is created
+        import boto3
+        from botocore.config import Config
+        self.session = boto3.Session(profile_name=profile_name)
+        self.boto_config = Config(max_pool_connections=max_pool_connections)
+        self.cf_clients = {}
+        self.stack_indexes = {}
+        self.stack_pollers = {}
+        # Template validations don't depend on the region, so one cache serves all workspaces
+        self.template_cache = DatabricksWSTemplateCache()
+        self.s3_clients = {}
+        self.template_stagers = {}
+        self.max_pool_connections = max_pool_connections
+        self.rate_limiter = DatabricksWSRateLimiter(accounts_api_rate_per_second, accounts_api_burst, rate_limit_dir)
+        self.accounts_api_clients = {}
+        self.workspace_watchers = {}
+        # boto3 sessions are not thread safe, so clients are created under a lock
+        self.client_lock = threading.Lock()
+
+    # Get the shared cloudformation client for a region
+    def _get_cf_client(self, region_name):
+        with self.client_lock:
+            if region_name not in self.cf_clients:
+                self.cf_clients[region_name] = self.session.client(service_name='cloudformation',
+                                                    region_name=region_name, config=self.boto_config)
+            return self.cf_clients[region_name]
+
+    # Get the shared stack index for a region, so that all workspaces of a region use one stack listing
+    def _get_stack_index(self, region_name):
+        cf_client = self._get_cf_client(region_name)
+        with self.client_lock:
+            if region_name not in self.stack_indexes:
+                self.stack_indexes[region_name] = DatabricksWSStackIndex(cf_client)
+            return self.stack_indexes[region_name]
+
+    # Get the shared stack poller for a region, so that all in-flight stacks of a region are checked together
+    def _get_stack_poller(self, region_name):
+        stack_index = self._get_stack_index(region_name)
+        with self.client_lock:
+            if region_name not in self.stack_pollers:
+                self.stack_pollers[region_name] = DatabricksWSStackPoller(self.cf_clients[region_name], stack_index)
+            return self.stack_pollers[region_name]
+
+    # Get the shared template stager for the staging bucket in the common params, so that each template is staged
+    # once for all workspaces. Returns None if templates are not staged.
+    def _get_template_stager(self, common_params):
+        bucket_name = common_params.get("template_staging_bucket")
+        if not bucket_name:
+            return None
+        key_prefix = common_params.get("template_staging_prefix", 'dbx-ws-templates/')
+        with self.client_lock:
+            if (bucket_name, key_prefix) not in self.template_stagers:
+                region_name = common_params.get("template_staging_region", common_params["region_name"])
+                if region_name not in self.s3_clients:
+                    self.s3_clients[region_name] = self.session.client(service_name='s3', region_name=region_name,
+                                                        config=self.boto_config)
+                self.template_stagers[(bucket_name, key_prefix)] = DatabricksWSTemplateStager(
+                    self.s3_clients[region_name], bucket_name, key_prefix, region_name)
+            return self.template_stagers[(bucket_name, key_prefix)]
+
+    # Get the shared Accounts API client for the API user in the common params
+    def _get_accounts_api_client(self, common_params):
+        with self.client_lock:
+            if common_params["api_user"] not in self.accounts_api_clients:
+                from databricks_cli.sdk import ApiClient
+                from databricks_cli.accounts.api import AccountsApi
+                dbcli_apiclient = ApiClient(common_params["api_user"], password=common_params["api_password"],
+                                        host='https://accounts.cloud.databricks.com',
+                                        verify=True, command_name='Python Dev')
+                self.accounts_api_clients[common_params["api_user"]] = DatabricksWSAccountsTransport(
+                    AccountsApi(dbcli_apiclient), self.rate_limiter, pool_maxsize=self.max_pool_connections)
+            return self.accounts_api_clients[common_params["api_user"]]
+
+    # Get the summed counters of the Accounts API transports - calls, throttles, retries and so on
+    def _get_accounts_api_counters(self):
+        accounts_api_counters = {}
+        with self.client_lock:
+            accounts_api_clients = list(self.accounts_api_clients.values())
+        for accounts_api_client in accounts_api_clients:
+            for counter_name, counter_value in accounts_api_client._get_counters().items():
+                accounts_api_counters[counter_name] = accounts_api_counters.get(counter_name, 0) + counter_value
+        return accounts_api_counters
+
+    # Get the shared workspace watcher for the API user in the common params, so that all workspaces
+    # being provisioned are checked together
+    def _get_workspace_watcher(self, common_params):
+        accounts_api_client = self._get_accounts_api_client(common_params)
+        with self.client_lock:
+            if common_params["api_user"] not in self.workspace_watchers:
+                self.workspace_watchers[common_params["api_user"]] = DatabricksWSWorkspaceWatcher(accounts_api_client)
+            return self.workspace_watchers[common_params["api_user"]]
@@ -0,0 +1,475 @@
+# In-process stand-ins for the AWS cloudformation and S3 clients and the Databricks E2 Accounts API
+# Used to run and benchmark provisioning offline. Latency of every call and of stack creation and workspace
+# provisioning, and the failure rates of calls, stacks and workspaces, are configurable.
+
+import io
+import random
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+from json import loads as json_loads
+from urllib.parse import urlparse
+
+import botocore.exceptions
+import requests
+
+# Get a latency function that samples a log-normal distribution around the given median, in seconds
+def lognormal_latency(median_seconds, sigma=0.3):
+    return lambda: median_seconds * random.lognormvariate(0, sigma)
+
+# Base for the fakes - keeps call counts, and applies the latency and failure rate configured for each call
+class DatabricksWSFakeService(object):
+
+    # Error code and message of the botocore ClientError raised for a failed call
+    failure_error = ('Throttling', 'Rate exceeded')
+
+    def __init__(self, call_latencies=None, call_failure_rates=None, default_call_latency=None):
+        self.call_latencies = call_latencies or {}
+        self.call_failure_rates = call_failure_rates or {}
+        self.default_call_latency = default_call_latency or lognormal_latency(0.05)
+        self.call_counts = {}
+        self.service_lock = threading.Lock()
+
+    # Count a call, sleep for its latency and raise its configured failure
+    def _call(self, call_name):
+        with self.service_lock:
+            self.call_counts[call_name] = self.call_counts.get(call_name, 0) + 1
+        time.sleep(self.call_latencies.get(call_name, self.default_call_latency)())
+        if random.random() < self.call_failure_rates.get(call_name, 0):
+            self._raise_failure(call_name)
+
+    def _raise_failure(self, call_name):
+        raise botocore.exceptions.ClientError({'Error': {'Code': self.failure_error[0], 'Message': self.failure_error[1]}},
+                                              call_name)
+
+    # Get the total number of calls made
+    def _get_total_calls(self):
+        with self.service_lock:
+            return sum(self.call_counts.values())
+
+# Paginator over a fake list call, which counts and delays every page like a call of its own
+class DatabricksWSFakePaginator(object):
+
+    def __init__(self, fake_service, call_name, list_items, result_key, page_size):
+        self.fake_service = fake_service
+        self.call_name = call_name
+        self.list_items = list_items
+        self.result_key = result_key
+        self.page_size = page_size
+
+    def paginate(self, **kwargs):
+        page_items = self.list_items(**kwargs)
+        for page_start in range(0, max(len(page_items), 1), self.page_size):
+            self.fake_service._call(self.call_name)
+            yield {self.result_key: page_items[page_start:page_start + self.page_size]}
+
+# Waiter over a fake stack or change set, polling it like the boto waiters do
+class DatabricksWSFakeWaiter(object):
+
+    def __init__(self, get_status, success_status, time_scale):
+        self.get_status = get_status
+        self.success_status = success_status
+        self.time_scale = time_scale
+
+    def wait(self, WaiterConfig=None, **kwargs):
+        waiter_config = WaiterConfig or {}
+        for _ in range(waiter_config.get('MaxAttempts', 120)):
+            status = self.get_status(**kwargs)
+            if status == self.success_status:
+                return
+            if status.endswith('FAILED') or status.endswith('ROLLBACK_COMPLETE'):
+                break
+            time.sleep(waiter_config.get('Delay', 5) * self.time_scale)
+        raise botocore.exceptions.WaiterError(name='fake', reason='Status is {}'.format(status), last_response={})
+
+# Stand-in for the AWS S3 client, for the object calls used to stage templates
+class DatabricksWSFakeS3Client(DatabricksWSFakeService):
+
+    failure_error = ('SlowDown', 'Please reduce your request rate')
+
+    def __init__(self, **kwargs):
+        super(DatabricksWSFakeS3Client, self).__init__(**kwargs)
+        self.s3_objects = {}
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object')
+        with self.service_lock:
+            s3_object = self.s3_objects.get((Bucket, Key))
+        if s3_object is None:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'head_object')
+        return {'ContentLength': len(s3_object)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('put_object')
+        with self.service_lock:
+            self.s3_objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self._call('get_object')
+        with self.service_lock:
+            s3_object = self.s3_objects.get((Bucket, Key))
+        if s3_object is None:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, 'get_object')
+        return {'Body': io.BytesIO(s3_object), 'ContentLength': len(s3_object)}
+
+    # Read the object at a virtual-hosted style S3 URL, as cloudformation does for a TemplateURL
+    def _read_url(self, object_url):
+        parsed_url = urlparse(object_url)
+        bucket_name = parsed_url.netloc.split('.s3.')[0]
+        with self.service_lock:
+            s3_object = self.s3_objects.get((bucket_name, parsed_url.path.lstrip('/')))
+        if s3_object is None:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ValidationError',
+                        'Message': 'TemplateURL must reference a valid S3 object'}}, 'read_url')
+        return s3_object.decode('utf-8')
+
+# Stand-in for the boto3 cloudformation client, for the calls used by the provisioning scripts
+class DatabricksWSFakeCloudFormationClient(DatabricksWSFakeService):
+
+    # stack_latencies maps a substring of the stack name to a latency function for creating or updating the stack
+    # An S3 fake is needed to create stacks from a TemplateURL
+    def __init__(self, stack_latencies=None, default_stack_latency=None, stack_failure_rate=0, page_size=100,
+                 time_scale=1.0, s3_client=None, **kwargs):
+        super(DatabricksWSFakeCloudFormationClient, self).__init__(**kwargs)
+        self.s3_client = s3_client
+        # Bytes of template bodies and URLs sent in requests, to compare inline and staged templates
+        self.template_request_bytes = 0
+        self.stack_latencies = stack_latencies or {}
+        self.default_stack_latency = default_stack_latency or lognormal_latency(60)
+        self.stack_failure_rate = stack_failure_rate
+        self.page_size = page_size
+        self.time_scale = time_scale
+        self.stacks = {}
+        self.change_sets = {}
+        # Sampled duration of every stack operation, for critical path calculations
+        self.stack_durations = {}
+
+    def _raise_missing_stack(self, stack_name, call_name):
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'ValidationError',
+                    'Message': 'Stack with id {} does not exist'.format(stack_name)}}, call_name)
+
+    def _get_stack_latency(self, stack_name):
+        for name_part, stack_latency in self.stack_latencies.items():
+            if name_part in stack_name:
+                return stack_latency
+        return self.default_stack_latency
+
+    # Start a create, update or delete operation on a stack, which completes after its sampled duration
+    def _start_stack_operation(self, fake_stack, operation):
+        duration = self._get_stack_latency(fake_stack["StackName"])()
+        self.stack_durations.setdefault(fake_stack["StackName"], {})[operation] = duration
+        fake_stack["operation"] = operation
+        fake_stack["started_at"] = time.time()
+        fake_stack["completes_at"] = time.time() + duration * self.time_scale
+        fake_stack["fails"] = operation != 'DELETE' and random.random() < self.stack_failure_rate
+
+    # Get the current status of a fake stack, based on its operation and the time passed
+    def _get_stack_status(self, fake_stack):
+        if time.time() < fake_stack["completes_at"]:
+            return '{}_IN_PROGRESS'.format(fake_stack["operation"])
+        if fake_stack["fails"]:
+            return 'ROLLBACK_COMPLETE' if fake_stack["operation"] == 'CREATE' else 'UPDATE_ROLLBACK_COMPLETE'
+        return '{}_COMPLETE'.format(fake_stack["operation"])
+
+    def _describe_fake_stack(self, fake_stack):
+        stack_status = self._get_stack_status(fake_stack)
+        stack = {
+            'StackId': fake_stack["StackId"],
+            'StackName': fake_stack["StackName"],
+            'StackStatus': stack_status,
+            'CreationTime': fake_stack["CreationTime"],
+            'Parameters': fake_stack["Parameters"],
+            'Tags': fake_stack["Tags"]
+        }
+        if stack_status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+            stack['Outputs'] = [{'OutputKey': output_key, 'OutputValue': output_value}
+                                for output_key, output_value in fake_stack["Outputs"].items()]
+        return stack
+
+    # Get the fake stacks that are not deleted
+    def _get_live_stacks(self):
+        with self.service_lock:
+            fake_stacks = list(self.stacks.values())
+        return [fake_stack for fake_stack in fake_stacks if self._get_stack_status(fake_stack) != 'DELETE_COMPLETE']
+
+    def _get_live_stack(self, stack_name, call_name):
+        with self.service_lock:
+            fake_stack = self.stacks.get(stack_name)
+        if fake_stack is None or self._get_stack_status(fake_stack) == 'DELETE_COMPLETE':
+            self._raise_missing_stack(stack_name, call_name)
+        return fake_stack
+
+    # Make up output values for the outputs declared by a template
+    def _get_fake_outputs(self, stack_name, template_data, outputs_version):
+        fake_outputs = {}
+        for output_key in json_loads(template_data).get('Outputs', {}):
+            output_value = 'fake-{}-{}-{}'.format(stack_name, output_key, outputs_version).lower()
+            fake_outputs[output_key] = 'alias/' + output_value if 'Alias' in output_key else output_value
+        return fake_outputs
+
+    # Get the template body of a call, reading it from the S3 fake if it was passed as a URL
+    def _get_template_body(self, TemplateBody, TemplateURL, call_name):
+        with self.service_lock:
+            self.template_request_bytes += len((TemplateBody or '').encode('utf-8')) + len(TemplateURL or '')
+        if TemplateURL is None:
+            return TemplateBody
+        if self.s3_client is None:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ValidationError',
+                        'Message': 'TemplateURL is not supported without an S3 fake'}}, call_name)
+        return self.s3_client._read_url(TemplateURL)
+
+    def validate_template(self, TemplateBody=None, TemplateURL=None):
+        self._call('validate_template')
+        template = json_loads(self._get_template_body(TemplateBody, TemplateURL, 'validate_template'))
+        return {'Parameters': [dict({'ParameterKey': parameter_key},
+                                    **({'DefaultValue': parameter['Default']} if 'Default' in parameter else {}))
+                               for parameter_key, parameter in template.get('Parameters', {}).items()]}
+
+    def create_stack(self, StackName, TemplateBody=None, Parameters=None, Capabilities=None, Tags=None, TemplateURL=None):
+        self._call('create_stack')
+        TemplateBody = self._get_template_body(TemplateBody, TemplateURL, 'create_stack')
+        with self.service_lock:
+            existing_stack = self.stacks.get(StackName)
+            if existing_stack is not None and self._get_stack_status(existing_stack) != 'DELETE_COMPLETE':
+                raise botocore.exceptions.ClientError({'Error': {'Code': 'AlreadyExistsException',
+                            'Message': 'Stack [{}] already exists'.format(StackName)}}, 'create_stack')
+            fake_stack = {
+                "StackId": 'arn:aws:cloudformation:fake:stack/{}/{}'.format(StackName, uuid.uuid4()),
+                "StackName": StackName,
+                "CreationTime": datetime.now(timezone.utc),
+                "Parameters": Parameters or [],
+                "Tags": Tags or [],
+                "TemplateBody": TemplateBody,
+                "Outputs": self._get_fake_outputs(StackName, TemplateBody, 1),
+                "OutputsVersion": 1
+            }
+            self._start_stack_operation(fake_stack, 'CREATE')
+            self.stacks[StackName] = fake_stack
+        return {'StackId': fake_stack["StackId"]}
+
+    def delete_stack(self, StackName):
+        self._call('delete_stack')
+        with self.service_lock:
+            fake_stack = self.stacks.get(StackName)
+            if fake_stack is not None and self._get_stack_status(fake_stack) != 'DELETE_COMPLETE':
+                self._start_stack_operation(fake_stack, 'DELETE')
+        return {}
+
+    def describe_stacks(self, StackName):
+        self._call('describe_stacks')
+        return {'Stacks': [self._describe_fake_stack(self._get_live_stack(StackName, 'describe_stacks'))]}
+
+    def list_stacks(self, StackStatusFilter=None):
+        self._call('list_stacks')
+        return {'StackSummaries': [{'StackName': fake_stack["StackName"], 'StackStatus': self._get_stack_status(fake_stack)}
+                                   for fake_stack in self._get_live_stacks()]}
+
+    # Make up the events of a stack - one per second of its current operation
+    def _get_stack_events(self, StackName):
+        fake_stack = self._get_live_stack(StackName, 'describe_stack_events')
+        stack_status = self._get_stack_status(fake_stack)
+        elapsed_seconds = int((min(time.time(), fake_stack["completes_at"]) - fake_stack["started_at"]) / self.time_scale)
+        stack_events = [{'EventId': '{}-{}-{}'.format(fake_stack["operation"], fake_stack["started_at"], event_index),
+                         'StackName': StackName, 'LogicalResourceId': 'FakeResource{}'.format(event_index),
+                         'ResourceStatus': '{}_IN_PROGRESS'.format(fake_stack["operation"]),
+                         'Timestamp': datetime.fromtimestamp(fake_stack["started_at"] + event_index * self.time_scale, timezone.utc)}
+                        for event_index in range(elapsed_seconds)]
+        if not stack_status.endswith('_IN_PROGRESS'):
+            stack_events.append({'EventId': '{}-{}-done'.format(fake_stack["operation"], fake_stack["started_at"]),
+                                 'StackName': StackName, 'LogicalResourceId': StackName, 'ResourceStatus': stack_status,
+                                 'Timestamp': datetime.fromtimestamp(fake_stack["completes_at"], timezone.utc)})
+        return list(reversed(stack_events))
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'describe_stacks':
+            return DatabricksWSFakePaginator(self, 'describe_stacks',
+                        lambda: [self._describe_fake_stack(fake_stack) for fake_stack in self._get_live_stacks()],
+                        'Stacks', self.page_size)
+        if operation_name == 'list_stacks':
+            return DatabricksWSFakePaginator(self, 'list_stacks', lambda **kwargs: self.list_stacks(**kwargs)['StackSummaries'],
+                        'StackSummaries', self.page_size)
+        if operation_name == 'describe_stack_events':
+            return DatabricksWSFakePaginator(self, 'describe_stack_events', self._get_stack_events, 'StackEvents', self.page_size)
+        raise ValueError("Operation {} can't be paginated by the fake".format(operation_name))
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType='UPDATE', TemplateBody=None, Parameters=None,
+                          Capabilities=None, Tags=None, TemplateURL=None):
+        self._call('create_change_set')
+        TemplateBody = self._get_template_body(TemplateBody, TemplateURL, 'create_change_set')
+        fake_stack = self._get_live_stack(StackName, 'create_change_set')
+        has_changes = TemplateBody != fake_stack["TemplateBody"] or Parameters != fake_stack["Parameters"]
+        with self.service_lock:
+            self.change_sets[(StackName, ChangeSetName)] = {
+                "Status": 'CREATE_COMPLETE' if has_changes else 'FAILED',
+                "StatusReason": '' if has_changes else "The submitted information didn't contain changes.",
+                "TemplateBody": TemplateBody,
+                "Parameters": Parameters or [],
+                "Tags": Tags or fake_stack["Tags"]
+            }
+        return {'Id': ChangeSetName}
+
+    def describe_change_set(self, StackName, ChangeSetName):
+        self._call('describe_change_set')
+        change_set = self.change_sets[(StackName, ChangeSetName)]
+        return {'Status': change_set["Status"], 'StatusReason': change_set["StatusReason"]}
+
+    def delete_change_set(self, StackName, ChangeSetName):
+        self._call('delete_change_set')
+        with self.service_lock:
+            self.change_sets.pop((StackName, ChangeSetName), None)
+        return {}
+
+    def execute_change_set(self, StackName, ChangeSetName):
+        self._call('execute_change_set')
+        fake_stack = self._get_live_stack(StackName, 'execute_change_set')
+        with self.service_lock:
+            change_set = self.change_sets.pop((StackName, ChangeSetName))
+            fake_stack["TemplateBody"] = change_set["TemplateBody"]
+            fake_stack["Parameters"] = change_set["Parameters"]
+            fake_stack["Tags"] = change_set["Tags"]
+            # Changed parameters may change resources, so the outputs get new values
+            fake_stack["OutputsVersion"] += 1
+            fake_stack["Outputs"] = self._get_fake_outputs(StackName, change_set["TemplateBody"], fake_stack["OutputsVersion"])
+            self._start_stack_operation(fake_stack, 'UPDATE')
+        return {}
+
+    def get_waiter(self, waiter_name):
+        if waiter_name == 'stack_create_complete':
+            return DatabricksWSFakeWaiter(
+                lambda StackName: self._get_stack_status(self._get_live_stack(StackName, 'describe_stacks')),
+                'CREATE_COMPLETE', self.time_scale)
+        if waiter_name == 'change_set_create_complete':
+            return DatabricksWSFakeWaiter(
+                lambda StackName, ChangeSetName: self.describe_change_set(StackName, ChangeSetName)['Status'],
+                'CREATE_COMPLETE', self.time_scale)
+        raise ValueError("Waiter {} is not supported by the fake".format(waiter_name))
+
+# Stand-in for the databricks_cli AccountsApi, for the calls used by the provisioning scripts
+class DatabricksWSFakeAccountsApi(DatabricksWSFakeService):
+
+    def __init__(self, workspace_latency=None, workspace_failure_rate=0, time_scale=1.0, **kwargs):
+        super(DatabricksWSFakeAccountsApi, self).__init__(**kwargs)
+        self.workspace_latency = workspace_latency or lognormal_latency(240)
+        self.workspace_failure_rate = workspace_failure_rate
+        self.time_scale = time_scale
+        # Objects per type, keyed by their id
+        self.account_objects = {}
+        # Sampled provisioning duration of every workspace, keyed by name, for critical path calculations
+        self.workspace_durations = {}
+
+    def _raise_failure(self, call_name):
+        http_response = requests.models.Response()
+        http_response.status_code = 429
+        raise requests.exceptions.HTTPError('429 Client Error: Too Many Requests for {}'.format(call_name),
+                                            response=http_response)
+
+    def _raise_missing_object(self, object_type, object_id):
+        http_response = requests.models.Response()
+        http_response.status_code = 404
+        raise requests.exceptions.HTTPError('404 Client Error: {} {} not found'.format(object_type, object_id),
+                                            response=http_response)
+
+    # Create an account object of a type
+    def _create_object(self, object_type, id_key, object_request):
+        self._call('create_{}'.format(object_type))
+        account_object = dict(object_request)
+        account_object[id_key] = str(uuid.uuid4())
+        account_object["creation_time"] = int(time.time() * 1000)
+        with self.service_lock:
+            self.account_objects.setdefault(object_type, {})[account_object[id_key]] = account_object
+        return account_object
+
+    def _list_objects(self, object_type):
+        self._call('list_{}'.format(object_type))
+        with self.service_lock:
+            return list(self.account_objects.get(object_type, {}).values())
+
+    def _get_object(self, object_type, object_id):
+        self._call('get_{}'.format(object_type))
+        with self.service_lock:
+            account_object = self.account_objects.get(object_type, {}).get(object_id)
+        if account_object is None:
+            self._raise_missing_object(object_type, object_id)
+        return account_object
+
+    def _delete_object(self, object_type, object_id):
+        self._call('delete_{}'.format(object_type))
+        with self.service_lock:
+            if self.account_objects.get(object_type, {}).pop(object_id, None) is None:
+                self._raise_missing_object(object_type, object_id)
+        return {}
+
+    def create_credentials(self, account_id, credentials_request):
+        return self._create_object('credentials', 'credentials_id', credentials_request)
+
+    def create_storage_config(self, account_id, storage_config_request):
+        return self._create_object('storage_config', 'storage_configuration_id', storage_config_request)
+
+    def create_network(self, account_id, network_request):
+        return self._create_object('network', 'network_id', network_request)
+
+    def create_customer_managed_key(self, account_id, customer_managed_key_request):
+        return self._create_object('customer_managed_key', 'customer_managed_key_id', customer_managed_key_request)
+
+    def create_workspace(self, account_id, workspace_request):
+        workspace = self._create_object('workspace', 'workspace_id', workspace_request)
+        duration = self.workspace_latency()
+        with self.service_lock:
+            self.workspace_durations[workspace_request["workspace_name"]] = duration
+            workspace["ready_at"] = time.time() + duration * self.time_scale
+            workspace["fails"] = random.random() < self.workspace_failure_rate
+        return self._describe_workspace(workspace)
+
+    # Get a workspace with its current status, based on the time passed since it was created
+    def _describe_workspace(self, workspace):
+        described_workspace = dict((key, value) for key, value in workspace.items() if key not in ("ready_at", "fails"))
+        if time.time() < workspace["ready_at"]:
+            described_workspace["workspace_status"] = 'PROVISIONING'
+        else:
+            described_workspace["workspace_status"] = 'FAILED' if workspace["fails"] else 'RUNNING'
+        return described_workspace
+
+    def get_workspace(self, account_id, workspace_id):
+        return self._describe_workspace(self._get_object('workspace', workspace_id))
+
+    def list_workspaces(self, account_id):
+        return [self._describe_workspace(workspace) for workspace in self._list_objects('workspace')]
+
+    def update_workspace(self, account_id, workspace_id, workspace_request):
+        self._call('update_workspace')
+        with self.service_lock:
+            workspace = self.account_objects.get('workspace', {}).get(workspace_id)
+            if workspace is None:
+                self._raise_missing_object('workspace', workspace_id)
+            workspace.update(workspace_request)
+        return {}
+
+    def list_credentials(self, account_id):
+        return self._list_objects('credentials')
+
+    def list_storage_config(self, account_id):
+        return self._list_objects('storage_config')
+
+    def list_network(self, account_id):
+        return self._list_objects('network')
+
+    def list_customer_managed_keys(self, account_id):
+        return self._list_objects('customer_managed_key')
+
+    def delete_credentials(self, account_id, credentials_id):
+        return self._delete_object('credentials', credentials_id)
+
+    def delete_storage_config(self, account_id, storage_config_id):
+        return self._delete_object('storage_config', storage_config_id)
+
+    def delete_network(self, account_id, network_id):
+        return self._delete_object('network', network_id)
+
+    def delete_customer_managed_key(self, account_id, customer_managed_key_id):
+        return self._delete_object('customer_managed_key', customer_managed_key_id)
+
+    def delete_workspace(self, account_id, workspace_id):
+        return self._delete_object('workspace', workspace_id)
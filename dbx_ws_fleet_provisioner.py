@@ -0,0 +1,277 @@
+# Controller script to provision a fleet of Databricks AWS E2 workspaces from a manifest, with bounded parallelism.
+# Each manifest row (JSON lines, or CSV with a header) holds the per-workspace overrides that are layered on the
+# shared defaults from common_params.json. The name defaults can refer to manifest values, e.g.
+# "vpc_stack_name": "E2-BYOVPC-Deploy-{workspace_key}", and keys of the form <step_name>.<ParameterKey>
+# (e.g. "s3.BucketName", "vpc.Subnet1Cidr") override a cloudformation parameter of that step in stack_graph.json.
+
+import argparse
+import csv
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from json import dumps as json_dumps, loads as json_loads
+
+from dbx_ws_utils import DatabricksWSProvisioningUtils
+from dbx_ws_accounts_api import DatabricksWSAccountsAPI
+from dbx_ws_client_pool import DatabricksWSClientPool
+from dbx_ws_provisioner import create_workspace, get_run_journal, get_trace_path, provision_workspace, teardown_workspace
+from dbx_ws_provisioner import get_resource_bundle_path, load_resource_bundle, save_resource_bundle, update_workspace
+from dbx_ws_tracer import DatabricksWSTracer
+
+# Defaults that are templated with the values of a manifest row. Other defaults, e.g. the API password, are taken as is.
+TEMPLATED_PARAM_KEYS = ['workspace_name', 'deployment_cname', 'vpc_stack_name', 'iam_stack_name', 's3_stack_name',
+                        'kms_stack_name', 'credentials_name', 'storage_config_name', 'network_name',
+                        'customer_managed_key_name']
+
+class DatabricksWSFleetProvisioner(object):
+
+    # With a resource pool, new workspaces are created from its prepared resource bundles whenever it has one
+    def __init__(self, defaults, client_pool, max_workspaces=10, max_workspaces_per_region=5,
+                 step_graph='./stack_graph.json', resume=False, update=False, teardown=False, resource_pool=None):
+        # A cap of 0 would never start a workspace
+        if max_workspaces < 1 or max_workspaces_per_region < 1:
+            print("Exiting the script as the caps on workspaces provisioned at once must be at least 1")
+            exit(1)
+        self.defaults = defaults
+        self.client_pool = client_pool
+        self.max_workspaces = max_workspaces
+        self.max_workspaces_per_region = max_workspaces_per_region
+        self.step_graph = step_graph
+        self.resume = resume
+        self.update = update
+        self.teardown = teardown
+        self.resource_pool = resource_pool
+
+    # Read and parse a manifest file of per-workspace overrides, either JSON lines or CSV
+    def _parse_manifest(self, manifest):
+        with open(manifest) as manifest_fileobj:
+            if manifest.endswith('.csv'):
+                manifest_rows = [dict(manifest_row) for manifest_row in csv.DictReader(manifest_fileobj)]
+            else:
+                manifest_rows = [json_loads(manifest_line) for manifest_line in manifest_fileobj if manifest_line.strip()]
+        return manifest_rows
+
+    # Template a default with the values of a manifest row. Raises a ValueError naming the default if it can't be.
+    def _template_default(self, param_key, param_value, manifest_row):
+        if not isinstance(param_value, str):
+            return param_value
+        try:
+            return param_value.format_map(manifest_row)
+        except (KeyError, IndexError, ValueError) as ex:
+            raise ValueError("Default {} could not be templated with the manifest row: {!r}".format(param_key, ex))
+
+    # Layer the overrides of a manifest row on the shared defaults to get the common params for a workspace
+    def _build_common_params(self, manifest_row):
+        common_params = {}
+        for param_key, param_value in self.defaults.items():
+            if param_key in TEMPLATED_PARAM_KEYS:
+                param_value = self._template_default(param_key, param_value, manifest_row)
+            common_params[param_key] = param_value
+
+        stack_parameter_overrides = {}
+        for overrides in (self.defaults.get("stack_parameter_overrides", {}),
+                          manifest_row.get("stack_parameter_overrides", {})):
+            for step_name, step_overrides in overrides.items():
+                stack_parameter_overrides.setdefault(step_name, {}).update(step_overrides)
+        for param_key, param_value in manifest_row.items():
+            if param_key == "stack_parameter_overrides":
+                continue
+            if '.' in param_key:
+                step_name, parameter_key = param_key.split('.', 1)
+                stack_parameter_overrides.setdefault(step_name, {})[parameter_key] = param_value
+            else:
+                common_params[param_key] = param_value
+        common_params["stack_parameter_overrides"] = stack_parameter_overrides
+        return common_params
+
+    # Get the cloudformation and Accounts API interfaces for a workspace, on the shared clients
+    def _get_provisioning_apis(self, common_params, tracer):
+        ws_prov_utils = DatabricksWSProvisioningUtils(common_params,
+                            self.client_pool._get_cf_client(common_params["region_name"]),
+                            self.client_pool._get_stack_index(common_params["region_name"]),
+                            self.client_pool._get_stack_poller(common_params["region_name"]),
+                            self.client_pool.template_cache, tracer,
+                            self.client_pool._get_template_stager(common_params))
+        ws_accounts_api = DatabricksWSAccountsAPI(common_params,
+                            self.client_pool._get_accounts_api_client(common_params),
+                            self.client_pool._get_workspace_watcher(common_params), tracer)
+        return ws_prov_utils, ws_accounts_api
+
+    # Provision one workspace of the fleet using the shared clients, and return its result record
+    # A tracer can be passed in, e.g. to follow the progress of the run through its span callback
+    def _run_workspace(self, common_params, tracer=None):
+        start_time = time.time()
+        workspace_result = {
+            "workspace_name": common_params["workspace_name"],
+            "region_name": common_params["region_name"],
+            "workspace_id": None,
+            "workspace_status": None,
+            "error": None
+        }
+        # Polls of the shared stack pollers and workspace watchers are not counted on the tracer of any one workspace
+        if tracer is None:
+            tracer = DatabricksWSTracer(common_params["workspace_name"])
+        try:
+            ws_prov_utils, ws_accounts_api = self._get_provisioning_apis(common_params, tracer)
+            if self.teardown:
+                teardown_result = teardown_workspace(common_params, ws_prov_utils, ws_accounts_api, self.step_graph)
+                workspace_result["workspace_id"] = teardown_result["workspace_id"]
+                workspace_result["deleted_stacks"] = teardown_result["deleted_stacks"]
+                workspace_result["workspace_status"] = 'DELETED'
+            elif self.update:
+                workspace_result["replaced_objects"] = update_workspace(common_params, ws_prov_utils,
+                                                           ws_accounts_api, self.step_graph)
+                workspace_result["workspace_status"] = 'UPDATED'
+            else:
+                run_journal = get_run_journal(common_params, self.resume)
+                # A resumed run picks up the bundle it was created from, if any, and otherwise its own stacks and
+                # workspace objects instead of a prepared bundle
+                resource_bundle = load_resource_bundle(common_params) if self.resume else None
+                is_taken_bundle = False
+                if self.resource_pool is not None and not self.resume:
+                    resource_bundle = self.resource_pool._take_bundle(common_params)
+                    is_taken_bundle = resource_bundle is not None
+                    if is_taken_bundle:
+                        save_resource_bundle(common_params, resource_bundle)
+                if resource_bundle is not None:
+                    workspace_result["resource_bundle"] = {"bundle_key": resource_bundle["bundle_key"],
+                                                           "stack_names": resource_bundle["stack_names"]}
+                    try:
+                        workspace_id, workspace_prov_status = create_workspace(common_params, ws_accounts_api,
+                                                                resource_bundle["workspace_input_data"], run_journal)
+                    # Without a workspace nothing uses the bundle, so it goes back to the pool instead of leaking
+                    except (Exception, SystemExit):
+                        if is_taken_bundle and run_journal._get("workspace", "workspace_id") is None:
+                            os.remove(get_resource_bundle_path(common_params))
+                            self.resource_pool._discard_bundle(resource_bundle)
+                        raise
+                else:
+                    workspace_id, workspace_prov_status = provision_workspace(common_params, ws_prov_utils,
+                                                            ws_accounts_api, self.step_graph, run_journal)
+                workspace_result["workspace_id"] = workspace_id
+                workspace_result["workspace_status"] = workspace_prov_status
+        # The pipeline exits on most failures, which must only fail this workspace and not the fleet
+        except (Exception, SystemExit) as ex:
+            workspace_result["error"] = repr(ex)
+        # Times are kept unrounded, as the benchmark scales them up to modeled seconds
+        workspace_result["elapsed_seconds"] = time.time() - start_time
+
+        run_summary = tracer._get_summary()
+        workspace_result["critical_path_seconds"] = run_summary["critical_path_seconds"]
+        workspace_result["idle_seconds"] = run_summary["idle_seconds"]
+        workspace_result["time_to_running_seconds"] = run_summary["milestone_seconds"].get("workspace_running")
+        workspace_result["span_seconds"] = run_summary["span_seconds"]
+        workspace_result["api_calls"] = run_summary["api_calls"]
+        workspace_result["throttles"] = run_summary["throttles"]
+        workspace_result["retries"] = run_summary["retries"]
+        try:
+            workspace_result["trace_path"] = tracer._export_trace(get_trace_path(common_params))
+        except OSError as ex:
+            print("Trace of workspace {} could not be exported: {!r}".format(common_params["workspace_name"], ex))
+        return workspace_result
+
+    # Summarize the results of a fleet into the p50 and p95 of the provisioning, critical path and time to RUNNING
+    # of the workspaces that were provisioned successfully
+    def _summarize_fleet(self, fleet_results):
+        fleet_summary = {}
+        succeeded_results = [workspace_result for workspace_result in fleet_results
+                             if workspace_result["workspace_status"] in ('RUNNING', 'UPDATED', 'DELETED')]
+        for result_key in ("elapsed_seconds", "critical_path_seconds", "idle_seconds", "time_to_running_seconds"):
+            result_values = sorted(workspace_result[result_key] for workspace_result in succeeded_results
+                                   if workspace_result.get(result_key) is not None)
+            if not result_values:
+                continue
+            for percentile in (50, 95):
+                percentile_index = min(len(result_values) - 1, int(round(percentile / 100 * (len(result_values) - 1))))
+                fleet_summary["p{}_{}".format(percentile, result_key)] = result_values[percentile_index]
+        fleet_summary["api_calls"] = sum(workspace_result.get("api_calls", 0) for workspace_result in fleet_results)
+        fleet_summary["throttles"] = sum(workspace_result.get("throttles", 0) for workspace_result in fleet_results)
+        fleet_summary["retries"] = sum(workspace_result.get("retries", 0) for workspace_result in fleet_results)
+        return fleet_summary
+
+    # Provision all workspaces of the manifest, within the global and per-region concurrency caps
+    def _provision_fleet(self, manifest_rows):
+        fleet_results = []
+        pending_workspaces = []
+        for manifest_row in manifest_rows:
+            try:
+                pending_workspaces.append(self._build_common_params(manifest_row))
+            except (KeyError, ValueError) as ex:
+                print("Skipping manifest row {} as its params could not be built: {}".format(manifest_row, ex))
+                fleet_results.append({"workspace_name": manifest_row.get("workspace_name"),
+                                      "region_name": manifest_row.get("region_name"),
+                                      "workspace_id": None, "workspace_status": None,
+                                      "error": repr(ex), "elapsed_seconds": 0.0})
+
+        running_workspaces = {}
+        running_per_region = {}
+        with ThreadPoolExecutor(max_workers=self.max_workspaces) as executor:
+            while pending_workspaces or running_workspaces:
+                for common_params in list(pending_workspaces):
+                    if len(running_workspaces) >= self.max_workspaces:
+                        break
+                    region_name = common_params["region_name"]
+                    if running_per_region.get(region_name, 0) >= self.max_workspaces_per_region:
+                        continue
+                    pending_workspaces.remove(common_params)
+                    running_per_region[region_name] = running_per_region.get(region_name, 0) + 1
+                    print("Starting provisioning of workspace {} in {}".format(common_params["workspace_name"], region_name))
+                    running_workspaces[executor.submit(self._run_workspace, common_params)] = common_params
+
+                done_futures, _ = wait(running_workspaces, return_when=FIRST_COMPLETED)
+                for workspace_future in done_futures:
+                    common_params = running_workspaces.pop(workspace_future)
+                    running_per_region[common_params["region_name"]] -= 1
+                    workspace_result = workspace_future.result()
+                    print("Finished workspace {} with status {} in {:.1f}s ({} of {} done)".format(
+                        workspace_result["workspace_name"], workspace_result["workspace_status"],
+                        workspace_result["elapsed_seconds"], len(fleet_results) + 1, len(manifest_rows)))
+                    fleet_results.append(workspace_result)
+        return fleet_results
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Provision a fleet of Databricks AWS E2 workspaces from a manifest')
+    arg_parser.add_argument('--manifest', required=True, help='JSON lines or CSV file of per-workspace overrides')
+    arg_parser.add_argument('--defaults', default='./common_params.json', help='Shared default master parameters')
+    arg_parser.add_argument('--step-graph', default='./stack_graph.json', help='Step graph of the stacks to deploy')
+    arg_parser.add_argument('--max-workspaces', type=int, default=10, help='Max workspaces provisioned at once')
+    arg_parser.add_argument('--max-workspaces-per-region', type=int, default=5,
+                            help='Max workspaces provisioned at once in a single region')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='Resume the interrupted runs of the workspaces from their journals')
+    arg_parser.add_argument('--update', action='store_true',
+                            help='Update the stacks of the existing workspaces whose templates or parameters changed')
+    arg_parser.add_argument('--teardown', action='store_true',
+                            help='Delete the workspaces of the manifest, with their workspace objects and stacks')
+    arg_parser.add_argument('--results', default='./fleet_results.jsonl', help='File to write per-workspace results to')
+    args = arg_parser.parse_args()
+
+    with open(args.defaults) as parameter_fileobj:
+        parameter_str = parameter_fileobj.read()
+    defaults = json_loads(parameter_str)
+
+    # Every pipeline of a region keeps a few stacks in flight at once, so size the connection pools for all of them
+    client_pool = DatabricksWSClientPool(max_pool_connections=args.max_workspaces_per_region * defaults.get("max_parallel_stacks", 4),
+                                         accounts_api_rate_per_second=defaults.get("accounts_api_rate_per_second", 5),
+                                         accounts_api_burst=defaults.get("accounts_api_burst", 10),
+                                         rate_limit_dir=defaults.get("rate_limit_dir"))
+    ws_fleet_provisioner = DatabricksWSFleetProvisioner(defaults, client_pool, args.max_workspaces,
+                                args.max_workspaces_per_region, args.step_graph, args.resume, args.update,
+                                args.teardown)
+    manifest_rows = ws_fleet_provisioner._parse_manifest(args.manifest)
+    fleet_results = ws_fleet_provisioner._provision_fleet(manifest_rows)
+
+    with open(args.results, 'w') as results_fileobj:
+        for workspace_result in fleet_results:
+            results_fileobj.write(json_dumps(workspace_result) + '\n')
+
+    print("Fleet summary is {}".format(json_dumps(ws_fleet_provisioner._summarize_fleet(fleet_results))))
+    print("Accounts API transport counters are {}".format(json_dumps(client_pool._get_accounts_api_counters())))
+    failed_results = [workspace_result for workspace_result in fleet_results
+                      if workspace_result["workspace_status"] not in ('RUNNING', 'UPDATED', 'DELETED')]
+    fleet_action = 'Tore down' if args.teardown else 'Updated' if args.update else 'Provisioned'
+    print("{} {} of {} workspaces successfully, results are in {}".format(fleet_action,
+        len(fleet_results) - len(failed_results), len(fleet_results), args.results))
+    if failed_results:
+        exit(1)
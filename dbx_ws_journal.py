@@ -0,0 +1,85 @@
+# Interface for a persistent journal of a provisioning run for a Databricks E2 Workspace
+# Records the outputs of every completed step in a JSON lines file, so that an interrupted run can be resumed
+# from the first incomplete step instead of being restarted
+
+import os
+import threading
+import time
+
+from datetime import datetime
+from json import dumps as json_dumps, loads as json_loads
+
+class DatabricksWSRunJournal(object):
+
+    # Without resume, a journal left by a previous run that didn't complete is not overwritten
+    def __init__(self, journal_path, resume=False):
+        self.journal_path = journal_path
+        self.resume = resume
+        self.journal_records = {}
+        self.journal_lock = threading.Lock()
+
+        has_previous_run = os.path.exists(journal_path) and os.path.getsize(journal_path) > 0
+        if has_previous_run and not resume:
+            print("Exiting the script as the journal {} of a previous run exists - resume the run or delete the journal".format(journal_path))
+            exit(1)
+        if has_previous_run:
+            with open(journal_path) as journal_fileobj:
+                for journal_line in journal_fileobj:
+                    # A partially written last line means the run was killed while recording, so that step is redone
+                    try:
+                        journal_record = json_loads(journal_line)
+                    except ValueError:
+                        continue
+                    self.journal_records[(journal_record["record_type"], journal_record["key"])] = journal_record["value"]
+            print("Resuming from journal {} with {} completed steps".format(journal_path, len(self.journal_records)))
+        else:
+            os.makedirs(os.path.dirname(journal_path) or '.', exist_ok=True)
+
+    # Serialize the datetimes in stack objects
+    def _json_serial(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        raise TypeError("Type not serializable")
+
+    # Get the recorded value of a completed step, or None if it's not complete
+    def _get(self, record_type, key):
+        with self.journal_lock:
+            return self.journal_records.get((record_type, key))
+
+    # Durably record the value of a completed step
+    def _record(self, record_type, key, value):
+        journal_record = {"recorded_at": time.time(), "record_type": record_type, "key": key, "value": value}
+        journal_line = json_dumps(journal_record, default=self._json_serial) + '\n'
+        with self.journal_lock:
+            with open(self.journal_path, 'a') as journal_fileobj:
+                journal_fileobj.write(journal_line)
+                journal_fileobj.flush()
+                os.fsync(journal_fileobj.fileno())
+            self.journal_records[(record_type, key)] = value
+
+    # Record a created stack, keeping only what later steps need from it
+    def _record_stack(self, step_name, created_stack_obj):
+        created_stack = created_stack_obj['Stacks'][0]
+        self._record("stack", step_name, {'Stacks': [{
+            'StackName': created_stack['StackName'],
+            'StackId': created_stack.get('StackId'),
+            'StackStatus': created_stack['StackStatus'],
+            'Outputs': created_stack.get('Outputs', [])
+        }]})
+
+    # Move the journal of a finished run aside with the given suffix, so that the next run for the same workspace
+    # starts fresh
+    def _move_aside(self, suffix):
+        with self.journal_lock:
+            if os.path.exists(self.journal_path):
+                os.replace(self.journal_path, '{}.{}.{}'.format(self.journal_path, datetime.now().strftime('%Y%m%d%H%M%S'), suffix))
+
+    # Move the journal of a completed run aside
+    def _complete(self):
+        self._move_aside('done')
+
+    # Record the final status of a run whose workspace failed, and move its journal aside. The failed workspace
+    # can't be resumed, so its stacks and workspace objects are left to a teardown.
+    def _fail(self, workspace_prov_status):
+        self._record("run", "workspace_status", workspace_prov_status)
+        self._move_aside('failed')
@@ -0,0 +1,77 @@
+# Interface for a preflight pass over all AWS cloudformation templates and parameter files of a step graph
+# Loads and validates everything at once before any stack is deployed, so that a broken template or a
+# mismatched parameter is found in seconds instead of after the other stacks have been created
+
+from concurrent.futures import ThreadPoolExecutor
+from json import loads as json_loads
+
+class DatabricksWSPreflight(object):
+
+    def __init__(self, ws_prov_utils, max_workers=8):
+        self.ws_prov_utils = ws_prov_utils
+        self.max_workers = max_workers
+
+    # Check a single step - its template, its parameter file and the params and outputs it refers to.
+    # Returns the declared outputs of the template and a list of problems found.
+    def _check_step(self, step, common_params):
+        step_problems = []
+        try:
+            with open(step["template"]) as template_fileobj:
+                template_data = template_fileobj.read()
+        except OSError as ex:
+            return [], ["Template {} could not be read: {}".format(step["template"], ex)]
+        try:
+            template_outputs = list(json_loads(template_data).get("Outputs", {}).keys())
+        except ValueError as ex:
+            return [], ["Template {} is not valid JSON: {}".format(step["template"], ex)]
+        try:
+            template_parameters = self.ws_prov_utils._get_template_parameters(template_data)
+        except Exception as ex:
+            return template_outputs, ["Template {} failed validation: {}".format(step["template"], ex)]
+
+        try:
+            parameter_data = self.ws_prov_utils._parse_parameters(step["parameters"])
+        except (OSError, ValueError) as ex:
+            return template_outputs, ["Parameter file {} could not be read: {}".format(step["parameters"], ex)]
+
+        if step["stack_name_param"] not in common_params:
+            step_problems.append("Common param {} for the stack name is missing".format(step["stack_name_param"]))
+        for common_params_key in step.get("common_params_inputs", {}).values():
+            if common_params_key not in common_params:
+                step_problems.append("Common param {} is missing".format(common_params_key))
+
+        parameter_keys = [parameter["ParameterKey"] for parameter in parameter_data]
+        parameter_keys += list(step.get("common_params_inputs", {}).keys())
+        parameter_keys += list(step.get("stack_inputs", {}).keys())
+        parameter_keys += list(common_params.get("stack_parameter_overrides", {}).get(step["step_name"], {}).keys())
+        for parameter_key in parameter_keys:
+            if parameter_key not in template_parameters:
+                step_problems.append("Parameter {} is not declared by template {}".format(parameter_key, step["template"]))
+        for parameter_key, has_default in template_parameters.items():
+            if not has_default and parameter_key not in parameter_keys:
+                step_problems.append("Parameter {} of template {} has no default and no value".format(parameter_key, step["template"]))
+        return template_outputs, step_problems
+
+    # Check all steps of the graph concurrently, including that every stack input refers to a declared output.
+    # Exits if any problem is found.
+    def _run_preflight(self, steps, common_params):
+        print("Running preflight checks for {} templates".format(len(steps)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            step_futures = {step["step_name"]: executor.submit(self._check_step, step, common_params) for step in steps}
+        template_outputs = {step_name: step_future.result()[0] for step_name, step_future in step_futures.items()}
+
+        preflight_problems = []
+        for step in steps:
+            preflight_problems += ["Step {}: {}".format(step["step_name"], step_problem)
+                                   for step_problem in step_futures[step["step_name"]].result()[1]]
+            for parameter_key, stack_input in step.get("stack_inputs", {}).items():
+                if stack_input["output_key"] not in template_outputs[stack_input["step_name"]]:
+                    preflight_problems.append("Step {}: Output {} of step {} for parameter {} is not declared".format(
+                        step["step_name"], stack_input["output_key"], stack_input["step_name"], parameter_key))
+
+        for preflight_problem in preflight_problems:
+            print(preflight_problem)
+        if preflight_problems:
+            print("Exiting the script as preflight checks found {} problems".format(len(preflight_problems)))
+            exit(1)
+        print("Preflight checks passed")
@@ -1,116 +1,292 @@
 # This is a quick and dirty script to do full end-to-end AWS infra and Databricks E2 workspace
 # provisioning. To do something similar in CI/CD pipelines, I would suggest to modularize
-# and externalize the config further.
+# and externalize the config further. To provision many workspaces at once, see dbx_ws_fleet_provisioner.py.
 
-from json import loads as json_loads
+import argparse
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps, loads as json_loads
 
 from dbx_ws_utils import DatabricksWSProvisioningUtils
 from dbx_ws_stack_processor import DatabricksWSStackProcessor
+from dbx_ws_stack_scheduler import DatabricksWSStackScheduler
+from dbx_ws_preflight import DatabricksWSPreflight
 from dbx_ws_accounts_api import DatabricksWSAccountsAPI
+from dbx_ws_journal import DatabricksWSRunJournal
+from dbx_ws_tracer import DatabricksWSTracer
+
+# Get the path of the run journal for the workspace in the common params
+def get_run_journal_path(common_params):
+    return os.path.join(common_params.get("run_journal_dir", "./.run_journal"), "{}.jsonl".format(common_params["workspace_name"]))
+
+# Get the run journal for the workspace in the common params
+def get_run_journal(common_params, resume=False):
+    return DatabricksWSRunJournal(get_run_journal_path(common_params), resume)
+
+# Get the path of the record of the pooled resource bundle that the workspace in the common params was created from
+def get_resource_bundle_path(common_params):
+    return os.path.join(common_params.get("run_journal_dir", "./.run_journal"), "{}.bundle.json".format(common_params["workspace_name"]))
+
+# Durably record the pooled resource bundle that the workspace in the common params is created from, so that the
+# stacks and workspace objects of the bundle are found by a resume or a teardown of the workspace
+def save_resource_bundle(common_params, resource_bundle):
+    bundle_path = get_resource_bundle_path(common_params)
+    os.makedirs(os.path.dirname(bundle_path) or '.', exist_ok=True)
+    with open(bundle_path + '.tmp', 'w') as bundle_fileobj:
+        bundle_fileobj.write(json_dumps(resource_bundle))
+        bundle_fileobj.flush()
+        os.fsync(bundle_fileobj.fileno())
+    os.replace(bundle_path + '.tmp', bundle_path)
+
+# Get the recorded resource bundle of the workspace in the common params, or None if it wasn't created from one
+def load_resource_bundle(common_params):
+    bundle_path = get_resource_bundle_path(common_params)
+    if not os.path.exists(bundle_path):
+        return None
+    with open(bundle_path) as bundle_fileobj:
+        return json_loads(bundle_fileobj.read())
+
+# Get the common params of a workspace created from a pooled resource bundle, with the names of the bundle's stacks
+# and workspace objects and the stack parameters they were deployed with
+def apply_resource_bundle(common_params, resource_bundle):
+    return dict(common_params, stack_parameter_overrides=resource_bundle["stack_parameter_overrides"],
+                **resource_bundle["bundle_names"])
+
+# Get the path to export the trace of a run for the workspace in the common params to
+def get_trace_path(common_params):
+    return os.path.join(common_params.get("trace_dir", "./.traces"), "{}.trace.json".format(common_params["workspace_name"]))
+
+# Prepare the AWS infra and the workspace objects for a Databricks E2 workspace - everything but the workspace itself
+# With a run journal, every completed step is recorded and steps completed by a previous run are skipped
+# Returns the ids of the workspace objects, as input data for the workspace
+def prepare_workspace_resources(common_params, ws_prov_utils, ws_accounts_api, step_graph='./stack_graph.json',
+                                run_journal=None):
+    # Create object to process AWS stack outputs - to create input data for Workspace Accounts APIs
+    ws_stack_processor = DatabricksWSStackProcessor()
+
+    # Steps 1 to 8 - Deploy the VPC infra, IAM role, S3 bucket and KMS key cloudformation templates,
+    # and create the workspace credentials, storage config, network and customer managed key objects.
+    # The step graph declares the template, params and upstream stack outputs of each stack. Stacks run
+    # concurrently as soon as their inputs are ready - only the IAM role needs the VPC security group.
+    # Each workspace object is created as soon as the stack it is based on has been created.
+    ws_stack_scheduler = DatabricksWSStackScheduler(ws_prov_utils, common_params.get("max_parallel_stacks", 4), run_journal)
+    stack_steps = ws_stack_scheduler._parse_step_graph(step_graph)
+    # Validate all templates and parameters up front, so that nothing is deployed if any of them is broken
+    with ws_prov_utils.tracer._span('preflight'):
+        DatabricksWSPreflight(ws_prov_utils)._run_preflight(stack_steps, common_params)
+
+    with ThreadPoolExecutor(max_workers=len(stack_steps)) as workspace_object_executor:
+        workspace_object_futures = {}
+
+        # Parse the stack output for the data required by the workspace object, and submit its creation
+        def _on_stack_step_complete(stack_step, created_stack_obj):
+            stack_processor_method = getattr(ws_stack_processor, stack_step["stack_processor"])
+            other_input_data = stack_processor_method(created_stack_obj)
+            workspace_object = stack_step["workspace_object"]
+            workspace_object_futures[workspace_object["id_key"]] = ws_accounts_api._submit_workspace_object(
+                workspace_object_executor, workspace_object["create_method"], common_params, other_input_data,
+                workspace_object["id_key"], run_journal)
+
+        ws_stack_scheduler._deploy_step_graph(stack_steps, common_params, _on_stack_step_complete)
+        return ws_accounts_api._collect_workspace_objects(workspace_object_futures)
+
+# Create the Databricks E2 workspace from the ids of its prepared workspace objects, and wait until it's provisioned
+# Returns the workspace id and its final provisioning status
+def create_workspace(common_params, ws_accounts_api, workspace_input_data, run_journal=None):
+    # Step 9 - Create the workspace itself, unless a previous run already did
+    workspace_id = run_journal._get("workspace", "workspace_id") if run_journal is not None else None
+    if workspace_id is None:
+        workspace_id = ws_accounts_api._create_workspace(common_params, workspace_input_data)
+        if run_journal is not None:
+            run_journal._record("workspace", "workspace_id", workspace_id)
+
+    # Step 10 - Check the workspace provisioning status
+    workspace_prov_status = ws_accounts_api._check_workspace_provisioning(common_params, {"workspace_id": workspace_id})
+    # A workspace still provisioning past its deadline may yet get to RUNNING, so its run stays resumable
+    if run_journal is not None and workspace_prov_status == 'RUNNING':
+        run_journal._complete()
+    elif run_journal is not None and workspace_prov_status != 'PROVISIONING':
+        run_journal._fail(workspace_prov_status)
+    return workspace_id, workspace_prov_status
+
+# Provision the AWS infra and the Databricks E2 workspace for one set of master parameters
+# With a run journal, every completed step is recorded and steps completed by a previous run are skipped
+# Returns the workspace id and its final provisioning status
+def provision_workspace(common_params, ws_prov_utils, ws_accounts_api, step_graph='./stack_graph.json', run_journal=None):
+    # A workspace that was created from a pooled resource bundle, e.g. by a run being resumed, uses the bundle's
+    # workspace objects instead of deploying its own
+    resource_bundle = load_resource_bundle(common_params)
+    if resource_bundle is not None:
+        print("Using the resource bundle {} of workspace {}".format(resource_bundle["bundle_key"], common_params["workspace_name"]))
+        return create_workspace(common_params, ws_accounts_api, resource_bundle["workspace_input_data"], run_journal)
+    workspace_input_data = prepare_workspace_resources(common_params, ws_prov_utils, ws_accounts_api, step_graph, run_journal)
+    return create_workspace(common_params, ws_accounts_api, workspace_input_data, run_journal)
+
+# Update the AWS infra of an existing workspace to the current templates and parameters
+# Only the stacks whose template or parameters changed are updated, and the workspace objects based on
+# stack outputs that changed are replaced. The replaced objects are deleted once the workspace is RUNNING
+# with the replacements. Returns the ids of the replacement workspace objects.
+def update_workspace(common_params, ws_prov_utils, ws_accounts_api, step_graph='./stack_graph.json'):
+    # A workspace created from a pooled resource bundle uses the stacks and workspace objects of the bundle
+    resource_bundle = load_resource_bundle(common_params)
+    if resource_bundle is not None:
+        common_params = apply_resource_bundle(common_params, resource_bundle)
+    ws_stack_processor = DatabricksWSStackProcessor()
+    ws_stack_scheduler = DatabricksWSStackScheduler(ws_prov_utils, common_params.get("max_parallel_stacks", 4))
+    stack_steps = ws_stack_scheduler._parse_step_graph(step_graph)
+    with ws_prov_utils.tracer._span('preflight'):
+        DatabricksWSPreflight(ws_prov_utils)._run_preflight(stack_steps, common_params)
+
+    replaced_input_data = {}
+
+    # Replace the workspace object based on an updated stack, if the data it takes from the stack output changed
+    def _on_stack_step_updated(stack_step, updated_stack_obj, previous_stack_obj):
+        stack_processor_method = getattr(ws_stack_processor, stack_step["stack_processor"])
+        other_input_data = stack_processor_method(updated_stack_obj)
+        if other_input_data == stack_processor_method(previous_stack_obj):
+            return
+        workspace_object = stack_step["workspace_object"]
+        print("Replacing the workspace object for {} as the output of stack step {} changed".format(
+            workspace_object["id_key"], stack_step["step_name"]))
+        replaced_input_data[workspace_object["id_key"]] = ws_accounts_api._create_replacement_workspace_object(
+            common_params, workspace_object, other_input_data)
+
+    ws_stack_scheduler._update_step_graph(stack_steps, common_params, _on_stack_step_updated)
+    if not replaced_input_data:
+        return replaced_input_data
+    workspace_id = ws_accounts_api._get_workspace_id(common_params)
+    workspace_object_ids = ws_accounts_api._get_workspace_object_ids(
+                               ws_accounts_api._find_workspace(dict(common_params, workspace_id=workspace_id)))
+    if ws_accounts_api._update_workspace(common_params, workspace_id, replaced_input_data) is None:
+        return replaced_input_data
+
+    # The workspace uses the replaced objects until the update is applied, so they're only deleted after that
+    workspace_prov_status = ws_accounts_api._check_workspace_provisioning(common_params, {"workspace_id": workspace_id})
+    replaced_object_ids = dict((id_key, workspace_object_ids[id_key]) for id_key in replaced_input_data
+                               if workspace_object_ids.get(id_key) not in (None, replaced_input_data[id_key]))
+    if workspace_prov_status == 'RUNNING':
+        ws_accounts_api._delete_workspace_objects(common_params, replaced_object_ids)
+    else:
+        print("Keeping the replaced workspace objects {} as workspace {} is {} after the update".format(
+            replaced_object_ids, workspace_id, workspace_prov_status))
+    return replaced_input_data
+
+# Tear down a Databricks E2 workspace and its AWS infra, walking the step graph in reverse
+# The workspace is deleted first, then all of its workspace objects at once, and then the stacks - each one as soon as
+# the stacks that take its outputs are gone, so that e.g. the S3 bucket and KMS key stacks are deleted together.
+# Returns the ids of the deleted workspace and workspace objects, and the names of the deleted stacks.
+def teardown_workspace(common_params, ws_prov_utils, ws_accounts_api, step_graph='./stack_graph.json'):
+    ws_stack_processor = DatabricksWSStackProcessor()
+    ws_stack_scheduler = DatabricksWSStackScheduler(ws_prov_utils, common_params.get("max_parallel_stacks", 4))
+    stack_steps = ws_stack_scheduler._parse_step_graph(step_graph)
+    # A workspace created from a pooled resource bundle uses the stacks and workspace objects named after the bundle
+    resource_bundle = load_resource_bundle(common_params)
+    if resource_bundle is not None:
+        print("Tearing down the resource bundle {} of workspace {}".format(resource_bundle["bundle_key"], common_params["workspace_name"]))
+        common_params = apply_resource_bundle(common_params, resource_bundle)
+
+    # Step 1 - Delete the workspace, after getting the ids of the workspace objects it uses
+    workspace = ws_accounts_api._find_workspace(common_params)
+    workspace_id = None
+    workspace_object_ids = {}
+    if workspace is not None:
+        workspace_id = workspace['workspace_id']
+        workspace_object_ids = ws_accounts_api._get_workspace_object_ids(workspace)
+        ws_accounts_api._delete_workspace(common_params, workspace_id)
+    else:
+        print("Skipping the workspace {} as it doesn't exist".format(common_params["workspace_name"]))
+
+    # Step 2 - Delete the workspace objects concurrently. Objects of a run that didn't get to create the
+    # workspace are found by name, or by the stack output they were created from.
+    for stack_step in stack_steps:
+        workspace_object = stack_step["workspace_object"]
+        if workspace_object["id_key"] in workspace_object_ids:
+            continue
+        stack = ws_prov_utils.stack_index._invalidate(common_params[stack_step["stack_name_param"]])
+        other_input_data = None
+        if stack is not None and stack.get('Outputs'):
+            other_input_data = getattr(ws_stack_processor, stack_step["stack_processor"])({'Stacks': [stack]})
+        workspace_object_id = ws_accounts_api._find_workspace_object_id(common_params, workspace_object, other_input_data)
+        if workspace_object_id is not None:
+            workspace_object_ids[workspace_object["id_key"]] = workspace_object_id
+    ws_accounts_api._delete_workspace_objects(common_params, workspace_object_ids)
+
+    # Steps 3 and 4 - Delete the IAM role, S3 bucket and KMS key stacks together, and then the VPC infra stack
+    deleted_stack_objs = ws_stack_scheduler._delete_step_graph(stack_steps, common_params)
+
+    # The journal of an earlier run refers to what was just deleted, so a resume must not reuse it
+    journal_path = get_run_journal_path(common_params)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+        print("Removed the run journal {}".format(journal_path))
+    if resource_bundle is not None:
+        os.remove(get_resource_bundle_path(common_params))
+    return {
+        "workspace_id": workspace_id,
+        "workspace_object_ids": workspace_object_ids,
+        "deleted_stacks": [deleted_stack_obj['Stacks'][0]['StackName'] for deleted_stack_obj in deleted_stack_objs.values()
+                           if deleted_stack_obj is not None]
+    }
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Provision a Databricks AWS E2 workspace and its AWS infra')
+    arg_parser.add_argument('--preflight-only', action='store_true',
+                            help='Only validate the templates and parameters, without deploying anything')
+    arg_parser.add_argument('--update', action='store_true',
+                            help='Update the stacks of an existing workspace whose templates or parameters changed')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='Resume an interrupted run from its journal, reusing the stacks and objects it created')
+    arg_parser.add_argument('--teardown', action='store_true',
+                            help='Delete the workspace, its workspace objects and its stacks')
+    arg_parser.add_argument('--verbose', action='store_true',
+                            help='Print the full description of every created stack instead of a one line summary')
+    args = arg_parser.parse_args()
+
+    # Get the required master parameters to be used below
+    with open('./common_params.json') as parameter_fileobj:
+        parameter_str = parameter_fileobj.read()
+    common_params = json_loads(parameter_str)
+    if args.verbose:
+        common_params["verbose"] = True
+
+    # Create object to trace the phases of the run and the API calls made, shared by both API interfaces
+    tracer = DatabricksWSTracer(common_params["workspace_name"])
+
+    # Create object to invoke utility methods - mostly for cloudformation related interaction
+    ws_prov_utils = DatabricksWSProvisioningUtils(common_params, tracer=tracer)
+    if args.preflight_only:
+        ws_stack_scheduler = DatabricksWSStackScheduler(ws_prov_utils)
+        DatabricksWSPreflight(ws_prov_utils)._run_preflight(ws_stack_scheduler._parse_step_graph('./stack_graph.json'), common_params)
+        exit(0)
+
+    # Create a Databricks Accounts API Client to use for the workspace objects and the workspace
+    ws_accounts_api = DatabricksWSAccountsAPI(common_params, tracer=tracer)
+
+    if args.update:
+        replaced_input_data = update_workspace(common_params, ws_prov_utils, ws_accounts_api)
+        print("Updated the workspace {}, replaced workspace objects are {}".format(common_params["workspace_name"], replaced_input_data))
+        exit(0)
+
+    if args.teardown:
+        try:
+            teardown_result = teardown_workspace(common_params, ws_prov_utils, ws_accounts_api)
+        finally:
+            tracer._print_summary()
+            print("Trace of the run is in {}".format(tracer._export_trace(get_trace_path(common_params))))
+        print("Tore down the workspace {}, deleted {}".format(common_params["workspace_name"], teardown_result))
+        exit(0)
+
+    run_journal = get_run_journal(common_params, args.resume)
+    # The trace is exported even if the run fails, to show where it spent its time until then
+    try:
+        workspace_id, workspace_prov_status = provision_workspace(common_params, ws_prov_utils, ws_accounts_api,
+                                                run_journal=run_journal)
+    finally:
+        tracer._print_summary()
+        print("Trace of the run is in {}".format(tracer._export_trace(get_trace_path(common_params))))
 
-from databricks_cli.sdk import ApiClient
-from databricks_cli.accounts import AccountsApi
-
-# Get the required master parameters to be used below
-with open('./common_params.json') as parameter_fileobj:
-    parameter_str = parameter_fileobj.read()
-common_params = json_loads(parameter_str)
-
-# Create object to invoke utility methods - mostly for cloudformation related interaction
-ws_prov_utils = DatabricksWSProvisioningUtils(common_params)
-# Create object to process AWS stack outputs - to create input data for Workspace Accounts APIs
-ws_stack_processor = DatabricksWSStackProcessor()
-
-# Step 1 - Try and deploy the VPC infra cloudformation template
-# Read and parse the VPC infra cloudformation template body and required params
-vpc_template_data = ws_prov_utils._parse_template('cf_templates/e2-existingvpc-cf_template.json')
-vpc_parameter_data = ws_prov_utils._parse_parameters('cf_template_params/e2-existingvpc-cf_params.json')
-# Add the extra required params
-vpc_parameter_data.append({"ParameterKey": "VpcId","ParameterValue": common_params["vpc_id"]})
-
-# Deploy the VPC infra stack
-created_vpc_stack_obj = ws_prov_utils._deploy_stack(common_params["vpc_stack_name"], 
-                            vpc_template_data, vpc_parameter_data, False)
-
-# Parse the stack output for security group and subnets that're required to create the workspace network object
-network_input_data = ws_stack_processor._process_vpc_stack_output(created_vpc_stack_obj)
-
-# Step 2 - Try and deploy the IAM role cloudformation template
-# Read and parse the IAM role cloudformation template body and required params
-iam_template_data = ws_prov_utils._parse_template('cf_templates/e2-iam_role_with_restricted_and_sg_policy.json')
-iam_parameter_data = ws_prov_utils._parse_parameters('cf_template_params/e2-iam_role_with_restricted_and_sg_policy_params.json')
-# Add the extra required params
-iam_parameter_data.append({"ParameterKey": "DatabricksAWSAccount","ParameterValue": common_params["databricks_aws_account_id"]})
-iam_parameter_data.append({"ParameterKey": "DatabricksE2WorkspaceAccount","ParameterValue": common_params["databricks_workspace_account_id"]})
-iam_parameter_data.append({"ParameterKey": "WorkspaceRegion","ParameterValue": common_params["region_name"]})
-iam_parameter_data.append({"ParameterKey": "WorkspaceVPC","ParameterValue": common_params["vpc_id"]})
-iam_parameter_data.append({"ParameterKey": "WorkspaceSecurityGroup","ParameterValue": network_input_data["security_group_id"]})
-
-# Deploy the IAM role stack
-created_iam_stack_obj = ws_prov_utils._deploy_stack(common_params["iam_stack_name"], 
-                            iam_template_data, iam_parameter_data, True)
-
-# Parse the stack output for IAM role ARN that's needed to create the workspace credentials object
-creds_input_data = ws_stack_processor._process_iam_stack_output(created_iam_stack_obj)
-
-# Step 3 - Create a new S3 root bucket for the Databricks workspace 
-# Also add a policy to be accessible from the Databricks control plane
-# Read and parse the S3 bucket cloudformation template body and required params
-s3_template_data = ws_prov_utils._parse_template('cf_templates/e2-dbfs_root_s3_bucket-cf_template.json')
-s3_parameter_data = ws_prov_utils._parse_parameters('cf_template_params/e2-dbfs_root_s3_bucket-cf_params.json')
-# Add the extra required params
-s3_parameter_data.append({"ParameterKey": "DatabricksAccount","ParameterValue": common_params["databricks_aws_account_id"]})
-
-# Deploy the S3 bucket stack
-created_s3_stack_obj = ws_prov_utils._deploy_stack(common_params["s3_stack_name"], 
-                            s3_template_data, s3_parameter_data, False)
-
-# Parse the stack info for S3 bucket name that's needed to create the workspace storage config object
-storage_config_input_data = ws_stack_processor._process_s3_stack_output(created_s3_stack_obj)
-
-# Step 4 - Try and deploy the KMS key cloudformation template
-# Also add a policy to be accessible from the Databricks control plane
-# Read and parse the KMS key cloudformation template body and required params
-kms_template_data = ws_prov_utils._parse_template('cf_templates/e2-byok_kms_key-cf_template.json')
-kms_parameter_data = ws_prov_utils._parse_parameters('cf_template_params/e2-byok_kms_key-cf_params.json')
-# Add the extra required params
-kms_parameter_data.append({"ParameterKey": "DatabricksAccount","ParameterValue": common_params["databricks_aws_account_id"]})
-
-# Deploy the KMS key stack
-created_kms_stack_obj = ws_prov_utils._deploy_stack(common_params["kms_stack_name"], 
-                            kms_template_data, kms_parameter_data, False)
-
-# Parse the stack info for KMS Key Alias and ARN that're required to create the workspace customer managed key object
-cust_managed_key_input_data = ws_stack_processor._process_kms_stack_output(created_kms_stack_obj)
-
-# Step 5 - Create the workspace credentials object
-# First create a Databricks Accounts API Client to use for further work
-ws_accounts_api = DatabricksWSAccountsAPI(common_params)
-
-credentials_id = ws_accounts_api._create_credentials(common_params, creds_input_data)
-
-# Step 6 - Create the workspace storage config object
-storage_config_id = ws_accounts_api._create_storage_config(common_params, storage_config_input_data)
-
-# Step 7 - Create the workspace network object
-network_id = ws_accounts_api._create_network(common_params, network_input_data)
-
-# Step 8 - Create the workspace customer managed key object
-customer_managed_key_id = ws_accounts_api._create_customer_managed_key(common_params, cust_managed_key_input_data)
-
-# Step 9 - Create the workspace itself
-workspace_input_data = {
-    "credentials_id": credentials_id,
-    "storage_config_id": storage_config_id,
-    "network_id": network_id,
-    "customer_managed_key_id": customer_managed_key_id
-}
-workspace_id = ws_accounts_api._create_workspace(common_params, workspace_input_data)
-
-# Step 10 - Check the workspace provisioning status
-workspace_prov_status = ws_accounts_api._check_workspace_provisioning(common_params, {"workspace_id": workspace_id})
-
-print("Final status for the workspace {} is workspace_prov_status is {}".format(workspace_id, workspace_prov_status))
-if workspace_prov_status == 'RUNNING':
-    deployment_url = "{}://{}.cloud.databricks.com".format("https", common_params["deployment_cname"])
-    print("URL for the workspace is {}".format(deployment_url))
+    print("Final status for the workspace {} is workspace_prov_status is {}".format(workspace_id, workspace_prov_status))
+    if workspace_prov_status == 'RUNNING':
+        deployment_url = "{}://{}.cloud.databricks.com".format("https", common_params["deployment_cname"])
+        print("URL for the workspace is {}".format(deployment_url))
@@ -0,0 +1,275 @@
+# Interface for a pool of pre-provisioned resource bundles for Databricks E2 workspaces
+# A bundle is everything a workspace needs but the workspace itself - the VPC infra, IAM role, S3 bucket and KMS key
+# stacks, and the credentials, storage config, network and customer managed key objects based on them. Bundles are
+# prepared in the background under names of their own, so that a workspace request only pays for creating the
+# workspace and waiting for it. The workspace takes over the names of its bundle's stacks and workspace objects.
+# Bundles older than the TTL are torn down and replaced, so that they don't drift from the current templates. The pool
+# is kept in a state file to outlive the process, and bundles that were still being prepared or torn down when the
+# process stopped are torn down on the next start.
+
+import os
+import threading
+import time
+import uuid
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps, loads as json_loads
+
+from dbx_ws_fleet_provisioner import DatabricksWSFleetProvisioner
+from dbx_ws_provisioner import prepare_workspace_resources, teardown_workspace
+from dbx_ws_stack_scheduler import DatabricksWSStackScheduler
+from dbx_ws_tracer import DatabricksWSTracer
+
+# Common params that a workspace must share with the pool to be created from one of its bundles
+BUNDLE_PARAM_KEYS = ['region_name', 'vpc_id', 'databricks_aws_account_id', 'databricks_workspace_account_id', 'api_user']
+
+class DatabricksWSResourcePool(object):
+
+    # Up to target_size bundles are kept ready or being prepared, at most max_parallel_refills of them at once.
+    # Names of a bundle are the default names suffixed by its key, and bundle_overrides give the stack parameters that
+    # must differ between bundles, formatted with the bundle key and a bundle index that wraps at 256 for use in CIDRs,
+    # e.g. {"s3.BucketName": "my-dbfs-{bundle_key}", "vpc.Subnet1Cidr": "10.173.{bundle_index}.0/25"}.
+    def __init__(self, defaults, client_pool, target_size=2, ttl_hours=24, max_parallel_refills=2,
+                 step_graph='./stack_graph.json', state_path='./.resource_pool/pool.json', key_prefix='pool-',
+                 bundle_overrides=None, min_retry_delay=30, max_retry_delay=600):
+        self.defaults = defaults
+        self.target_size = target_size
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_parallel_refills = max_parallel_refills
+        self.step_graph = step_graph
+        self.state_path = state_path
+        self.key_prefix = key_prefix
+        self.bundle_overrides = bundle_overrides or {}
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        # Used for its parameter layering and its interfaces on the shared clients
+        self.ws_fleet_provisioner = DatabricksWSFleetProvisioner(defaults, client_pool, step_graph=step_graph)
+        self.stack_steps = DatabricksWSStackScheduler(None)._parse_step_graph(step_graph)
+        # The stack and workspace object names of a bundle, which a workspace created from it takes over
+        self.bundle_name_params = []
+        for stack_step in self.stack_steps:
+            self.bundle_name_params += [stack_step["stack_name_param"], stack_step["workspace_object"]["name_param"]]
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel_refills * 2)
+        # Ready bundles, oldest first, and the indexes of the bundles being prepared or torn down by their keys
+        self.ready_bundles = []
+        self.preparing_bundles = {}
+        self.recycling_bundles = {}
+        self.next_bundle_index = 0
+        # Times at which a bundle was taken or recycled and not yet replaced, oldest first
+        self.deficit_times = []
+        self.refill_lags = deque(maxlen=1000)
+        self.refill_retry_at = 0
+        self.retry_delay = min_retry_delay
+        self.pool_counters = {"requests": 0, "hits": 0, "misses": 0, "refills": 0, "refill_failures": 0,
+                              "recycled": 0, "recycle_failures": 0}
+        self.is_stopped = False
+        self.pool_condition = threading.Condition()
+        self.refill_thread = None
+
+    # Get the common params of a bundle, with names unique to it
+    def _get_bundle_params(self, bundle_key, bundle_index=0):
+        manifest_row = {"workspace_key": bundle_key}
+        for param_key, param_value in self.bundle_overrides.items():
+            manifest_row[param_key] = param_value.format(bundle_key=bundle_key, bundle_index=bundle_index)
+        bundle_params = self.ws_fleet_provisioner._build_common_params(manifest_row)
+        for name_param in ["workspace_name"] + self.bundle_name_params:
+            if bundle_key not in bundle_params[name_param]:
+                bundle_params[name_param] = '{}-{}'.format(bundle_params[name_param], bundle_key)
+        return bundle_params
+
+    # Check if a workspace can be created from a bundle - it must be in the pool's region and account, and must not
+    # override any stack parameters
+    def _can_use_bundle(self, common_params):
+        if any(common_params.get(param_key) != self.defaults.get(param_key) for param_key in BUNDLE_PARAM_KEYS):
+            return False
+        return common_params.get("stack_parameter_overrides", {}) == self.defaults.get("stack_parameter_overrides", {})
+
+    def _is_expired(self, resource_bundle):
+        return time.time() - resource_bundle["prepared_at"] > self.ttl_seconds
+
+    # Write the pool to its state file. Must be called with the pool's lock held.
+    def _save_state(self):
+        pool_state = {
+            "ready": self.ready_bundles,
+            "preparing": self.preparing_bundles,
+            "recycling": self.recycling_bundles,
+            "next_bundle_index": self.next_bundle_index
+        }
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        with open(self.state_path + '.tmp', 'w') as state_fileobj:
+            state_fileobj.write(json_dumps(pool_state))
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    # Read the pool from its state file. Bundles that were being prepared or torn down are torn down again.
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as state_fileobj:
+            pool_state = json_loads(state_fileobj.read())
+        with self.pool_condition:
+            self.ready_bundles = pool_state.get("ready", [])
+            self.next_bundle_index = pool_state.get("next_bundle_index", 0)
+            for bundle_states in (pool_state.get("preparing", {}), pool_state.get("recycling", {})):
+                for bundle_key, bundle_index in bundle_states.items():
+                    self._submit_recycle(bundle_key, bundle_index)
+        print("Loaded {} ready resource bundles from {}".format(len(self.ready_bundles), self.state_path))
+
+    # Load the pool and start refilling it in the background
+    def _start(self):
+        self._load_state()
+        with self.pool_condition:
+            self.refill_thread = threading.Thread(target=self._refill_loop, name='resource-pool-refill', daemon=True)
+            self.refill_thread.start()
+
+    # Stop refilling the pool. Bundles already being prepared or torn down are finished, in the background unless
+    # wait is set, and the queued ones are torn down on the next start.
+    def _stop(self, wait=False):
+        with self.pool_condition:
+            self.is_stopped = True
+            self.pool_condition.notify_all()
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    # Take a ready bundle for a workspace, the oldest one first. Returns None if the pool has none for it.
+    def _take_bundle(self, common_params):
+        with self.pool_condition:
+            self.pool_counters["requests"] += 1
+            resource_bundle = None
+            if self._can_use_bundle(common_params):
+                resource_bundle = next((ready_bundle for ready_bundle in self.ready_bundles
+                                        if not self._is_expired(ready_bundle)), None)
+            if resource_bundle is None:
+                self.pool_counters["misses"] += 1
+                return None
+            self.ready_bundles.remove(resource_bundle)
+            self.pool_counters["hits"] += 1
+            self.deficit_times.append(time.time())
+            self._save_state()
+            self.pool_condition.notify_all()
+        print("Creating workspace {} from resource bundle {}".format(common_params["workspace_name"], resource_bundle["bundle_key"]))
+        return resource_bundle
+
+    # Give back a bundle that was taken for a workspace which was never created. The bundle is torn down and replaced
+    # rather than made ready again, as a failed create may have left it half used.
+    def _discard_bundle(self, resource_bundle):
+        with self.pool_condition:
+            self._submit_recycle(resource_bundle["bundle_key"], resource_bundle["bundle_index"])
+            self._save_state()
+            self.pool_condition.notify_all()
+        print("Discarded resource bundle {}".format(resource_bundle["bundle_key"]))
+
+    # Wait until the pool has at least the given number of ready bundles. Returns False if the timeout passed first.
+    def _wait_until_ready(self, ready_count, timeout_seconds=None):
+        with self.pool_condition:
+            return self.pool_condition.wait_for(lambda: len(self.ready_bundles) >= ready_count, timeout_seconds)
+
+    # Submit the teardown of a bundle. Must be called with the pool's lock held.
+    def _submit_recycle(self, bundle_key, bundle_index):
+        self.recycling_bundles[bundle_key] = bundle_index
+        if not self.is_stopped:
+            self.executor.submit(self._recycle_bundle, bundle_key, bundle_index)
+
+    # Prepare the stacks and workspace objects of a new bundle. A bundle that fails is torn down, and the next one
+    # is only started after a backoff.
+    def _prepare_bundle(self, bundle_key, bundle_index, needed_at):
+        bundle_params = self._get_bundle_params(bundle_key, bundle_index)
+        print("Preparing resource bundle {}".format(bundle_key))
+        try:
+            ws_prov_utils, ws_accounts_api = self.ws_fleet_provisioner._get_provisioning_apis(
+                                                 bundle_params, DatabricksWSTracer(bundle_params["workspace_name"]))
+            workspace_input_data = prepare_workspace_resources(bundle_params, ws_prov_utils, ws_accounts_api, self.step_graph)
+        # The pipeline exits on most failures, which must only fail this bundle and not the pool
+        except (Exception, SystemExit) as ex:
+            print("Preparing resource bundle {} failed with {!r}, tearing it down".format(bundle_key, ex))
+            with self.pool_condition:
+                del self.preparing_bundles[bundle_key]
+                self.pool_counters["refill_failures"] += 1
+                self.deficit_times.insert(0, needed_at)
+                self.refill_retry_at = time.time() + self.retry_delay
+                self.retry_delay = min(self.retry_delay * 2, self.max_retry_delay)
+                self._submit_recycle(bundle_key, bundle_index)
+                self._save_state()
+                self.pool_condition.notify_all()
+            return
+
+        with self.pool_condition:
+            del self.preparing_bundles[bundle_key]
+            self.ready_bundles.append({
+                "bundle_key": bundle_key,
+                "bundle_index": bundle_index,
+                "stack_names": dict((stack_step["stack_name_param"], bundle_params[stack_step["stack_name_param"]])
+                                    for stack_step in self.stack_steps),
+                "bundle_names": dict((name_param, bundle_params[name_param]) for name_param in self.bundle_name_params),
+                "stack_parameter_overrides": bundle_params.get("stack_parameter_overrides", {}),
+                "workspace_input_data": workspace_input_data,
+                "prepared_at": time.time()
+            })
+            self.refill_lags.append(time.time() - needed_at)
+            self.pool_counters["refills"] += 1
+            self.retry_delay = self.min_retry_delay
+            self._save_state()
+            self.pool_condition.notify_all()
+        print("Resource bundle {} is ready".format(bundle_key))
+
+    # Tear down the stacks and workspace objects of a bundle. One that fails is torn down again on the next start.
+    def _recycle_bundle(self, bundle_key, bundle_index):
+        bundle_params = self._get_bundle_params(bundle_key, bundle_index)
+        print("Recycling resource bundle {}".format(bundle_key))
+        try:
+            ws_prov_utils, ws_accounts_api = self.ws_fleet_provisioner._get_provisioning_apis(
+                                                 bundle_params, DatabricksWSTracer(bundle_params["workspace_name"]))
+            teardown_workspace(bundle_params, ws_prov_utils, ws_accounts_api, self.step_graph)
+        except (Exception, SystemExit) as ex:
+            print("Recycling resource bundle {} failed with {!r}, it's retried on the next start".format(bundle_key, ex))
+            with self.pool_condition:
+                self.pool_counters["recycle_failures"] += 1
+            return
+
+        with self.pool_condition:
+            del self.recycling_bundles[bundle_key]
+            self.pool_counters["recycled"] += 1
+            self._save_state()
+
+    # Recycle the expired bundles and start preparing new ones until the pool is at its target size, whenever a
+    # bundle is taken or ready, and when the next bundle expires
+    def _refill_loop(self):
+        while True:
+            with self.pool_condition:
+                if self.is_stopped:
+                    return
+                for ready_bundle in [ready_bundle for ready_bundle in self.ready_bundles if self._is_expired(ready_bundle)]:
+                    print("Resource bundle {} is older than its TTL".format(ready_bundle["bundle_key"]))
+                    self.ready_bundles.remove(ready_bundle)
+                    self.deficit_times.append(time.time())
+                    self._submit_recycle(ready_bundle["bundle_key"], ready_bundle["bundle_index"])
+
+                while (len(self.ready_bundles) + len(self.preparing_bundles) < self.target_size
+                       and len(self.preparing_bundles) < self.max_parallel_refills and time.time() >= self.refill_retry_at):
+                    bundle_key = '{}{}'.format(self.key_prefix, uuid.uuid4().hex[:8])
+                    bundle_index = self.next_bundle_index
+                    self.next_bundle_index = (self.next_bundle_index + 1) % 256
+                    needed_at = self.deficit_times.pop(0) if self.deficit_times else time.time()
+                    self.preparing_bundles[bundle_key] = bundle_index
+                    self.executor.submit(self._prepare_bundle, bundle_key, bundle_index, needed_at)
+                self._save_state()
+
+                wake_times = [ready_bundle["prepared_at"] + self.ttl_seconds for ready_bundle in self.ready_bundles]
+                if self.refill_retry_at > time.time():
+                    wake_times.append(self.refill_retry_at)
+                self.pool_condition.wait(max(min(wake_times) - time.time(), 0.01) if wake_times else None)
+
+    # Get the metrics of the pool - its size, the hit rate of workspace requests, and the lag of refills
+    # (the time from a bundle being taken or recycled until its replacement is ready)
+    def _get_metrics(self):
+        with self.pool_condition:
+            pool_metrics = dict(self.pool_counters, target_size=self.target_size, ready=len(self.ready_bundles),
+                                preparing=len(self.preparing_bundles), recycling=len(self.recycling_bundles))
+            refill_lags = sorted(self.refill_lags)
+        served_requests = pool_metrics["hits"] + pool_metrics["misses"]
+        pool_metrics["hit_rate"] = round(pool_metrics["hits"] / served_requests, 3) if served_requests else None
+        if refill_lags:
+            for percentile in (50, 95):
+                percentile_index = min(len(refill_lags) - 1, int(round(percentile / 100 * (len(refill_lags) - 1))))
+                pool_metrics["p{}_refill_lag_seconds".format(percentile)] = round(refill_lags[percentile_index], 3)
+            pool_metrics["max_refill_lag_seconds"] = round(refill_lags[-1], 3)
+        return pool_metrics
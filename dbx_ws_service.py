@@ -0,0 +1,385 @@
+# Long-running service to provision Databricks AWS E2 workspaces on request, over a local HTTP API.
+# The service keeps one client pool for all requests, so that the cloudformation and Accounts API clients and their
+# connections stay warm between workspaces. It listens on a TCP port of localhost, where every request must carry the
+# service token as "Authorization: Bearer <token>", or on a Unix socket that only the service's user can connect to.
+# With a resource pool, new workspaces are created from prepared bundles of stacks and workspace objects when possible.
+#
+#   POST /workspaces                    Provision a workspace. The body holds its common params, which are layered on
+#                                       the defaults like a row of a fleet manifest - only the names, region, VPC and
+#                                       stack parameters in REQUEST_PARAM_KEYS can be overridden. Add ?resume=1 to
+#                                       resume an interrupted run, or ?update=1 to update an existing workspace.
+#   GET  /workspaces/<request_id>        Get the status of a request, and its result once it's done
+#   GET  /workspaces/<request_id>/events Stream the progress of a request as JSON lines until it's done
+#   GET  /health                         Check that the service is up, and get the Accounts API transport counters
+#                                       and the resource pool metrics
+
+import argparse
+import hmac
+import os
+import re
+import secrets
+import socketserver
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as json_dumps, loads as json_loads
+from urllib.parse import parse_qs, urlparse
+
+from dbx_ws_client_pool import DatabricksWSClientPool
+from dbx_ws_fleet_provisioner import DatabricksWSFleetProvisioner
+from dbx_ws_resource_pool import DatabricksWSResourcePool
+from dbx_ws_tracer import DatabricksWSTracer
+
+# Common params a request may override. Everything else, e.g. the API credentials and the journal and trace
+# directories, comes from the defaults of the service. Stack parameters can be overridden as <step_name>.<ParameterKey>.
+REQUEST_PARAM_KEYS = ['workspace_key', 'workspace_name', 'deployment_cname', 'region_name', 'vpc_id',
+                      'vpc_stack_name', 'iam_stack_name', 's3_stack_name', 'kms_stack_name', 'credentials_name',
+                      'storage_config_name', 'network_name', 'customer_managed_key_name', 'stack_parameter_overrides']
+# Pattern of the workspace names a request may give
+WORKSPACE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,99}$')
+
+# Raised for a request for a workspace that another request is still queued or running for
+class DatabricksWSRequestConflict(Exception):
+
+    def __init__(self, workspace_name, request_id):
+        super().__init__("Request {} for workspace {} is still queued or running".format(request_id, workspace_name))
+        self.request_id = request_id
+
+class DatabricksWSProvisioningService(object):
+
+    # With a service token, requests over the TCP port must carry it. step_graph also gives the step names that
+    # stack parameter overrides of a request may refer to.
+    def __init__(self, defaults, client_pool, max_workspaces=10, max_workspaces_per_region=5,
+                 step_graph='./stack_graph.json', max_finished_requests=1000, resource_pool=None, service_token=None):
+        self.defaults = defaults
+        self.client_pool = client_pool
+        self.resource_pool = resource_pool
+        self.service_token = service_token
+        self.max_workspaces = max_workspaces
+        self.max_workspaces_per_region = max_workspaces_per_region
+        self.max_finished_requests = max_finished_requests
+        # One fleet provisioner per mode, all of them on the same client pool
+        self.ws_fleet_provisioners = dict(((resume, update), DatabricksWSFleetProvisioner(defaults, client_pool,
+                                              max_workspaces, max_workspaces_per_region, step_graph, resume, update,
+                                              resource_pool=resource_pool))
+                                          for resume in (False, True) for update in (False, True))
+        with open(step_graph) as step_graph_fileobj:
+            self.step_names = [step["step_name"] for step in json_loads(step_graph_fileobj.read())]
+        self.executor = ThreadPoolExecutor(max_workers=max_workspaces)
+        # Requests waiting for a slot in the global or per-region cap, in order of arrival
+        self.queued_requests = []
+        self.running_per_region = {}
+        # Requests keyed by id, with their status, progress events and result
+        self.service_requests = {}
+        self.finished_request_ids = []
+        self.service_condition = threading.Condition()
+
+    # Create the clients of the default region and API user, and make a first call with each, so that the
+    # first request doesn't pay for the client setup and the TLS handshakes
+    def _warm_up(self):
+        print("Warming up the clients for {} and {}".format(self.defaults["region_name"], self.defaults["api_user"]))
+        try:
+            self.client_pool._get_stack_poller(self.defaults["region_name"])
+            self.client_pool._get_stack_index(self.defaults["region_name"])._refresh()
+            self.client_pool._get_workspace_watcher(self.defaults)
+            accounts_api_client = self.client_pool._get_accounts_api_client(self.defaults)
+            if hasattr(accounts_api_client, 'list_workspaces'):
+                accounts_api_client.list_workspaces(self.defaults["databricks_workspace_account_id"])
+        except Exception as ex:
+            print("Warming up the clients failed with {!r}, they will be set up on the first request".format(ex))
+
+    # Add a progress event to a request, and wake up the streams following it
+    def _add_event(self, request_id, progress_record):
+        with self.service_condition:
+            progress_record = dict(progress_record, time=round(time.time(), 3))
+            self.service_requests[request_id]["events"].append(progress_record)
+            self.service_condition.notify_all()
+
+    # Check that a request only overrides the params it may. Raises a ValueError for a request that can't be accepted.
+    def _validate_request(self, manifest_row):
+        if not isinstance(manifest_row, dict):
+            raise ValueError("The request body must be a JSON object")
+        for param_key, param_value in manifest_row.items():
+            if '.' in param_key:
+                step_name = param_key.split('.', 1)[0]
+                if step_name not in self.step_names:
+                    raise ValueError("Stack parameter {} refers to unknown step {}".format(param_key, step_name))
+            elif param_key not in REQUEST_PARAM_KEYS:
+                raise ValueError("Param {} can't be overridden by a request".format(param_key))
+            if param_key != 'stack_parameter_overrides' and not isinstance(param_value, (str, int, float)):
+                raise ValueError("Param {} must be a string or a number".format(param_key))
+        stack_parameter_overrides = manifest_row.get("stack_parameter_overrides", {})
+        if not isinstance(stack_parameter_overrides, dict):
+            raise ValueError("Stack parameter overrides must map step names to parameters")
+        for step_name, step_overrides in stack_parameter_overrides.items():
+            if step_name not in self.step_names or not isinstance(step_overrides, dict):
+                raise ValueError("Stack parameter overrides for step {} must be parameters of a known step".format(step_name))
+
+    # Check if an HTTP request carries the service token, if the service has one
+    def _is_authorized(self, authorization_header):
+        if self.service_token is None:
+            return True
+        return hmac.compare_digest((authorization_header or '').encode('utf-8'),
+                                   'Bearer {}'.format(self.service_token).encode('utf-8'))
+
+    # Accept a provisioning request and queue it. Returns the request id. Requests for the same workspace would share
+    # its journal, stacks and workspace, so a request for a workspace that another one is queued or running for raises
+    # a DatabricksWSRequestConflict.
+    def _submit(self, manifest_row, resume=False, update=False):
+        ws_fleet_provisioner = self.ws_fleet_provisioners[(resume, update)]
+        self._validate_request(manifest_row)
+        common_params = ws_fleet_provisioner._build_common_params(manifest_row)
+        # Workspace names are used in the paths of journals and traces, so they must not be able to leave those directories
+        if not WORKSPACE_NAME_PATTERN.match(str(common_params["workspace_name"])):
+            raise ValueError("Workspace name {!r} must only have letters, digits, dots, dashes and underscores".format(
+                common_params["workspace_name"]))
+        request_id = str(uuid.uuid4())
+        with self.service_condition:
+            for service_request in self.service_requests.values():
+                if (service_request["workspace_name"] == common_params["workspace_name"]
+                        and service_request["status"] in ('QUEUED', 'RUNNING')):
+                    raise DatabricksWSRequestConflict(common_params["workspace_name"], service_request["request_id"])
+            self.service_requests[request_id] = {
+                "request_id": request_id,
+                "workspace_name": common_params["workspace_name"],
+                "region_name": common_params["region_name"],
+                "status": 'QUEUED',
+                "submitted_at": round(time.time(), 3),
+                "events": [],
+                "result": None
+            }
+        self._add_event(request_id, {"event": 'queued'})
+        with self.service_condition:
+            self.queued_requests.append((request_id, ws_fleet_provisioner, common_params))
+            self._start_queued_requests()
+        return request_id
+
+    # Start the queued requests in order of arrival, as long as the global and per-region caps allow. A request whose
+    # region is at its cap stays queued without holding up the requests of other regions, and a started request
+    # never waits for a worker. Must be called with the service condition held.
+    def _start_queued_requests(self):
+        for queued_request in list(self.queued_requests):
+            if sum(self.running_per_region.values()) >= self.max_workspaces:
+                break
+            region_name = queued_request[2]["region_name"]
+            if self.running_per_region.get(region_name, 0) >= self.max_workspaces_per_region:
+                continue
+            self.queued_requests.remove(queued_request)
+            self.running_per_region[region_name] = self.running_per_region.get(region_name, 0) + 1
+            self.executor.submit(self._run_request, *queued_request)
+
+    # Provision the workspace of a request, reporting its spans as progress events
+    def _run_request(self, request_id, ws_fleet_provisioner, common_params):
+        workspace_result = {"workspace_name": common_params["workspace_name"], "region_name": common_params["region_name"],
+                            "workspace_id": None, "workspace_status": None, "error": None}
+        try:
+            with self.service_condition:
+                self.service_requests[request_id]["status"] = 'RUNNING'
+            self._add_event(request_id, {"event": 'started'})
+            tracer = DatabricksWSTracer(common_params["workspace_name"],
+                        lambda span_event, progress_record: self._add_event(request_id, progress_record))
+            workspace_result = ws_fleet_provisioner._run_workspace(common_params, tracer)
+        # A request that fails outside of its pipeline must still finish, so that it releases its workspace name
+        except (Exception, SystemExit) as ex:
+            workspace_result["error"] = repr(ex)
+        finally:
+            with self.service_condition:
+                self.running_per_region[common_params["region_name"]] -= 1
+                self._start_queued_requests()
+
+        # The condition's lock is reentrant, so the finished event is added together with the result
+        with self.service_condition:
+            self.service_requests[request_id]["result"] = workspace_result
+            self.service_requests[request_id]["status"] = 'FAILED' if workspace_result["error"] else 'DONE'
+            # Only the most recent finished requests are kept
+            self.finished_request_ids.append(request_id)
+            while len(self.finished_request_ids) > self.max_finished_requests:
+                self.service_requests.pop(self.finished_request_ids.pop(0), None)
+            self._add_event(request_id, {"event": 'finished', "workspace_status": workspace_result["workspace_status"],
+                                         "error": workspace_result["error"]})
+
+    # Get the status and result of a request without its events, or None if it's unknown
+    def _get_request(self, request_id):
+        with self.service_condition:
+            service_request = self.service_requests.get(request_id)
+            if service_request is None:
+                return None
+            return dict((key, value) for key, value in service_request.items() if key != "events")
+
+    # Yield the progress events of a request as they arrive, until it's finished
+    def _follow_events(self, request_id):
+        next_event_index = 0
+        while True:
+            with self.service_condition:
+                service_request = self.service_requests.get(request_id)
+                if service_request is None:
+                    return
+                while next_event_index >= len(service_request["events"]) and service_request["status"] in ('QUEUED', 'RUNNING'):
+                    self.service_condition.wait(timeout=30)
+                new_events = service_request["events"][next_event_index:]
+                is_finished = service_request["status"] not in ('QUEUED', 'RUNNING')
+            next_event_index += len(new_events)
+            for progress_record in new_events:
+                yield progress_record
+            if is_finished and not new_events:
+                return
+
+    # Get the HTTP server for the service, on a Unix socket if a path is given and on a localhost port otherwise
+    def _get_server(self, port=8470, unix_socket=None):
+        ws_service = self
+
+        class DatabricksWSRequestHandler(BaseHTTPRequestHandler):
+
+            def _send_json(self, status_code, response_data):
+                response_body = json_dumps(response_data, default=str).encode('utf-8')
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            # Check the service token, and send a 401 if it's missing or wrong
+            def _check_authorized(self):
+                if ws_service._is_authorized(self.headers.get('Authorization')):
+                    return True
+                self._send_json(401, {"error": 'Missing or invalid service token'})
+                return False
+
+            def do_POST(self):
+                if not self._check_authorized():
+                    return
+                request_url = urlparse(self.path)
+                if request_url.path != '/workspaces':
+                    return self._send_json(404, {"error": 'Unknown path {}'.format(request_url.path)})
+                query_params = parse_qs(request_url.query)
+                try:
+                    manifest_row = json_loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    request_id = ws_service._submit(manifest_row, query_params.get('resume') == ['1'],
+                                                    query_params.get('update') == ['1'])
+                except DatabricksWSRequestConflict as ex:
+                    return self._send_json(409, {"error": str(ex), "request_id": ex.request_id})
+                except (KeyError, ValueError) as ex:
+                    return self._send_json(400, {"error": 'Invalid request: {!r}'.format(ex)})
+                self._send_json(202, {"request_id": request_id})
+
+            def do_GET(self):
+                if not self._check_authorized():
+                    return
+                path_parts = urlparse(self.path).path.strip('/').split('/')
+                if path_parts == ['health']:
+                    health_data = {"status": 'OK'}
+                    if hasattr(ws_service.client_pool, '_get_accounts_api_counters'):
+                        health_data["accounts_api_counters"] = ws_service.client_pool._get_accounts_api_counters()
+                    if ws_service.resource_pool is not None:
+                        health_data["resource_pool"] = ws_service.resource_pool._get_metrics()
+                    return self._send_json(200, health_data)
+                if len(path_parts) < 2 or path_parts[0] != 'workspaces' or ws_service._get_request(path_parts[1]) is None:
+                    return self._send_json(404, {"error": 'Unknown request {}'.format(self.path)})
+                if len(path_parts) == 2:
+                    return self._send_json(200, ws_service._get_request(path_parts[1]))
+                if path_parts[2:] != ['events']:
+                    return self._send_json(404, {"error": 'Unknown path {}'.format(self.path)})
+
+                # Stream the events as JSON lines, and close the connection once the request is finished
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                try:
+                    for progress_record in ws_service._follow_events(path_parts[1]):
+                        self.wfile.write((json_dumps(progress_record, default=str) + '\n').encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            # Unix socket clients have no address
+            def address_string(self):
+                return self.client_address[0] if self.client_address else unix_socket
+
+        if unix_socket is None:
+            return ThreadingHTTPServer(('127.0.0.1', port), DatabricksWSRequestHandler)
+
+        class DatabricksWSUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+            # HTTPServer.server_bind expects a host and port, which a Unix socket doesn't have
+            def server_bind(self):
+                socketserver.UnixStreamServer.server_bind(self)
+                self.server_name = 'localhost'
+                self.server_port = 0
+
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        # Only the user running the service can connect to the socket, which stands in for the token
+        previous_umask = os.umask(0o177)
+        try:
+            return DatabricksWSUnixHTTPServer(unix_socket, DatabricksWSRequestHandler)
+        finally:
+            os.umask(previous_umask)
+
+# Get the token that requests to the service's TCP port must carry - from the DBX_WS_SERVICE_TOKEN environment variable,
+# or else a new random one written to a file that only the current user can read
+def get_service_token(token_path):
+    service_token = os.environ.get("DBX_WS_SERVICE_TOKEN")
+    if service_token:
+        return service_token
+    service_token = secrets.token_urlsafe(32)
+    if os.path.exists(token_path):
+        os.remove(token_path)
+    token_fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(token_fd, 'w') as token_fileobj:
+        token_fileobj.write(service_token)
+    print("Service token is in {}".format(token_path))
+    return service_token
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Serve provisioning of Databricks AWS E2 workspaces over a local HTTP API')
+    arg_parser.add_argument('--defaults', default='./common_params.json', help='Shared default master parameters')
+    arg_parser.add_argument('--step-graph', default='./stack_graph.json', help='Step graph of the stacks to deploy')
+    arg_parser.add_argument('--port', type=int, default=8470, help='Port on localhost to listen on')
+    arg_parser.add_argument('--unix-socket', help='Path of a Unix socket to listen on instead of a port')
+    arg_parser.add_argument('--token-file', default='./.service_token',
+                            help='File to write the service token for the port to, unless DBX_WS_SERVICE_TOKEN is set')
+    arg_parser.add_argument('--max-workspaces', type=int, default=10, help='Max workspaces provisioned at once')
+    arg_parser.add_argument('--max-workspaces-per-region', type=int, default=5,
+                            help='Max workspaces provisioned at once in a single region')
+    arg_parser.add_argument('--resource-pool-size', type=int,
+                            help='Resource bundles to keep prepared for new workspaces, defaults to resource_pool_size')
+    args = arg_parser.parse_args()
+
+    with open(args.defaults) as parameter_fileobj:
+        parameter_str = parameter_fileobj.read()
+    defaults = json_loads(parameter_str)
+
+    client_pool = DatabricksWSClientPool(max_pool_connections=args.max_workspaces_per_region * defaults.get("max_parallel_stacks", 4),
+                                         accounts_api_rate_per_second=defaults.get("accounts_api_rate_per_second", 5),
+                                         accounts_api_burst=defaults.get("accounts_api_burst", 10),
+                                         rate_limit_dir=defaults.get("rate_limit_dir"))
+    resource_pool = None
+    resource_pool_size = args.resource_pool_size if args.resource_pool_size is not None else defaults.get("resource_pool_size", 0)
+    if resource_pool_size > 0:
+        resource_pool = DatabricksWSResourcePool(defaults, client_pool, resource_pool_size,
+                            defaults.get("resource_pool_ttl_hours", 24), defaults.get("max_parallel_refills", 2), args.step_graph,
+                            os.path.join(defaults.get("resource_pool_dir", "./.resource_pool"), '{}.json'.format(defaults["region_name"])),
+                            bundle_overrides=defaults.get("resource_pool_overrides"))
+    # Requests over the Unix socket are already limited to the service's user by the socket's permissions
+    service_token = get_service_token(args.token_file) if args.unix_socket is None else None
+    ws_service = DatabricksWSProvisioningService(defaults, client_pool, args.max_workspaces,
+                                                 args.max_workspaces_per_region, args.step_graph,
+                                                 resource_pool=resource_pool, service_token=service_token)
+    ws_service._warm_up()
+    if resource_pool is not None:
+        resource_pool._start()
+
+    service_server = ws_service._get_server(args.port, args.unix_socket)
+    print("Serving workspace provisioning on {}".format(args.unix_socket or 'http://127.0.0.1:{}'.format(args.port)))
+    try:
+        service_server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping the service, provisioning requests in progress are resumable from their journals")
+    finally:
+        service_server.server_close()
+        if resource_pool is not None:
+            resource_pool._stop()
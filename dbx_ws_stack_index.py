@@ -0,0 +1,89 @@
+# Interface for an in-memory index of AWS cloudformation stacks, keyed by stack name
+# Built with one paginated sweep over all stacks that are not deleted, and holds their status and outputs
+
+import threading
+import time
+
+import botocore
+
+class DatabricksWSStackIndex(object):
+
+    def __init__(self, cf_client, ttl_seconds=60):
+        self.cf_client = cf_client
+        self.ttl_seconds = ttl_seconds
+        self.stacks = {}
+        self.refreshed_at = None
+        # Times at which single stacks were last refreshed, so that a sweep doesn't bring back an older state of them
+        self.invalidated_at = {}
+        self.index_lock = threading.Lock()
+        # Held during a full sweep, so that concurrent lookups on a stale index trigger only one sweep
+        self.refresh_lock = threading.Lock()
+
+    # Rebuild the index with one paginated sweep. describe_stacks without a stack name only returns the stacks
+    # that are not deleted, and unlike list_stacks it includes their outputs. Stacks refreshed on their own while
+    # the sweep ran keep that newer state.
+    def _refresh(self):
+        refresh_started_at = time.time()
+        stacks = {}
+        for stacks_page in self.cf_client.get_paginator('describe_stacks').paginate():
+            for stack in stacks_page['Stacks']:
+                if stack['StackStatus'] == 'DELETE_COMPLETE':
+                    continue
+                stacks[stack['StackName']] = stack
+        with self.index_lock:
+            for stack_name, invalidated_at in list(self.invalidated_at.items()):
+                if invalidated_at < refresh_started_at:
+                    del self.invalidated_at[stack_name]
+                elif stack_name in self.stacks:
+                    stacks[stack_name] = self.stacks[stack_name]
+                else:
+                    stacks.pop(stack_name, None)
+            self.stacks = stacks
+            self.refreshed_at = time.time()
+
+    # Rebuild the index if it was never built or is older than the TTL
+    def _refresh_if_stale(self):
+        with self.refresh_lock:
+            with self.index_lock:
+                is_stale = self.refreshed_at is None or time.time() - self.refreshed_at > self.ttl_seconds
+            if is_stale:
+                self._refresh()
+
+    # Refresh a single stack in the index, e.g. after creating or updating it. Returns the stack or None.
+    def _invalidate(self, stack_name):
+        try:
+            stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        except botocore.exceptions.ClientError as ex:
+            if 'does not exist' not in ex.response['Error']['Message']:
+                raise
+            stack = None
+        with self.index_lock:
+            self.invalidated_at[stack_name] = time.time()
+            if stack is None or stack['StackStatus'] == 'DELETE_COMPLETE':
+                self.stacks.pop(stack_name, None)
+                stack = None
+            else:
+                self.stacks[stack_name] = stack
+        return stack
+
+    # Get a stack from the index by its name, or None if it does not exist
+    def _get_stack(self, stack_name):
+        self._refresh_if_stale()
+        with self.index_lock:
+            return self.stacks.get(stack_name)
+
+    # Get all stacks in the index, rebuilding it first if it's stale
+    def _get_stacks(self):
+        self._refresh_if_stale()
+        with self.index_lock:
+            return list(self.stacks.values())
+
+    # Get the number of stacks in the index, or None if it was never built
+    def _get_stack_count(self):
+        with self.index_lock:
+            return len(self.stacks) if self.refreshed_at is not None else None
+
+    # Check if a stack exists, without listing the stacks again
+    def _stack_exists(self, stack_name):
+        return self._get_stack(stack_name) is not None
+
@@ -0,0 +1,181 @@
+# Interface for a shared poller of in-flight AWS cloudformation stacks
+# Checks all stacks being waited on from a single thread, using one paginated sweep when that's cheaper than a call per
+# due stack, an adaptive delay per stack, and streams new stack events as they arrive
+
+import math
+import random
+import threading
+import time
+
+from concurrent.futures import Future
+
+import botocore.exceptions
+
+from dbx_ws_tracer import THROTTLE_ERROR_CODES
+
+class DatabricksWSStackPoller(object):
+
+    def __init__(self, cf_client, stack_index, min_delay=2, max_delay=30, batch_threshold=5,
+                 stream_events=True, event_callback=None, sweep_page_size=100):
+        self.cf_client = cf_client
+        self.stack_index = stack_index
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # When at least this many stacks are due at once, one sweep of all stacks may be cheaper than a call per stack
+        self.batch_threshold = batch_threshold
+        # Stacks per page of a sweep, to tell how many calls a sweep of the region takes
+        self.sweep_page_size = sweep_page_size
+        self.stream_events = stream_events
+        self.event_callback = event_callback if event_callback is not None else self._print_stack_event
+        self.watched_stacks = {}
+        # Observed durations per success status, used when a watch has no expected duration
+        self.completion_times = {}
+        self.poller_condition = threading.Condition()
+        self.poller_thread = None
+
+    # Print a stack event as a compact single line
+    def _print_stack_event(self, stack_name, stack_event):
+        print("{} {} {} {} {}".format(stack_name, stack_event['Timestamp'].strftime('%H:%M:%S'),
+                stack_event['LogicalResourceId'], stack_event['ResourceStatus'],
+                stack_event.get('ResourceStatusReason', '')).rstrip())
+
+    # Start watching a stack until it reaches a terminal status. Returns a future with the final stack,
+    # or None if the stack no longer exists (e.g. once it's deleted). A stack that is already watched for the same
+    # status shares that watch, and a watch of it for another status fails the earlier one.
+    def _watch_stack(self, stack_name, success_status='CREATE_COMPLETE', expected_seconds=None, timeout_seconds=900):
+        if expected_seconds is None:
+            observed_times = self.completion_times.get(success_status, [])
+            expected_seconds = sum(observed_times) / len(observed_times) if observed_times else 120
+        stack_future = Future()
+        replaced_stack = None
+        with self.poller_condition:
+            watched_stack = self.watched_stacks.get(stack_name)
+            if watched_stack is not None and watched_stack["success_status"] == success_status:
+                watched_stack["deadline"] = max(watched_stack["deadline"], time.time() + timeout_seconds)
+                return watched_stack["future"]
+            replaced_stack = watched_stack
+            self.watched_stacks[stack_name] = {
+                "future": stack_future,
+                "success_status": success_status,
+                "expected_seconds": expected_seconds,
+                "started_at": time.time(),
+                "deadline": time.time() + timeout_seconds,
+                "next_poll_at": time.time() + self.min_delay,
+                "last_event_id": None
+            }
+            if self.poller_thread is None or not self.poller_thread.is_alive():
+                self.poller_thread = threading.Thread(target=self._poll_loop, name='stack-poller', daemon=True)
+                self.poller_thread.start()
+            self.poller_condition.notify()
+        if replaced_stack is not None:
+            replaced_stack["future"].set_exception(RuntimeError(
+                "Watch of stack {} for {} was replaced by a watch for {}".format(
+                    stack_name, replaced_stack["success_status"], success_status)))
+        return stack_future
+
+    # Get the delay until the next check of a stack - long while it's far from its expected completion,
+    # short when close to it, and backing off again when it's overdue. Jittered to spread the calls.
+    def _get_poll_delay(self, watched_stack):
+        elapsed_seconds = time.time() - watched_stack["started_at"]
+        remaining_seconds = watched_stack["expected_seconds"] - elapsed_seconds
+        if remaining_seconds > 0:
+            poll_delay = remaining_seconds / 3
+        else:
+            poll_delay = -remaining_seconds / 10
+        poll_delay = min(max(poll_delay, self.min_delay), self.max_delay)
+        return poll_delay * random.uniform(0.8, 1.2)
+
+    # Fetch the stack events newer than the last seen one, and pass them on in chronological order
+    def _stream_stack_events(self, stack_name, watched_stack):
+        new_stack_events = []
+        for stack_events_page in self.cf_client.get_paginator('describe_stack_events').paginate(StackName=stack_name):
+            for stack_event in stack_events_page['StackEvents']:
+                if stack_event['EventId'] == watched_stack["last_event_id"]:
+                    break
+                if stack_event['Timestamp'].timestamp() < watched_stack["started_at"] - 5:
+                    break
+                new_stack_events.append(stack_event)
+            else:
+                continue
+            break
+        for stack_event in reversed(new_stack_events):
+            self.event_callback(stack_name, stack_event)
+        if new_stack_events:
+            watched_stack["last_event_id"] = new_stack_events[0]['EventId']
+
+    # Check if one sweep of the region is cheaper than describing the due stacks one by one. A sweep pages over every
+    # stack of the region, so it's only used once the index tells that it takes fewer calls.
+    def _is_sweep_cheaper(self, due_stack_count):
+        stack_count = self.stack_index._get_stack_count()
+        if due_stack_count < self.batch_threshold or stack_count is None:
+            return False
+        return math.ceil(max(stack_count, 1) / self.sweep_page_size) < due_stack_count
+
+    # Check the stacks that are due, and complete the futures of the ones in a terminal status
+    def _poll_due_stacks(self, due_stack_names):
+        if self._is_sweep_cheaper(len(due_stack_names)):
+            self.stack_index._refresh()
+            stacks = {stack_name: self.stack_index._get_stack(stack_name) for stack_name in due_stack_names}
+        else:
+            stacks = {stack_name: self.stack_index._invalidate(stack_name) for stack_name in due_stack_names}
+
+        for stack_name, stack in stacks.items():
+            with self.poller_condition:
+                watched_stack = self.watched_stacks[stack_name]
+            if self.stream_events and stack is not None:
+                self._stream_stack_events(stack_name, watched_stack)
+
+            is_finished = stack is None or not stack['StackStatus'].endswith('_IN_PROGRESS')
+            is_expired = not is_finished and time.time() > watched_stack["deadline"]
+            if is_finished or is_expired:
+                # A watch that was replaced while it was checked has already been failed
+                with self.poller_condition:
+                    if self.watched_stacks.get(stack_name) is not watched_stack:
+                        continue
+                    del self.watched_stacks[stack_name]
+
+            if is_finished:
+                elapsed_seconds = time.time() - watched_stack["started_at"]
+                if stack is not None and stack['StackStatus'] == watched_stack["success_status"]:
+                    self.completion_times.setdefault(watched_stack["success_status"], []).append(elapsed_seconds)
+                watched_stack["future"].set_result(stack)
+            elif is_expired:
+                watched_stack["future"].set_exception(TimeoutError(
+                    "Stack {} did not reach {} in time".format(stack_name, watched_stack["success_status"])))
+            else:
+                watched_stack["next_poll_at"] = time.time() + self._get_poll_delay(watched_stack)
+
+    # Poll the watched stacks whenever the earliest of them is due, until there are none left
+    def _poll_loop(self):
+        while True:
+            with self.poller_condition:
+                if not self.watched_stacks:
+                    self.poller_thread = None
+                    return
+                next_poll_at = min(watched_stack["next_poll_at"] for watched_stack in self.watched_stacks.values())
+                if next_poll_at > time.time():
+                    self.poller_condition.wait(next_poll_at - time.time())
+                    continue
+                # Stacks due within the minimum delay are checked along with the due ones, so that they can share a sweep
+                due_stack_names = [stack_name for stack_name, watched_stack in self.watched_stacks.items()
+                                   if watched_stack["next_poll_at"] <= time.time() + self.min_delay]
+            try:
+                self._poll_due_stacks(due_stack_names)
+            except Exception as ex:
+                # Throttled stacks back off and are tried again until their deadline. Any other error fails the due
+                # stacks rather than leaving their waiters blocked forever.
+                is_throttled = (isinstance(ex, botocore.exceptions.ClientError)
+                                and ex.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES)
+                if is_throttled:
+                    print("Polling stacks failed with {}, backing off".format(ex.response['Error']['Message']))
+                failed_stacks = []
+                with self.poller_condition:
+                    for stack_name in due_stack_names:
+                        if stack_name not in self.watched_stacks:
+                            continue
+                        if not is_throttled or time.time() > self.watched_stacks[stack_name]["deadline"]:
+                            failed_stacks.append(self.watched_stacks.pop(stack_name))
+                        else:
+                            self.watched_stacks[stack_name]["next_poll_at"] = time.time() + self.max_delay
+                for watched_stack in failed_stacks:
+                    watched_stack["future"].set_exception(ex)
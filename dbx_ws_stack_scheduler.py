@@ -0,0 +1,191 @@
+# Interface for scheduling AWS cloudformation stack deployments for Databricks E2 Workspaces
+# Deploys the stacks of a declarative step graph, starting every step as soon as the stacks it depends on exist
+# Tears them down in reverse, deleting every stack as soon as the stacks that depend on it are gone
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from json import loads as json_loads
+
+# Statuses of a stack whose creation failed, which can't be updated and only be deleted
+FAILED_CREATE_STATUSES = ['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED']
+
+class DatabricksWSStackScheduler(object):
+
+    # With a run journal, steps completed by a previous run are skipped and completed steps are recorded
+    def __init__(self, ws_prov_utils, max_workers=4, run_journal=None):
+        self.ws_prov_utils = ws_prov_utils
+        self.max_workers = max_workers
+        self.run_journal = run_journal
+
+    # Read and parse a step graph file, and make sure every stack input refers to a known step
+    def _parse_step_graph(self, step_graph):
+        with open(step_graph) as step_graph_fileobj:
+            step_graph_str = step_graph_fileobj.read()
+        steps = json_loads(step_graph_str)
+        step_names = [step["step_name"] for step in steps]
+        for step in steps:
+            for dependency in self._get_dependencies(step):
+                if dependency not in step_names:
+                    print("Exiting the script as step {} depends on unknown step {}".format(step["step_name"], dependency))
+                    exit(1)
+        return steps
+
+    # Get the names of the steps whose stack outputs feed into the given step
+    def _get_dependencies(self, step):
+        return set(stack_input["step_name"] for stack_input in step.get("stack_inputs", {}).values())
+
+    # Get the value of an output from a created stack object
+    def _get_stack_output(self, created_stack_obj, output_key):
+        for stack_output in created_stack_obj['Stacks'][0].get('Outputs', []):
+            if stack_output['OutputKey'] == output_key:
+                return stack_output['OutputValue']
+        return None
+
+    # Build the full parameter list of a step from its parameter file, the common params and upstream stack outputs
+    def _resolve_parameters(self, step, common_params, created_stack_objs):
+        parameter_data = self.ws_prov_utils._parse_parameters(step["parameters"])
+        for parameter_key, common_params_key in step.get("common_params_inputs", {}).items():
+            parameter_data.append({"ParameterKey": parameter_key, "ParameterValue": common_params[common_params_key]})
+        for parameter_key, stack_input in step.get("stack_inputs", {}).items():
+            output_value = self._get_stack_output(created_stack_objs[stack_input["step_name"]], stack_input["output_key"])
+            if output_value is None:
+                print("Exiting the script as output {} of step {} was not available for step {}".format(
+                    stack_input["output_key"], stack_input["step_name"], step["step_name"]))
+                exit(1)
+            parameter_data.append({"ParameterKey": parameter_key, "ParameterValue": output_value})
+        # Per-workspace overrides of the parameter file values, e.g. a unique bucket or role name
+        stack_parameter_overrides = common_params.get("stack_parameter_overrides", {}).get(step["step_name"], {})
+        for parameter_key, parameter_value in stack_parameter_overrides.items():
+            parameter_data = [parameter for parameter in parameter_data if parameter["ParameterKey"] != parameter_key]
+            parameter_data.append({"ParameterKey": parameter_key, "ParameterValue": parameter_value})
+        return parameter_data
+
+    # Get the stack of a step completed by a previous run - from the journal or, when resuming, from an
+    # existing stack that was created successfully but not yet recorded. The stack is only adopted if its
+    # fingerprint tag matches the template and parameters of this run, as it may have changed in between.
+    # A stack of a previous run whose creation failed is deleted, so that it's created again.
+    def _get_completed_stack(self, step, stack_name, template_data, parameter_data):
+        created_stack_obj = self.run_journal._get("stack", step["step_name"])
+        if created_stack_obj is None and not self.run_journal.resume:
+            return None
+        stack = self.ws_prov_utils.stack_index._get_stack(stack_name)
+        if created_stack_obj is None and stack is not None and stack['StackStatus'] in FAILED_CREATE_STATUSES:
+            if self.ws_prov_utils._get_deployed_fingerprint(stack) is None:
+                print("Exiting the script as stack {} is {} and wasn't created by these scripts - delete it and "
+                      "resume the run".format(stack_name, stack['StackStatus']))
+                exit(1)
+            print("Deleting stack {} as its creation by a previous run ended in {}".format(stack_name, stack['StackStatus']))
+            self.ws_prov_utils._delete_stack(stack_name, step.get("expected_seconds"))
+            return None
+        if created_stack_obj is None and (stack is None or stack['StackStatus'] != 'CREATE_COMPLETE'):
+            return None
+        if created_stack_obj is not None and stack is None:
+            print("Exiting the script as stack {} recorded by the journal no longer exists - tear down the workspace".format(stack_name))
+            exit(1)
+
+        stack_fingerprint = self.ws_prov_utils._get_stack_fingerprint(template_data, parameter_data, step.get("is_iam_stack", False))
+        if self.ws_prov_utils._get_deployed_fingerprint(stack) != stack_fingerprint:
+            print("Exiting the script as stack {} of a previous run doesn't match the current template and parameters - "
+                  "update or tear down the workspace".format(stack_name))
+            exit(1)
+        if created_stack_obj is None:
+            created_stack_obj = {'Stacks': [stack]}
+            self.run_journal._record_stack(step["step_name"], created_stack_obj)
+        return created_stack_obj
+
+    # Read the template, resolve the parameters and deploy the stack for a single step
+    def _run_step(self, step, common_params, created_stack_objs):
+        stack_name = common_params[step["stack_name_param"]]
+        template_data = self.ws_prov_utils._parse_template(step["template"])
+        parameter_data = self._resolve_parameters(step, common_params, created_stack_objs)
+        if self.run_journal is not None:
+            created_stack_obj = self._get_completed_stack(step, stack_name, template_data, parameter_data)
+            if created_stack_obj is not None:
+                print("Skipping step {} as stack {} was already created".format(step["step_name"], stack_name))
+                return created_stack_obj
+
+        created_stack_obj = self.ws_prov_utils._deploy_stack(stack_name, template_data, parameter_data,
+                                step.get("is_iam_stack", False), step.get("expected_seconds"))
+        if self.run_journal is not None:
+            self.run_journal._record_stack(step["step_name"], created_stack_obj)
+        return created_stack_obj
+
+    # Read the template, resolve the parameters and update the existing stack for a single step
+    # Returns the updated stack object, and the stack object from before the update or None if nothing changed
+    def _run_update_step(self, step, common_params, stack_objs):
+        template_data = self.ws_prov_utils._parse_template(step["template"])
+        parameter_data = self._resolve_parameters(step, common_params, stack_objs)
+        return self.ws_prov_utils._update_stack(common_params[step["stack_name_param"]], template_data, parameter_data,
+                    step.get("is_iam_stack", False), step.get("expected_seconds"))
+
+    # Deploy all steps of the graph, each one as soon as the steps it depends on are complete.
+    # on_step_complete is called from the scheduling thread with the step and its created stack object.
+    def _deploy_step_graph(self, steps, common_params, on_step_complete=None):
+        return self._run_step_graph(steps, common_params, self._run_step, on_step_complete)
+
+    # Update the existing stacks of all steps of the graph, in the same order as they are deployed, so that
+    # changed outputs flow into the parameters of the steps that depend on them. on_step_updated is called
+    # from the scheduling thread with the step, its updated stack object and its previous stack object,
+    # only for the steps whose stack actually changed.
+    def _update_step_graph(self, steps, common_params, on_step_updated=None):
+        previous_stack_objs = {}
+
+        def _run_update_step(step, common_params, stack_objs):
+            updated_stack_obj, previous_stack_obj = self._run_update_step(step, common_params, stack_objs)
+            previous_stack_objs[step["step_name"]] = previous_stack_obj
+            return updated_stack_obj
+
+        def _on_step_complete(step, updated_stack_obj):
+            if on_step_updated is not None and previous_stack_objs[step["step_name"]] is not None:
+                on_step_updated(step, updated_stack_obj, previous_stack_objs[step["step_name"]])
+
+        return self._run_step_graph(steps, common_params, _run_update_step, _on_step_complete)
+
+    # Delete the stack of a single step. Returns the stack object from before the deletion, or None if it didn't exist.
+    def _run_delete_step(self, step, common_params, deleted_stack_objs):
+        deleted_stack = self.ws_prov_utils._delete_stack(common_params[step["stack_name_param"]], step.get("expected_seconds"))
+        return {'Stacks': [deleted_stack]} if deleted_stack is not None else None
+
+    # Delete the stacks of all steps of the graph in reverse order - each one as soon as the stacks of the steps
+    # that take its outputs are deleted, so that independent stacks are deleted together.
+    # on_step_deleted is called from the scheduling thread with the step and its stack object from before the deletion.
+    def _delete_step_graph(self, steps, common_params, on_step_deleted=None):
+        return self._run_step_graph(steps, common_params, self._run_delete_step, on_step_deleted, reverse=True)
+
+    # Run a single step with the given step runner, in a span of the run's tracer
+    def _run_traced_step(self, run_step, step, common_params, created_stack_objs):
+        with self.ws_prov_utils.tracer._span('stack_step', step_name=step["step_name"]):
+            return run_step(step, common_params, created_stack_objs)
+
+    # Get the names of the steps that take stack outputs from the given step
+    def _get_dependents(self, step, steps):
+        return set(other_step["step_name"] for other_step in steps if step["step_name"] in self._get_dependencies(other_step))
+
+    # Run all steps of the graph with the given step runner, each one as soon as the steps it depends on are complete
+    # In reverse, each step waits for the steps that depend on it instead
+    def _run_step_graph(self, steps, common_params, run_step, on_step_complete, reverse=False):
+        created_stack_objs = {}
+        pending_steps = list(steps)
+        running_steps = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending_steps or running_steps:
+                for step in list(pending_steps):
+                    step_dependencies = self._get_dependents(step, steps) if reverse else self._get_dependencies(step)
+                    if step_dependencies.issubset(created_stack_objs.keys()):
+                        pending_steps.remove(step)
+                        print("Scheduling step {}".format(step["step_name"]))
+                        step_future = executor.submit(self._run_traced_step, run_step, step, common_params,
+                                                      dict(created_stack_objs))
+                        running_steps[step_future] = step
+
+                if not running_steps:
+                    print("Exiting the script as steps {} have circular dependencies".format(
+                        [step["step_name"] for step in pending_steps]))
+                    exit(1)
+
+                done_futures, _ = wait(running_steps, return_when=FIRST_COMPLETED)
+                for step_future in done_futures:
+                    step = running_steps.pop(step_future)
+                    created_stack_objs[step["step_name"]] = step_future.result()
+                    if on_step_complete is not None:
+                        on_step_complete(step, created_stack_objs[step["step_name"]])
+        return created_stack_objs
@@ -0,0 +1,251 @@
+# Controller script to sweep orphaned AWS cloudformation stacks and Databricks E2 workspace objects of an account,
+# e.g. the ones left behind by short-lived CI and load test workspaces.
+# A workspace object is orphaned if its name starts with one of the given prefixes and no workspace uses it (customer
+# managed keys have no name, so they're matched by their key alias). A stack is orphaned if its name starts with one
+# of the prefixes, it carries the fingerprint tag of the provisioning scripts, and none of its outputs is used by a
+# workspace object that is kept. Resources younger than --min-age-hours are left alone, as they may belong to a run
+# that is still in progress. Resource bundles that a resource pool keeps ready or is preparing are not used by any
+# workspace yet, so their stacks and workspace objects are kept too. With --dry-run the orphans are only reported.
+
+import argparse
+import glob
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps, loads as json_loads
+
+from dbx_ws_utils import DatabricksWSProvisioningUtils
+from dbx_ws_accounts_api import DatabricksWSAccountsAPI, WORKSPACE_OBJECT_CALLS, WORKSPACE_REQUEST_KEYS, get_key_path_value
+from dbx_ws_client_pool import DatabricksWSClientPool
+from dbx_ws_tracer import DatabricksWSTracer
+
+class DatabricksWSOrphanSweeper(object):
+
+    def __init__(self, defaults, client_pool, name_prefixes, region_names=None, min_age_hours=6, max_parallel_stacks=4,
+                 resource_pool_dir='./.resource_pool'):
+        self.defaults = defaults
+        self.client_pool = client_pool
+        self.name_prefixes = name_prefixes
+        self.region_names = region_names or [defaults["region_name"]]
+        self.min_age_hours = min_age_hours
+        self.max_parallel_stacks = max_parallel_stacks
+        self.resource_pool_dir = resource_pool_dir
+        self.tracer = DatabricksWSTracer('orphan-sweep')
+
+    # Check if a resource name follows the naming convention of the resources to sweep
+    def _is_swept_name(self, resource_name):
+        return isinstance(resource_name, str) and any(resource_name.startswith(name_prefix)
+                                                      for name_prefix in self.name_prefixes)
+
+    # Check if a resource created at the given epoch seconds is old enough to be swept
+    def _is_old_enough(self, created_at):
+        return created_at is None or time.time() - created_at >= self.min_age_hours * 3600
+
+    # Get all string values of a nested account object, e.g. the role ARN of credentials or the subnet ids of a network
+    def _get_object_values(self, account_object):
+        if isinstance(account_object, dict):
+            account_object = list(account_object.values())
+        if isinstance(account_object, list):
+            object_values = set()
+            for object_value in account_object:
+                object_values.update(self._get_object_values(object_value))
+            return object_values
+        return set([account_object]) if isinstance(account_object, str) else set()
+
+    # Check that the Accounts API client can list the workspaces and every kind of workspace object. Without a listing,
+    # the objects and stacks in use can't be told apart from orphans, so the sweep exits.
+    def _check_listings(self, ws_accounts_api):
+        list_calls = ['list_workspaces'] + [object_calls["list_call"] for object_calls in WORKSPACE_OBJECT_CALLS.values()]
+        missing_list_calls = [list_call for list_call in list_calls if not hasattr(ws_accounts_api.accounts_api_client, list_call)]
+        if missing_list_calls:
+            print("Exiting the script as the Accounts API client can't make {}, so the resources in use can't be found".format(
+                missing_list_calls))
+            exit(1)
+
+    # Get the keys of the bundles that the resource pools keep ready or are preparing, and the ids of the workspace
+    # objects of the ready ones. Bundles being torn down are left to be swept. An unreadable pool state exits, as the
+    # bundles in it can't be told apart from orphans.
+    def _load_pooled_bundles(self):
+        pooled_bundle_keys = set()
+        pooled_object_ids = set()
+        for state_path in sorted(glob.glob(os.path.join(self.resource_pool_dir, '*.json'))):
+            try:
+                with open(state_path) as state_fileobj:
+                    pool_state = json_loads(state_fileobj.read())
+            except (OSError, ValueError) as ex:
+                print("Exiting the script as the resource pool state {} could not be read: {}".format(state_path, ex))
+                exit(1)
+            for ready_bundle in pool_state.get("ready", []):
+                pooled_bundle_keys.add(ready_bundle["bundle_key"])
+                pooled_object_ids.update(ready_bundle["workspace_input_data"].values())
+            pooled_bundle_keys.update(pool_state.get("preparing", {}).keys())
+        print("Keeping {} resource bundles of the resource pools in {}".format(len(pooled_bundle_keys), self.resource_pool_dir))
+        return pooled_bundle_keys, pooled_object_ids
+
+    # Check if a resource is named after one of the pooled bundles
+    def _is_pooled_name(self, resource_name, pooled_bundle_keys):
+        return isinstance(resource_name, str) and any(bundle_key in resource_name for bundle_key in pooled_bundle_keys)
+
+    # Find the orphaned workspace objects of the account
+    # Returns the orphans, and the values of the kept workspace objects which tell the stacks that are still used
+    def _find_orphaned_objects(self, ws_accounts_api, pooled_bundle_keys, pooled_object_ids):
+        used_object_ids = set(pooled_object_ids)
+        for workspace in ws_accounts_api.accounts_api_client.list_workspaces(self.defaults["databricks_workspace_account_id"]):
+            used_object_ids.update(ws_accounts_api._get_workspace_object_ids(workspace).values())
+
+        orphaned_objects = []
+        kept_object_values = set()
+        for id_key, object_calls in WORKSPACE_OBJECT_CALLS.items():
+            object_id_key = WORKSPACE_REQUEST_KEYS.get(id_key, id_key)
+            for account_object in ws_accounts_api._list_workspace_objects(self.defaults, id_key):
+                object_name = get_key_path_value(account_object, object_calls.get("sweep_key_path", object_calls["name_key_path"]))
+                created_at = account_object["creation_time"] / 1000 if account_object.get("creation_time") else None
+                if (account_object[object_id_key] not in used_object_ids and self._is_swept_name(object_name)
+                        and not self._is_pooled_name(object_name, pooled_bundle_keys) and self._is_old_enough(created_at)):
+                    orphaned_objects.append({"id_key": id_key, "object_id": account_object[object_id_key],
+                                             "name": object_name, "status": 'ORPHANED'})
+                else:
+                    kept_object_values.update(self._get_object_values(account_object))
+        return orphaned_objects, kept_object_values
+
+    # Find the orphaned stacks of a region, given the values of the workspace objects that are kept
+    def _find_orphaned_stacks(self, ws_prov_utils, kept_object_values, pooled_bundle_keys):
+        ws_prov_utils.stack_index._refresh()
+        orphaned_stacks = []
+        for stack in ws_prov_utils.stack_index._get_stacks():
+            if not self._is_swept_name(stack['StackName']) or ws_prov_utils._get_deployed_fingerprint(stack) is None:
+                continue
+            if self._is_pooled_name(stack['StackName'], pooled_bundle_keys):
+                continue
+            if stack['StackStatus'].endswith('_IN_PROGRESS') or not self._is_old_enough(stack['CreationTime'].timestamp()):
+                continue
+            stack_output_values = set(stack_output['OutputValue'] for stack_output in stack.get('Outputs', []))
+            if stack_output_values & kept_object_values:
+                continue
+            orphaned_stacks.append(stack)
+        return orphaned_stacks
+
+    # Order orphaned stacks into waves of stacks to delete together, like the step graph in reverse - a stack whose
+    # parameters take the outputs of another orphaned stack is deleted in an earlier wave than that stack
+    def _get_deletion_waves(self, stacks):
+        output_stack_names = {}
+        for stack in stacks:
+            for stack_output in stack.get('Outputs', []):
+                output_stack_names[stack_output['OutputValue']] = stack['StackName']
+        stack_dependencies = {}
+        for stack in stacks:
+            stack_dependencies[stack['StackName']] = set(output_stack_names[parameter['ParameterValue']]
+                for parameter in stack.get('Parameters', []) if parameter.get('ParameterValue') in output_stack_names)
+            stack_dependencies[stack['StackName']].discard(stack['StackName'])
+
+        deletion_waves = []
+        remaining_stack_names = [stack['StackName'] for stack in stacks]
+        while remaining_stack_names:
+            deletion_wave = [stack_name for stack_name in remaining_stack_names
+                             if not any(stack_name in stack_dependencies[other_stack_name]
+                                        for other_stack_name in remaining_stack_names)]
+            # Stacks with circular dependencies are deleted together
+            if not deletion_wave:
+                deletion_wave = list(remaining_stack_names)
+            deletion_waves.append(deletion_wave)
+            remaining_stack_names = [stack_name for stack_name in remaining_stack_names if stack_name not in deletion_wave]
+        return deletion_waves
+
+    # Run a deletion for each orphan concurrently, and record on each orphan whether it was deleted
+    def _delete_orphans(self, orphans, delete_orphan, max_workers):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            orphan_futures = [(orphan, executor.submit(delete_orphan, orphan)) for orphan in orphans]
+        for orphan, orphan_future in orphan_futures:
+            try:
+                orphan_future.result()
+                orphan["status"] = 'DELETED'
+            # Deletions exit on most failures, which must only fail that orphan and not the sweep
+            except (Exception, SystemExit) as ex:
+                orphan["status"] = 'FAILED'
+                orphan["error"] = repr(ex)
+
+    # Find the orphaned workspace objects of the account and the orphaned stacks of every region, and delete them
+    # unless it's a dry run. The workspace objects go first, as they may use outputs of the stacks.
+    # Returns a report of the orphans found, with the outcome of each deletion.
+    def _sweep(self, dry_run=False):
+        ws_accounts_api = DatabricksWSAccountsAPI(self.defaults, self.client_pool._get_accounts_api_client(self.defaults),
+                                                  self.client_pool._get_workspace_watcher(self.defaults), self.tracer)
+        self._check_listings(ws_accounts_api)
+        pooled_bundle_keys, pooled_object_ids = self._load_pooled_bundles()
+        orphaned_objects, kept_object_values = self._find_orphaned_objects(ws_accounts_api, pooled_bundle_keys,
+                                                                           pooled_object_ids)
+        print("Found {} orphaned workspace objects".format(len(orphaned_objects)))
+        if not dry_run and orphaned_objects:
+            self._delete_orphans(orphaned_objects, lambda orphan: ws_accounts_api._delete_workspace_object(
+                self.defaults, orphan["id_key"], orphan["object_id"]), len(orphaned_objects))
+
+        orphaned_stacks = []
+        for region_name in self.region_names:
+            region_params = dict(self.defaults, region_name=region_name)
+            ws_prov_utils = DatabricksWSProvisioningUtils(region_params,
+                                self.client_pool._get_cf_client(region_name),
+                                self.client_pool._get_stack_index(region_name),
+                                self.client_pool._get_stack_poller(region_name),
+                                self.client_pool.template_cache, self.tracer,
+                                self.client_pool._get_template_stager(region_params))
+            region_stacks = self._find_orphaned_stacks(ws_prov_utils, kept_object_values, pooled_bundle_keys)
+            print("Found {} orphaned stacks in {}".format(len(region_stacks), region_name))
+            for deletion_wave in self._get_deletion_waves(region_stacks):
+                region_orphans = [{"region_name": region_name, "stack_name": stack_name, "status": 'ORPHANED'}
+                                  for stack_name in deletion_wave]
+                if not dry_run:
+                    self._delete_orphans(region_orphans, lambda orphan: ws_prov_utils._delete_stack(orphan["stack_name"]),
+                                         self.max_parallel_stacks)
+                orphaned_stacks.extend(region_orphans)
+
+        return {
+            "dry_run": dry_run,
+            "name_prefixes": self.name_prefixes,
+            "min_age_hours": self.min_age_hours,
+            "workspace_objects": orphaned_objects,
+            "stacks": orphaned_stacks,
+            "deleted": sum(1 for orphan in orphaned_objects + orphaned_stacks if orphan["status"] == 'DELETED'),
+            "failed": sum(1 for orphan in orphaned_objects + orphaned_stacks if orphan["status"] == 'FAILED')
+        }
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Sweep orphaned stacks and workspace objects of a Databricks E2 account')
+    arg_parser.add_argument('--defaults', default='./common_params.json', help='Shared default master parameters')
+    arg_parser.add_argument('--name-prefix', action='append', required=True,
+                            help='Name prefix of the stacks and workspace objects to sweep, can be repeated')
+    arg_parser.add_argument('--regions', help='Comma separated regions to sweep stacks in, defaults to the default region')
+    arg_parser.add_argument('--min-age-hours', type=float, default=6,
+                            help='Only sweep stacks and workspace objects created at least this long ago')
+    arg_parser.add_argument('--dry-run', action='store_true', help='Only report the orphans, without deleting them')
+    arg_parser.add_argument('--report', default='./sweep_report.json', help='File to write the sweep report to')
+    args = arg_parser.parse_args()
+
+    # An empty prefix would match every stack and workspace object of the account
+    if not all(args.name_prefix):
+        print("Exiting the script as name prefixes must not be empty")
+        exit(1)
+
+    with open(args.defaults) as parameter_fileobj:
+        parameter_str = parameter_fileobj.read()
+    defaults = json_loads(parameter_str)
+
+    client_pool = DatabricksWSClientPool(max_pool_connections=defaults.get("max_parallel_stacks", 4),
+                                         accounts_api_rate_per_second=defaults.get("accounts_api_rate_per_second", 5),
+                                         accounts_api_burst=defaults.get("accounts_api_burst", 10),
+                                         rate_limit_dir=defaults.get("rate_limit_dir"))
+    ws_orphan_sweeper = DatabricksWSOrphanSweeper(defaults, client_pool, args.name_prefix,
+                            args.regions.split(',') if args.regions else None, args.min_age_hours,
+                            defaults.get("max_parallel_stacks", 4), defaults.get("resource_pool_dir", "./.resource_pool"))
+    sweep_report = ws_orphan_sweeper._sweep(args.dry_run)
+
+    with open(args.report, 'w') as report_fileobj:
+        report_fileobj.write(json_dumps(sweep_report, indent=2))
+
+    if args.dry_run:
+        print("Found {} orphaned workspace objects and {} orphaned stacks, report is in {}".format(
+            len(sweep_report["workspace_objects"]), len(sweep_report["stacks"]), args.report))
+    else:
+        print("Deleted {} orphans, {} failed, report is in {}".format(sweep_report["deleted"], sweep_report["failed"], args.report))
+    if sweep_report["failed"]:
+        exit(1)
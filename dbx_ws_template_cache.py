@@ -0,0 +1,99 @@
+# Interface for an on-disk cache of AWS cloudformation template validations, keyed by template content hash
+# An unchanged template is validated with cloudformation only once, across runs and processes
+
+import hashlib
+import os
+import threading
+import time
+
+from json import dumps as json_dumps, loads as json_loads
+
+class DatabricksWSTemplateCache(object):
+
+    def __init__(self, cache_dir='./.template_validation_cache', max_entries=500, max_age_seconds=30 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        # In-memory copy of the entries read or written by this process
+        self.cache_entries = {}
+        self.cache_lock = threading.Lock()
+
+    # Get the content hash of a template body
+    def _get_template_hash(self, template_data):
+        return hashlib.sha256(template_data.encode('utf-8')).hexdigest()
+
+    def _get_entry_path(self, template_hash):
+        return os.path.join(self.cache_dir, '{}.json'.format(template_hash))
+
+    # Get a cached validation by template hash, or None if it's not cached or has expired
+    def _get(self, template_hash):
+        with self.cache_lock:
+            cache_entry = self.cache_entries.get(template_hash)
+        if cache_entry is None:
+            try:
+                with open(self._get_entry_path(template_hash)) as entry_fileobj:
+                    cache_entry = json_loads(entry_fileobj.read())
+            except (OSError, ValueError):
+                return None
+        if time.time() - cache_entry["validated_at"] > self.max_age_seconds:
+            self._remove(template_hash)
+            return None
+        with self.cache_lock:
+            self.cache_entries[template_hash] = cache_entry
+        return cache_entry
+
+    # Store a validation by template hash, and evict the oldest entries beyond the max number of entries
+    def _put(self, template_hash, cache_entry):
+        with self.cache_lock:
+            self.cache_entries[template_hash] = cache_entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a partial entry
+        entry_path = self._get_entry_path(template_hash)
+        temp_entry_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(), threading.get_ident())
+        with open(temp_entry_path, 'w') as entry_fileobj:
+            entry_fileobj.write(json_dumps(cache_entry))
+        os.replace(temp_entry_path, entry_path)
+        self._evict()
+
+    # Remove a cached validation
+    def _remove(self, template_hash):
+        with self.cache_lock:
+            self.cache_entries.pop(template_hash, None)
+        try:
+            os.remove(self._get_entry_path(template_hash))
+        except OSError:
+            pass
+
+    # Evict expired entries, and the least recently written ones beyond the max number of entries
+    def _evict(self):
+        entry_files = []
+        for entry_file in os.listdir(self.cache_dir):
+            if not entry_file.endswith('.json'):
+                continue
+            try:
+                entry_files.append((os.path.getmtime(os.path.join(self.cache_dir, entry_file)), entry_file))
+            except OSError:
+                continue
+        entry_files.sort(reverse=True)
+        for entry_index, (entry_mtime, entry_file) in enumerate(entry_files):
+            if entry_index >= self.max_entries or time.time() - entry_mtime > self.max_age_seconds:
+                self._remove(entry_file[:-len('.json')])
+
+    # Validate a template with cloudformation unless it's cached, and get its declared parameters
+    # Returns a dict of parameter key to whether the parameter has a default value
+    # With a template stager, the template is staged in S3 and validated from there
+    def _validate_template(self, cf_client, template_data, template_stager=None):
+        template_hash = self._get_template_hash(template_data)
+        cache_entry = self._get(template_hash)
+        if cache_entry is None:
+            if template_stager is not None:
+                validation_resp = cf_client.validate_template(TemplateURL=template_stager._stage_template(template_data))
+            else:
+                validation_resp = cf_client.validate_template(TemplateBody=template_data)
+            cache_entry = {
+                "validated_at": time.time(),
+                "parameters": {parameter['ParameterKey']: 'DefaultValue' in parameter
+                               for parameter in validation_resp.get('Parameters', [])}
+            }
+            self._put(template_hash, cache_entry)
+        return cache_entry["parameters"]
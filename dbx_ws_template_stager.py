@@ -0,0 +1,73 @@
+# Interface for staging AWS cloudformation templates in S3, so that stacks are created from a TemplateURL
+# Each template is minified and uploaded once under its content hash, and an upload is skipped if an object with
+# that hash already exists. This keeps the template out of every cloudformation request, and lifts the size limit
+# of inline template bodies (51,200 bytes) to the one of templates in S3 (1 MB).
+
+import hashlib
+import threading
+
+import botocore.exceptions
+
+from json import dumps as json_dumps, loads as json_loads
+
+# Error codes of head_object for an object that doesn't exist
+MISSING_OBJECT_ERROR_CODES = ['404', 'NoSuchKey', 'NotFound']
+
+class DatabricksWSTemplateStager(object):
+
+    def __init__(self, s3_client, bucket_name, key_prefix='dbx-ws-templates/', region_name=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key_prefix = key_prefix
+        self.region_name = region_name
+        # URLs of the templates staged or found by this process, keyed by content hash
+        self.staged_urls = {}
+        # One lock per content hash, so that concurrent workspaces upload a template only once
+        self.template_locks = {}
+        self.stager_lock = threading.Lock()
+
+    # Minify a JSON template by dropping all whitespace. YAML templates are staged as they are.
+    def _minify_template(self, template_data):
+        try:
+            return json_dumps(json_loads(template_data), separators=(',', ':'))
+        except ValueError:
+            return template_data
+
+    # Get the URL of a staged template in the bucket
+    def _get_template_url(self, template_key):
+        if self.region_name is None or self.region_name == 'us-east-1':
+            return 'https://{}.s3.amazonaws.com/{}'.format(self.bucket_name, template_key)
+        return 'https://{}.s3.{}.amazonaws.com/{}'.format(self.bucket_name, self.region_name, template_key)
+
+    # Check if a template is already staged under a key
+    def _is_staged(self, template_key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=template_key)
+            return True
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] in MISSING_OBJECT_ERROR_CODES:
+                return False
+            raise
+
+    # Stage a minified template under its content hash unless it's already there, and get its URL
+    def _stage_template(self, template_data):
+        minified_template_data = self._minify_template(template_data)
+        template_hash = hashlib.sha256(minified_template_data.encode('utf-8')).hexdigest()
+        with self.stager_lock:
+            if template_hash in self.staged_urls:
+                return self.staged_urls[template_hash]
+            template_lock = self.template_locks.setdefault(template_hash, threading.Lock())
+
+        with template_lock:
+            with self.stager_lock:
+                if template_hash in self.staged_urls:
+                    return self.staged_urls[template_hash]
+            template_key = '{}{}.json'.format(self.key_prefix, template_hash)
+            if not self._is_staged(template_key):
+                template_body = minified_template_data.encode('utf-8')
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=template_key, Body=template_body,
+                                          ContentType='application/json')
+                print('Staged template as s3://{}/{} ({} bytes)'.format(self.bucket_name, template_key, len(template_body)))
+            with self.stager_lock:
+                self.staged_urls[template_hash] = self._get_template_url(template_key)
+                return self.staged_urls[template_hash]
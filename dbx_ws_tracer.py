@@ -0,0 +1,326 @@
+# Interface for tracing a provisioning run of a Databricks E2 Workspace
+# Records timed spans for the phases of a run - template validations, stack deployments, workspace object creations
+# and status waits - with the AWS and Databricks API calls, throttles and retries made within each of them.
+# Traces are exported as JSON in the Chrome trace event format, and summarized into the critical path and idle time.
+
+import functools
+import os
+import threading
+import time
+
+from json import dumps as json_dumps
+
+# Error codes of AWS API calls that were throttled
+THROTTLE_ERROR_CODES = ['Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded']
+# Slack when matching the end of a span to the start of the next one on the critical path
+CRITICAL_PATH_SLACK_SECONDS = 0.01
+
+# Calls being made through instrumented clients on the current thread, so that a transport under a client can report the retries
+# it makes within the call to the tracer of the client
+call_context = threading.local()
+
+# Count a retry of the API call being made on the current thread, and whether the try before it was throttled, on the
+# tracer whose instrumented client is making the call. Retries made outside of an instrumented client are not counted.
+def count_retry(throttled=False):
+    instrumented_calls = getattr(call_context, 'instrumented_calls', None)
+    if instrumented_calls:
+        instrumented_calls[-1]._count_retry(throttled)
+
+# Decorator to record every call of a method in a span of the tracer of its object
+# With attribute_name, the first argument of the call is recorded on the span under that name
+def traced(span_name, attribute_name=None):
+    def _traced(method):
+        @functools.wraps(method)
+        def _traced_method(self, *args, **kwargs):
+            span_attributes = {attribute_name: args[0]} if attribute_name is not None and args else {}
+            with self.tracer._span(span_name, **span_attributes):
+                return method(self, *args, **kwargs)
+        return _traced_method
+    return _traced
+
+# Span of a tracer, used as a context manager around the phase it times
+class DatabricksWSSpan(object):
+
+    def __init__(self, tracer, span_name, span_attributes):
+        self.tracer = tracer
+        self.span_name = span_name
+        self.span_attributes = span_attributes
+        self.parent_span = None
+        self.thread_id = None
+        self.start_time = None
+        self.end_time = None
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.error = None
+
+    def __enter__(self):
+        self.parent_span = self.tracer._get_current_span()
+        self.thread_id = threading.get_ident()
+        self.start_time = time.time()
+        self.tracer._push_span(self)
+        self.tracer._notify('span_started', self)
+        return self
+
+    def __exit__(self, ex_type, ex, ex_traceback):
+        self.end_time = time.time()
+        if ex is not None:
+            self.error = repr(ex)
+        self.tracer._pop_span(self)
+        self.tracer._notify('span_ended', self)
+        return False
+
+    def _get_seconds(self):
+        return (self.end_time or time.time()) - self.start_time
+
+class DatabricksWSTracer(object):
+
+    # span_callback is called with an event name and a progress record whenever a span starts or ends,
+    # e.g. to stream the progress of a run
+    def __init__(self, run_name=None, span_callback=None):
+        self.run_name = run_name
+        self.span_callback = span_callback
+        self.start_time = time.time()
+        self.spans = []
+        self.call_counts = {}
+        self.throttle_counts = {}
+        self.retry_counts = {}
+        # Seconds to milestones of the run that no span times, e.g. the time a workspace took to get to RUNNING
+        self.milestone_seconds = {}
+        self.tracer_lock = threading.Lock()
+        # Stack of the open spans of each thread, so that calls are counted on the spans they were made in
+        self.span_context = threading.local()
+
+    # Get a new span, to be used with a with statement
+    def _span(self, span_name, **span_attributes):
+        return DatabricksWSSpan(self, span_name, span_attributes)
+
+    def _get_open_spans(self):
+        if not hasattr(self.span_context, 'open_spans'):
+            self.span_context.open_spans = []
+        return self.span_context.open_spans
+
+    # Get the innermost open span of the current thread, or None
+    def _get_current_span(self):
+        open_spans = self._get_open_spans()
+        return open_spans[-1] if open_spans else None
+
+    def _push_span(self, span):
+        self._get_open_spans().append(span)
+        with self.tracer_lock:
+            self.spans.append(span)
+
+    def _pop_span(self, span):
+        open_spans = self._get_open_spans()
+        if span in open_spans:
+            open_spans.remove(span)
+
+    # Pass a started or ended span to the span callback, as a progress record
+    def _notify(self, span_event, span):
+        if self.span_callback is None:
+            return
+        progress_record = {"event": span_event, "span": self._get_span_label(span),
+                           "elapsed_seconds": round(time.time() - self.start_time, 3)}
+        if span.end_time is not None:
+            progress_record["seconds"] = round(span._get_seconds(), 3)
+            progress_record["calls"] = span.calls
+            if span.error is not None:
+                progress_record["error"] = span.error
+        self.span_callback(span_event, progress_record)
+
+    # Record the seconds to a milestone of the run
+    def _record_milestone(self, milestone_name, seconds):
+        with self.tracer_lock:
+            self.milestone_seconds[milestone_name] = seconds
+
+    # Count an API call on the run and on all open spans of the current thread
+    def _count_call(self, service_name, call_name, throttled=False):
+        call_key = '{}.{}'.format(service_name, call_name)
+        with self.tracer_lock:
+            self.call_counts[call_key] = self.call_counts.get(call_key, 0) + 1
+            if throttled:
+                self.throttle_counts[call_key] = self.throttle_counts.get(call_key, 0) + 1
+            for span in self._get_open_spans():
+                span.calls += 1
+                if throttled:
+                    span.throttles += 1
+
+    # Count a retry of an API call on the run and on all open spans of the current thread, and the throttle of the
+    # try before it if it was throttled
+    def _count_retry(self, service_name, call_name, throttled=False):
+        call_key = '{}.{}'.format(service_name, call_name)
+        with self.tracer_lock:
+            self.retry_counts[call_key] = self.retry_counts.get(call_key, 0) + 1
+            if throttled:
+                self.throttle_counts[call_key] = self.throttle_counts.get(call_key, 0) + 1
+            for span in self._get_open_spans():
+                span.retries += 1
+                if throttled:
+                    span.throttles += 1
+
+    # Wrap an AWS or Databricks API client, so that its calls are counted on the run and its open spans
+    def _instrument_client(self, client, service_name):
+        if client is None or isinstance(client, DatabricksWSInstrumentedClient):
+            return client
+        return DatabricksWSInstrumentedClient(client, service_name, self)
+
+    # Get the spans of the run's phases - the spans that were not opened within another span
+    def _get_phase_spans(self):
+        with self.tracer_lock:
+            return [span for span in self.spans if span.parent_span is None and span.end_time is not None]
+
+    # Get the critical path of the run, walking back from the phase that ended last to the phase that
+    # ended last before it started, and so on. Of phases that ended at about the same time, the longest
+    # one is taken. Returns the phases on the path in the order they ran.
+    def _get_critical_path(self):
+        phase_spans = self._get_phase_spans()
+        if not phase_spans:
+            return []
+        critical_path = [max(phase_spans, key=lambda span: span.end_time)]
+        while True:
+            path_start_time = critical_path[0].start_time
+            preceding_spans = [span for span in phase_spans if span.start_time < path_start_time
+                               and span.end_time <= path_start_time + CRITICAL_PATH_SLACK_SECONDS]
+            if not preceding_spans:
+                break
+            last_end_time = max(span.end_time for span in preceding_spans)
+            critical_path.insert(0, max([span for span in preceding_spans
+                                         if span.end_time >= last_end_time - CRITICAL_PATH_SLACK_SECONDS],
+                                        key=lambda span: span._get_seconds()))
+        return critical_path
+
+    # Get the time of the run during which no phase was running, e.g. while waiting on a concurrency cap
+    def _get_idle_seconds(self, end_time):
+        idle_seconds = 0
+        covered_until = self.start_time
+        for span in sorted(self._get_phase_spans(), key=lambda span: span.start_time):
+            if span.start_time > covered_until:
+                idle_seconds += span.start_time - covered_until
+            covered_until = max(covered_until, span.end_time)
+        return idle_seconds + max(end_time - covered_until, 0)
+
+    def _get_span_label(self, span):
+        if not span.span_attributes:
+            return span.span_name
+        return '{}({})'.format(span.span_name, ', '.join(str(value) for value in span.span_attributes.values()))
+
+    # Summarize the run - its wall time, critical path, idle time and API calls, and the total time per span name
+    def _get_summary(self):
+        end_time = time.time()
+        critical_path = self._get_critical_path()
+        critical_path_seconds = sum(span._get_seconds() for span in critical_path)
+        span_seconds = {}
+        with self.tracer_lock:
+            for span in self.spans:
+                span_seconds[span.span_name] = round(span_seconds.get(span.span_name, 0) + span._get_seconds(), 3)
+            call_counts = dict(self.call_counts)
+            throttle_counts = dict(self.throttle_counts)
+            retry_counts = dict(self.retry_counts)
+            milestone_seconds = dict((milestone_name, round(seconds, 3))
+                                     for milestone_name, seconds in self.milestone_seconds.items())
+        return {
+            "run_name": self.run_name,
+            "wall_seconds": round(end_time - self.start_time, 3),
+            "critical_path": [{"span": self._get_span_label(span), "seconds": round(span._get_seconds(), 3)}
+                              for span in critical_path],
+            "critical_path_seconds": round(critical_path_seconds, 3),
+            "idle_seconds": round(self._get_idle_seconds(end_time), 3),
+            "span_seconds": span_seconds,
+            "api_calls": sum(call_counts.values()),
+            "api_call_counts": call_counts,
+            "throttles": sum(throttle_counts.values()),
+            "throttle_counts": throttle_counts,
+            "retries": sum(retry_counts.values()),
+            "retry_counts": retry_counts,
+            "milestone_seconds": milestone_seconds
+        }
+
+    # Print a compact summary of the run
+    def _print_summary(self):
+        run_summary = self._get_summary()
+        print("Run {} took {}s, with {}s on the critical path and {}s idle".format(
+            self.run_name, run_summary["wall_seconds"], run_summary["critical_path_seconds"], run_summary["idle_seconds"]))
+        print("Critical path is {}".format(' -> '.join('{} {}s'.format(path_span["span"], path_span["seconds"])
+                                                        for path_span in run_summary["critical_path"])))
+        print("Made {} API calls, with {} throttles and {} retries".format(run_summary["api_calls"], run_summary["throttles"],
+                                                                           run_summary["retries"]))
+        return run_summary
+
+    # Export the spans of the run as a JSON trace in the Chrome trace event format, with the summary of the run
+    def _export_trace(self, trace_path):
+        trace_events = []
+        with self.tracer_lock:
+            spans = list(self.spans)
+        for span in spans:
+            span_args = dict(span.span_attributes, calls=span.calls, throttles=span.throttles, retries=span.retries)
+            if span.error is not None:
+                span_args["error"] = span.error
+            trace_events.append({
+                "name": span.span_name,
+                "ph": 'X',
+                "ts": int((span.start_time - self.start_time) * 1e6),
+                "dur": int(span._get_seconds() * 1e6),
+                "pid": self.run_name or 'run',
+                "tid": span.thread_id,
+                "args": span_args
+            })
+        os.makedirs(os.path.dirname(trace_path) or '.', exist_ok=True)
+        with open(trace_path, 'w') as trace_fileobj:
+            trace_fileobj.write(json_dumps({"traceEvents": trace_events, "otherData": self._get_summary()}, default=str))
+        return trace_path
+
+# Wrapper of an API client that counts its calls and throttles on a tracer
+class DatabricksWSInstrumentedClient(object):
+
+    def __init__(self, client, service_name, tracer):
+        self.client = client
+        self.service_name = service_name
+        self.tracer = tracer
+
+    # Check if a failed call was throttled - a ClientError from botocore or an HTTPError with status 429
+    def _is_throttled(self, ex):
+        ex_response = getattr(ex, 'response', None)
+        if isinstance(ex_response, dict):
+            return ex_response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+        return getattr(ex_response, 'status_code', None) == 429
+
+    def __getattr__(self, attribute_name):
+        attribute = getattr(self.client, attribute_name)
+        if not callable(attribute):
+            return attribute
+
+        def _instrumented_call(*args, **kwargs):
+            if not hasattr(call_context, 'instrumented_calls'):
+                call_context.instrumented_calls = []
+            call_context.instrumented_calls.append(DatabricksWSInstrumentedCall(self, attribute_name))
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as ex:
+                self.tracer._count_call(self.service_name, attribute_name, self._is_throttled(ex))
+                raise
+            finally:
+                call_context.instrumented_calls.pop()
+            # Paginators and waiters are made locally, and make their calls when they are used
+            if attribute_name in ('get_paginator', 'get_waiter'):
+                return DatabricksWSInstrumentedClient(result, '{}.{}'.format(self.service_name, args[0]), self.tracer)
+            if attribute_name == 'paginate':
+                return self._count_pages(result)
+            self.tracer._count_call(self.service_name, attribute_name)
+            return result
+        return _instrumented_call
+
+    # Count every page of a paginator as a call of its own
+    def _count_pages(self, pages):
+        for page in pages:
+            self.tracer._count_call(self.service_name, 'page')
+            yield page
+
+# A call being made through an instrumented client, which takes the retries reported by the transport under it
+class DatabricksWSInstrumentedCall(object):
+
+    def __init__(self, instrumented_client, call_name):
+        self.instrumented_client = instrumented_client
+        self.call_name = call_name
+
+    def _count_retry(self, throttled=False):
+        self.instrumented_client.tracer._count_retry(self.instrumented_client.service_name, self.call_name, throttled)
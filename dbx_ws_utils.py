@@ -1,17 +1,61 @@
 # Interface for utility methods aiding in AWS Databricks E2 Workspace provisioning
 # Majorly a client for AWS cloudformation interaction, and any pre or post processing
 
-import boto3
-import botocore
+import hashlib
+
+import botocore.exceptions
 
 from datetime import datetime
 from json import dumps as json_dumps, loads as json_loads
 
+from dbx_ws_stack_index import DatabricksWSStackIndex
+from dbx_ws_stack_poller import DatabricksWSStackPoller
+from dbx_ws_template_cache import DatabricksWSTemplateCache
+from dbx_ws_template_stager import DatabricksWSTemplateStager
+from dbx_ws_tracer import DatabricksWSTracer, traced
+
+# Tag on each stack with the fingerprint of the template and parameters it was last deployed with
+FINGERPRINT_TAG_KEY = 'dbx-ws-fingerprint'
+# Stack statuses from which a stack can be updated
+UPDATABLE_STACK_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+
 class DatabricksWSProvisioningUtils(object):
 
-    def __init__(self, common_params):
-        session = boto3.Session(profile_name='databricks-field-eng-admin')
-        self.cf_client = session.client(service_name='cloudformation', region_name=common_params["region_name"])
+    # A shared cloudformation client, stack index, stack poller and template cache can be passed in, e.g. from
+    # DatabricksWSClientPool when provisioning many workspaces. Calls made through the cloudformation client
+    # are counted on the tracer of the run. With a template stager, or a template_staging_bucket in the common params,
+    # templates are staged in S3 and stacks are created from their URL instead of an inline template body.
+    def __init__(self, common_params, cf_client=None, stack_index=None, stack_poller=None, template_cache=None,
+                 tracer=None, template_stager=None):
+        if tracer is None:
+            tracer = DatabricksWSTracer(common_params.get("workspace_name"))
+        self.tracer = tracer
+        # Full stack descriptions are only printed at verbose level
+        self.verbose = common_params.get("verbose", False)
+        if cf_client is None:
+            # boto3 takes a while to import, so it's only imported when a client has to be created
+            import boto3
+            session = boto3.Session(profile_name='databricks-field-eng-admin')
+            cf_client = session.client(service_name='cloudformation', region_name=common_params["region_name"])
+        self.cf_client = tracer._instrument_client(cf_client, 'cloudformation')
+        if stack_index is None:
+            stack_index = DatabricksWSStackIndex(self.cf_client)
+        self.stack_index = stack_index
+        if stack_poller is None:
+            stack_poller = DatabricksWSStackPoller(self.cf_client, stack_index)
+        self.stack_poller = stack_poller
+        if template_cache is None:
+            template_cache = DatabricksWSTemplateCache()
+        self.template_cache = template_cache
+        if template_stager is None and common_params.get("template_staging_bucket"):
+            import boto3
+            session = boto3.Session(profile_name='databricks-field-eng-admin')
+            s3_client = tracer._instrument_client(
+                            session.client(service_name='s3', region_name=common_params["region_name"]), 's3')
+            template_stager = DatabricksWSTemplateStager(s3_client, common_params["template_staging_bucket"],
+                                  common_params.get("template_staging_prefix", 'dbx-ws-templates/'),
+                                  common_params.get("template_staging_region", common_params["region_name"]))
+        self.template_stager = template_stager
 
     # Appropriately serialize the JSON to be printed/dumped correctly
     def _json_serial(self, obj):
@@ -22,13 +66,26 @@ class DatabricksWSProvisioningUtils(object):
         raise TypeError("Type not serializable")
 
     # Read, parse and validate a AWS cloudformation templae
+    @traced('parse_template', 'template')
     def _parse_template(self, template):
         with open(template) as template_fileobj:
             template_data_in = template_fileobj.read()
         print('Validating {}'.format(template))
-        self.cf_client.validate_template(TemplateBody=template_data_in)
+        self._get_template_parameters(template_data_in)
         return template_data_in
 
+    # Validate a template body, unless an identical one was validated before, and get its declared parameters
+    # Returns a dict of parameter key to whether the parameter has a default value
+    def _get_template_parameters(self, template_data):
+        return self.template_cache._validate_template(self.cf_client, template_data, self.template_stager)
+
+    # Get the arguments to pass a template to cloudformation with - its staged URL if templates are staged,
+    # or else its body
+    def _get_template_args(self, template_data):
+        if self.template_stager is not None:
+            return {"TemplateURL": self.template_stager._stage_template(template_data)}
+        return {"TemplateBody": template_data}
+
     # Read and parse a parameter file, including both app-specific and AWS cloudformation parameters
     def _parse_parameters(self, parameters):
         with open(parameters) as parameter_fileobj:
@@ -36,44 +93,164 @@ class DatabricksWSProvisioningUtils(object):
         parameter_data_in = json_loads(parameter_str)
         return parameter_data_in
 
+    # Fingerprint a stack deployment from its template body and resolved parameters
+    def _get_stack_fingerprint(self, template_data, parameter_data, is_iam_stack):
+        fingerprint_data = json_dumps({
+            "template": template_data,
+            "parameters": sorted((parameter["ParameterKey"], str(parameter["ParameterValue"])) for parameter in parameter_data),
+            "is_iam_stack": is_iam_stack
+        }, sort_keys=True)
+        return hashlib.sha256(fingerprint_data.encode('utf-8')).hexdigest()
+
+    # Get the fingerprint tag that was stored on a deployed stack, if any
+    def _get_deployed_fingerprint(self, stack):
+        for stack_tag in stack.get('Tags', []):
+            if stack_tag['Key'] == FINGERPRINT_TAG_KEY:
+                return stack_tag['Value']
+        return None
+
     # Check if a AWS cloudformation stack exists or not
     def _stack_exists(self, stack_name_in):
-        stacks = self.cf_client.list_stacks()['StackSummaries']
-        for stack in stacks:
-            if stack['StackStatus'] == 'DELETE_COMPLETE':
-                continue
-            if stack_name_in == stack['StackName']:
-                return True
-        return False
+        return self.stack_index._stack_exists(stack_name_in)
+
+    # Get a one line description of a stack, with its status and outputs
+    def _get_stack_summary(self, stack):
+        stack_outputs = ', '.join('{}={}'.format(stack_output['OutputKey'], stack_output['OutputValue'])
+                                  for stack_output in stack.get('Outputs', []))
+        return "Stack {} is {} with outputs [{}]".format(stack['StackName'], stack['StackStatus'], stack_outputs)
 
     # Deploy a AWS cloudformation stack
-    def _deploy_stack(self, stack_name, template_data, parameter_data, is_iam_stack):
+    # expected_seconds is a hint for the stack poller about how long the stack usually takes to create
+    @traced('deploy_stack', 'stack_name')
+    def _deploy_stack(self, stack_name, template_data, parameter_data, is_iam_stack, expected_seconds=None):
         stack_deploy_try = False
         created_stack_obj = None
         try:
             if not self._stack_exists(stack_name):
                 stack_deploy_try = True
                 print('Creating stack {}'.format(stack_name))
+                # Tag the stack with its fingerprint, so that an update can tell if anything changed
+                stack_tags = [{'Key': FINGERPRINT_TAG_KEY,
+                               'Value': self._get_stack_fingerprint(template_data, parameter_data, is_iam_stack)}]
+                template_args = self._get_template_args(template_data)
                 if(is_iam_stack):
-                    stack_result = self.cf_client.create_stack(StackName=stack_name, 
-                                        TemplateBody=template_data, Parameters=parameter_data,
-                                        Capabilities=['CAPABILITY_NAMED_IAM'])
+                    self.cf_client.create_stack(StackName=stack_name, 
+                                 Parameters=parameter_data,
+                                 Capabilities=['CAPABILITY_NAMED_IAM'], Tags=stack_tags, **template_args)
                 else:
-                    stack_result = self.cf_client.create_stack(StackName=stack_name, 
-                                        TemplateBody=template_data, Parameters=parameter_data)
-                stack_waiter = self.cf_client.get_waiter('stack_create_complete')
+                    self.cf_client.create_stack(StackName=stack_name, 
+                                 Parameters=parameter_data, Tags=stack_tags, **template_args)
                 print("...Waiting for stack {} to be created...".format(stack_name))
-                stack_waiter.wait(StackName=stack_name, WaiterConfig={'Delay': 10,'MaxAttempts': 90})
+                with self.tracer._span('wait_stack', stack_name=stack_name):
+                    created_stack = self.stack_poller._watch_stack(stack_name, 'CREATE_COMPLETE', expected_seconds).result()
         except botocore.exceptions.ClientError as ex:
             error_message = ex.response['Error']['Message']
             print(error_message)
             raise
         else:
-            if stack_deploy_try:
-                created_stack_obj = self.cf_client.describe_stacks(StackName=stack_result['StackId'])
-                print(json_dumps(created_stack_obj, indent=2, default=self._json_serial))
+            # The poller has refreshed the stack in the index, including its final status and outputs
+            if stack_deploy_try and created_stack is not None:
+                created_stack_obj = {'Stacks': [created_stack]}
+                if self.verbose:
+                    print(json_dumps(created_stack_obj, indent=2, default=self._json_serial))
+                else:
+                    print(self._get_stack_summary(created_stack))
 
         if created_stack_obj is None or created_stack_obj['Stacks'][0]['StackStatus'] != 'CREATE_COMPLETE':
             print("Exiting the script as stack {} either already exists or it was not created successfully".format(stack_name))
             exit(1)
-        return created_stack_obj
\ No newline at end of file
+        return created_stack_obj
+
+    # Delete a AWS cloudformation stack and wait until it's gone
+    # Returns the stack as it was before the deletion, or None if it didn't exist
+    @traced('delete_stack', 'stack_name')
+    def _delete_stack(self, stack_name, expected_seconds=None):
+        stack = self.stack_index._invalidate(stack_name)
+        if stack is None:
+            print("Skipping stack {} as it doesn't exist".format(stack_name))
+            return None
+        try:
+            print('Deleting stack {}'.format(stack_name))
+            self.cf_client.delete_stack(StackName=stack_name)
+            print("...Waiting for stack {} to be deleted...".format(stack_name))
+            with self.tracer._span('wait_stack', stack_name=stack_name):
+                deleted_stack = self.stack_poller._watch_stack(stack_name, 'DELETE_COMPLETE', expected_seconds).result()
+        except botocore.exceptions.ClientError as ex:
+            error_message = ex.response['Error']['Message']
+            print(error_message)
+            raise
+
+        # The poller gets None once the stack no longer exists
+        if deleted_stack is not None:
+            print("Exiting the script as stack {} was not deleted successfully, it's in {} status".format(
+                stack_name, deleted_stack['StackStatus']))
+            exit(1)
+        print("Deleted stack {}".format(stack_name))
+        return stack
+
+    # Delete a change set left behind by an earlier update that was interrupted before executing it, as change set
+    # names are derived from the fingerprint and an identical update would collide with it
+    def _delete_stale_change_set(self, stack_name, change_set_name):
+        try:
+            self.cf_client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] not in ('ChangeSetNotFound', 'ChangeSetNotFoundException'):
+                raise
+
+    # Update an existing AWS cloudformation stack through a change set, if its fingerprint has changed
+    # Returns the updated stack object, and the stack object from before the update or None if nothing changed
+    @traced('update_stack', 'stack_name')
+    def _update_stack(self, stack_name, template_data, parameter_data, is_iam_stack, expected_seconds=None):
+        previous_stack = self.stack_index._get_stack(stack_name)
+        if previous_stack is None or previous_stack['StackStatus'] not in UPDATABLE_STACK_STATUSES:
+            print("Exiting the script as stack {} either doesn't exist or can't be updated".format(stack_name))
+            exit(1)
+        stack_fingerprint = self._get_stack_fingerprint(template_data, parameter_data, is_iam_stack)
+        if self._get_deployed_fingerprint(previous_stack) == stack_fingerprint:
+            print("Skipping stack {} as its template and parameters haven't changed".format(stack_name))
+            return {'Stacks': [previous_stack]}, None
+
+        change_set_name = 'dbx-ws-update-{}'.format(stack_fingerprint[:16])
+        change_set_args = {
+            "StackName": stack_name,
+            "ChangeSetName": change_set_name,
+            "ChangeSetType": 'UPDATE',
+            "Parameters": parameter_data,
+            "Tags": [{'Key': FINGERPRINT_TAG_KEY, 'Value': stack_fingerprint}]
+        }
+        change_set_args.update(self._get_template_args(template_data))
+        if is_iam_stack:
+            change_set_args["Capabilities"] = ['CAPABILITY_NAMED_IAM']
+        try:
+            self._delete_stale_change_set(stack_name, change_set_name)
+            print('Creating change set {} for stack {}'.format(change_set_name, stack_name))
+            self.cf_client.create_change_set(**change_set_args)
+            change_set_waiter = self.cf_client.get_waiter('change_set_create_complete')
+            try:
+                change_set_waiter.wait(StackName=stack_name, ChangeSetName=change_set_name,
+                                       WaiterConfig={'Delay': 2, 'MaxAttempts': 90})
+            except botocore.exceptions.WaiterError:
+                change_set = self.cf_client.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+                status_reason = change_set.get('StatusReason', '')
+                if "didn't contain changes" in status_reason or "No updates" in status_reason:
+                    self.cf_client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+                    print("Skipping stack {} as its change set contains no changes".format(stack_name))
+                    return {'Stacks': [previous_stack]}, None
+                print("Exiting the script as change set for stack {} failed: {}".format(stack_name, status_reason))
+                exit(1)
+
+            print('Executing change set {} for stack {}'.format(change_set_name, stack_name))
+            self.cf_client.execute_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            print("...Waiting for stack {} to be updated...".format(stack_name))
+            with self.tracer._span('wait_stack', stack_name=stack_name):
+                updated_stack = self.stack_poller._watch_stack(stack_name, 'UPDATE_COMPLETE', expected_seconds).result()
+        except botocore.exceptions.ClientError as ex:
+            error_message = ex.response['Error']['Message']
+            print(error_message)
+            raise
+
+        if updated_stack is None or updated_stack['StackStatus'] != 'UPDATE_COMPLETE':
+            print("Exiting the script as stack {} was not updated successfully".format(stack_name))
+            exit(1)
+        return {'Stacks': [updated_stack]}, {'Stacks': [previous_stack]}
+
@@ -0,0 +1,161 @@
+# Interface for a shared watcher of Databricks E2 Workspaces that are being provisioned or deleted
+# Tracks all workspaces from a single thread, listing the account's workspaces in one call when many are due,
+# with an adaptive delay and a deadline per workspace. The time each one took to get to RUNNING is printed, and returned
+# with its status to be recorded in the trace of its run.
+
+import random
+import threading
+import time
+
+from concurrent.futures import Future
+
+class DatabricksWSWorkspaceWatcher(object):
+
+    def __init__(self, accounts_api_client, min_delay=5, max_delay=60, batch_threshold=3, expected_seconds=300):
+        self.accounts_api_client = accounts_api_client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # When at least this many workspaces of an account are due at once, list the account's workspaces instead
+        self.batch_threshold = batch_threshold
+        self.expected_seconds = expected_seconds
+        self.watched_workspaces = {}
+        self.watcher_condition = threading.Condition()
+        self.watcher_thread = None
+
+    # Start watching a workspace until it's no longer provisioning - or with until_deleted, until it no longer
+    # exists - or until its deadline has passed. Returns a future with the final workspace status, which is None if
+    # the workspace doesn't exist, and still PROVISIONING if the deadline passed while provisioning, and the seconds
+    # the watch took. A workspace that is already watched the same way shares that watch, and a watch of it the other
+    # way fails the earlier one, as it can't end the way it was waited for.
+    def _watch_workspace(self, account_id, workspace_id, deadline_seconds=1800, until_deleted=False):
+        workspace_future = Future()
+        replaced_workspace = None
+        with self.watcher_condition:
+            watched_workspace = self.watched_workspaces.get(workspace_id)
+            if watched_workspace is not None and watched_workspace["until_deleted"] == until_deleted:
+                watched_workspace["deadline"] = max(watched_workspace["deadline"], time.time() + deadline_seconds)
+                return watched_workspace["future"]
+            replaced_workspace = watched_workspace
+            self.watched_workspaces[workspace_id] = {
+                "future": workspace_future,
+                "account_id": account_id,
+                "until_deleted": until_deleted,
+                "started_at": time.time(),
+                "deadline": time.time() + deadline_seconds,
+                "next_poll_at": time.time() + self.min_delay
+            }
+            if self.watcher_thread is None or not self.watcher_thread.is_alive():
+                self.watcher_thread = threading.Thread(target=self._watch_loop, name='workspace-watcher', daemon=True)
+                self.watcher_thread.start()
+            self.watcher_condition.notify()
+        if replaced_workspace is not None:
+            replaced_workspace["future"].set_exception(RuntimeError(
+                "Watch of workspace {} was replaced by a watch until it's {}".format(
+                    workspace_id, 'deleted' if until_deleted else 'provisioned')))
+        return workspace_future
+
+    # Get the delay until the next check of a workspace - long early on, short close to the expected
+    # provisioning time, and backing off again when it's overdue. Jittered to spread the calls.
+    def _get_poll_delay(self, watched_workspace):
+        elapsed_seconds = time.time() - watched_workspace["started_at"]
+        remaining_seconds = self.expected_seconds - elapsed_seconds
+        if remaining_seconds > 0:
+            poll_delay = remaining_seconds / 3
+        else:
+            poll_delay = -remaining_seconds / 10
+        poll_delay = min(max(poll_delay, self.min_delay), self.max_delay)
+        return poll_delay * random.uniform(0.8, 1.2)
+
+    # Get the current status of a workspace, or None if it doesn't exist
+    def _get_workspace_status(self, account_id, workspace_id):
+        try:
+            workspace_prov_resp = self.accounts_api_client.get_workspace(account_id, workspace_id)
+        except Exception as ex:
+            if getattr(getattr(ex, 'response', None), 'status_code', None) == 404:
+                return None
+            raise
+        return workspace_prov_resp['workspace_status']
+
+    # Get the current status of the due workspaces of an account, in one listing call if there are enough of them
+    def _get_workspace_statuses(self, account_id, workspace_ids):
+        if len(workspace_ids) >= self.batch_threshold and hasattr(self.accounts_api_client, 'list_workspaces'):
+            workspaces = self.accounts_api_client.list_workspaces(account_id)
+            listed_statuses = {workspace['workspace_id']: workspace['workspace_status'] for workspace in workspaces}
+        else:
+            listed_statuses = {}
+        workspace_statuses = {}
+        for workspace_id in workspace_ids:
+            if workspace_id in listed_statuses:
+                workspace_statuses[workspace_id] = listed_statuses[workspace_id]
+                continue
+            workspace_statuses[workspace_id] = self._get_workspace_status(account_id, workspace_id)
+        return workspace_statuses
+
+    # Check the due workspaces of an account, and complete the futures of the ones that are done or past their deadline
+    def _poll_due_workspaces(self, account_id, workspace_ids):
+        workspace_statuses = self._get_workspace_statuses(account_id, workspace_ids)
+        for workspace_id, workspace_prov_status in workspace_statuses.items():
+            with self.watcher_condition:
+                watched_workspace = self.watched_workspaces[workspace_id]
+            elapsed_seconds = time.time() - watched_workspace["started_at"]
+
+            if watched_workspace["until_deleted"]:
+                is_finished = workspace_prov_status is None
+                if is_finished:
+                    print("Workspace {} was deleted in {:.0f}s".format(workspace_id, elapsed_seconds))
+            else:
+                is_finished = workspace_prov_status != 'PROVISIONING'
+                if workspace_prov_status == 'RUNNING':
+                    print("Workspace {} got to RUNNING in {:.0f}s".format(workspace_id, elapsed_seconds))
+                elif workspace_prov_status is None:
+                    print("Workspace {} no longer exists".format(workspace_id))
+
+            if not is_finished and time.time() > watched_workspace["deadline"]:
+                print("Workspace {} is still {} after its deadline of {:.0f}s".format(workspace_id,
+                      'being deleted' if watched_workspace["until_deleted"] else 'provisioning', elapsed_seconds))
+            elif not is_finished:
+                watched_workspace["next_poll_at"] = time.time() + self._get_poll_delay(watched_workspace)
+                continue
+
+            # A watch that was replaced while it was checked has already been failed
+            with self.watcher_condition:
+                if self.watched_workspaces.get(workspace_id) is not watched_workspace:
+                    continue
+                del self.watched_workspaces[workspace_id]
+            watched_workspace["future"].set_result({"workspace_status": workspace_prov_status,
+                                                    "elapsed_seconds": elapsed_seconds})
+
+    # Poll the watched workspaces whenever the earliest of them is due, until there are none left
+    def _watch_loop(self):
+        while True:
+            with self.watcher_condition:
+                if not self.watched_workspaces:
+                    self.watcher_thread = None
+                    return
+                next_poll_at = min(watched_workspace["next_poll_at"] for watched_workspace in self.watched_workspaces.values())
+                if next_poll_at > time.time():
+                    self.watcher_condition.wait(next_poll_at - time.time())
+                    continue
+                # Workspaces due within the minimum delay are checked along with the due ones, to share a listing call
+                due_workspace_ids = {}
+                for workspace_id, watched_workspace in self.watched_workspaces.items():
+                    if watched_workspace["next_poll_at"] <= time.time() + self.min_delay:
+                        due_workspace_ids.setdefault(watched_workspace["account_id"], []).append(workspace_id)
+
+            for account_id, workspace_ids in due_workspace_ids.items():
+                try:
+                    self._poll_due_workspaces(account_id, workspace_ids)
+                except Exception as ex:
+                    # Most likely throttling or a transient API error - back off these workspaces and try again
+                    print("Checking workspaces {} failed with {!r}, backing off".format(workspace_ids, ex))
+                    expired_workspaces = []
+                    with self.watcher_condition:
+                        for workspace_id in workspace_ids:
+                            if workspace_id not in self.watched_workspaces:
+                                continue
+                            if time.time() > self.watched_workspaces[workspace_id]["deadline"]:
+                                expired_workspaces.append(self.watched_workspaces.pop(workspace_id))
+                            else:
+                                self.watched_workspaces[workspace_id]["next_poll_at"] = time.time() + self.max_delay
+                    for watched_workspace in expired_workspaces:
+                        watched_workspace["future"].set_exception(ex)
@@ -0,0 +1,168 @@
+# Tests of the stack poller, the workspace watcher and resumed runs against the fake AWS and Accounts API clients
+# Run with python -m pytest from the project directory
+
+import contextlib
+import io
+import json
+import os
+import time
+
+import botocore.exceptions
+import pytest
+
+from dbx_ws_accounts_api import DatabricksWSAccountsAPI
+from dbx_ws_benchmark import DatabricksWSBenchmark, DatabricksWSBenchmarkClientPool
+from dbx_ws_fleet_provisioner import DatabricksWSFleetProvisioner
+from dbx_ws_provisioner import get_run_journal, provision_workspace, update_workspace
+from dbx_ws_resource_pool import DatabricksWSResourcePool
+from dbx_ws_stack_index import DatabricksWSStackIndex
+from dbx_ws_stack_poller import DatabricksWSStackPoller
+from dbx_ws_stack_scheduler import DatabricksWSStackScheduler
+from dbx_ws_template_cache import DatabricksWSTemplateCache
+from dbx_ws_tracer import DatabricksWSTracer
+from dbx_ws_workspace_watcher import DatabricksWSWorkspaceWatcher
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+TIME_SCALE = 0.005
+
+# A cloudformation client whose stack calls all fail with the same error code
+class FailingCloudFormationClient(object):
+
+    def __init__(self, error_code):
+        self.error_code = error_code
+        self.call_count = 0
+
+    def describe_stacks(self, **kwargs):
+        self.call_count += 1
+        raise botocore.exceptions.ClientError({'Error': {'Code': self.error_code, 'Message': self.error_code}},
+                                              'DescribeStacks')
+
+# An accounts API client whose workspaces get to RUNNING after a set time
+class SlowAccountsApiClient(object):
+
+    def __init__(self, running_after_seconds):
+        self.running_at = time.time() + running_after_seconds
+
+    def get_workspace(self, account_id, workspace_id):
+        return {'workspace_status': 'RUNNING' if time.time() > self.running_at else 'PROVISIONING'}
+
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+# The benchmark's fakes and client pool, with the run journals in a temporary directory
+@pytest.fixture
+def fake_env(tmp_path, monkeypatch):
+    monkeypatch.chdir(PROJECT_DIR)
+    with open('common_params.json') as common_params_file:
+        defaults = json.load(common_params_file)
+    benchmark = DatabricksWSBenchmark(defaults, time_scale=TIME_SCALE)
+    steps = DatabricksWSStackScheduler(None)._parse_step_graph('stack_graph.json')
+    cf_client, accounts_api_client, _ = benchmark._build_fakes(steps)
+    client_pool = DatabricksWSBenchmarkClientPool(cf_client, accounts_api_client,
+                                                  DatabricksWSTemplateCache(str(tmp_path / 'template_cache')), TIME_SCALE)
+    return {
+        "defaults": dict(defaults, run_journal_dir=str(tmp_path / 'run_journal'), trace_dir=str(tmp_path / 'traces')),
+        "benchmark": benchmark,
+        "cf_client": cf_client,
+        "accounts_api_client": accounts_api_client,
+        "client_pool": client_pool,
+        "step_graph": benchmark._write_scaled_step_graph(steps, str(tmp_path)),
+        "tmp_path": tmp_path
+    }
+
+def get_live_stacks(cf_client):
+    return sorted((stack['StackName'], cf_client._get_stack_status(stack)) for stack in cf_client._get_live_stacks())
+
+def test_poller_fails_on_non_throttling_error_without_waiting_for_deadline():
+    cf_client = FailingCloudFormationClient('AccessDenied')
+    poller = DatabricksWSStackPoller(cf_client, DatabricksWSStackIndex(cf_client), min_delay=0.01, max_delay=0.05)
+    stack_future = poller._watch_stack('stack', timeout_seconds=30)
+    with pytest.raises(botocore.exceptions.ClientError):
+        stack_future.result(timeout=5)
+    assert cf_client.call_count == 1
+
+def test_poller_backs_off_throttling_until_deadline():
+    cf_client = FailingCloudFormationClient('Throttling')
+    poller = DatabricksWSStackPoller(cf_client, DatabricksWSStackIndex(cf_client), min_delay=0.01, max_delay=0.05)
+    started_at = time.time()
+    with quiet():
+        stack_future = poller._watch_stack('stack', timeout_seconds=0.3)
+        with pytest.raises(botocore.exceptions.ClientError):
+            stack_future.result(timeout=5)
+    assert time.time() - started_at >= 0.3
+    assert cf_client.call_count > 1
+
+def test_poller_shares_duplicate_watch_and_fails_replaced_one():
+    cf_client = FailingCloudFormationClient('Throttling')
+    poller = DatabricksWSStackPoller(cf_client, DatabricksWSStackIndex(cf_client), min_delay=5, max_delay=5)
+    first_future = poller._watch_stack('stack')
+    assert poller._watch_stack('stack') is first_future
+    deleted_future = poller._watch_stack('stack', success_status='DELETE_COMPLETE')
+    with pytest.raises(RuntimeError):
+        first_future.result(timeout=1)
+    assert not deleted_future.done()
+
+def test_watcher_shares_duplicate_watch_and_fails_replaced_one():
+    watcher = DatabricksWSWorkspaceWatcher(SlowAccountsApiClient(0.2), min_delay=0.02, max_delay=0.05,
+                                           expected_seconds=0.2)
+    with quiet():
+        first_future = watcher._watch_workspace('account', 'workspace-1')
+        assert watcher._watch_workspace('account', 'workspace-1') is first_future
+        assert first_future.result(timeout=5)["workspace_status"] == 'RUNNING'
+
+        provisioned_future = watcher._watch_workspace('account', 'workspace-2')
+        watcher._watch_workspace('account', 'workspace-2', until_deleted=True)
+        with pytest.raises(RuntimeError):
+            provisioned_future.result(timeout=1)
+
+def test_resume_recreates_failed_stacks(fake_env):
+    cf_client = fake_env["cf_client"]
+    manifest_rows = fake_env["benchmark"]._get_manifest_rows(1)
+    cf_client.stack_failure_rate = 1
+    with quiet():
+        fleet_results = DatabricksWSFleetProvisioner(fake_env["defaults"], fake_env["client_pool"], 10, 10,
+                                                     fake_env["step_graph"])._provision_fleet(manifest_rows)
+    assert fleet_results[0]["error"]
+    assert any(stack_status == 'ROLLBACK_COMPLETE' for _, stack_status in get_live_stacks(cf_client))
+
+    cf_client.stack_failure_rate = 0
+    with quiet():
+        fleet_results = DatabricksWSFleetProvisioner(fake_env["defaults"], fake_env["client_pool"], 10, 10,
+                                                     fake_env["step_graph"], resume=True)._provision_fleet(manifest_rows)
+    assert fleet_results[0]["workspace_status"] == 'RUNNING'
+    assert {stack_status for _, stack_status in get_live_stacks(cf_client)} == {'CREATE_COMPLETE'}
+
+def test_resume_of_pooled_run_reuses_its_bundle(fake_env, monkeypatch):
+    cf_client = fake_env["cf_client"]
+    accounts_api_client = fake_env["accounts_api_client"]
+    with quiet():
+        resource_pool = DatabricksWSResourcePool(fake_env["defaults"], fake_env["client_pool"], 1,
+                                                 step_graph=fake_env["step_graph"],
+                                                 state_path=str(fake_env["tmp_path"] / 'resource_pool' / 'pool.json'),
+                                                 bundle_overrides=fake_env["defaults"]["resource_pool_overrides"])
+        resource_pool._start()
+        resource_pool._wait_until_ready(1, 30)
+
+    # Interrupt the run once its workspace is created, as if the process was stopped while it was provisioning
+    def interrupted_check(self, *args, **kwargs):
+        raise SystemExit(1)
+    manifest_rows = fake_env["benchmark"]._get_manifest_rows(1)
+    fleet_provisioner = DatabricksWSFleetProvisioner(fake_env["defaults"], fake_env["client_pool"], 10, 10,
+                                                     fake_env["step_graph"], resource_pool=resource_pool)
+    with monkeypatch.context() as patch, quiet():
+        patch.setattr(DatabricksWSAccountsAPI, '_check_workspace_provisioning', interrupted_check)
+        fleet_results = fleet_provisioner._provision_fleet(manifest_rows)
+        resource_pool._stop(wait=True)
+    assert fleet_results[0]["error"]
+
+    live_stacks = get_live_stacks(cf_client)
+    account_object_counts = {object_type: len(objects) for object_type, objects in accounts_api_client.account_objects.items()}
+    common_params = fleet_provisioner._build_common_params(manifest_rows[0])
+    ws_prov_utils, accounts_api = fleet_provisioner._get_provisioning_apis(common_params, DatabricksWSTracer('resume'))
+    with quiet():
+        provision_workspace(common_params, ws_prov_utils, accounts_api, fake_env["step_graph"],
+                            get_run_journal(common_params, True))
+        update_workspace(common_params, ws_prov_utils, accounts_api, fake_env["step_graph"])
+    assert [stack_name for stack_name, _ in get_live_stacks(cf_client)] == [stack_name for stack_name, _ in live_stacks]
+    assert {object_type: len(objects) for object_type, objects in accounts_api_client.account_objects.items()} == \
+        account_object_counts